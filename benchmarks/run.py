@@ -0,0 +1,327 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# End-to-end benchmark of the XML -> tokens -> BPE -> batches -> generate
+# pipeline on a synthetic corpus. Run from the repo root:
+#
+#   python -m benchmarks.run --num_files=500
+#
+# Every run is appended to a JSON lines history (one object per run with the
+# commit, config and per-stage results) and compared against the last run with
+# the same config, so regressions show up between commits.
+
+import contextlib
+import datetime
+import io
+import json
+import os
+import subprocess
+import time
+
+import torch
+from absl import app, flags
+
+import bpe
+import consts
+import prep
+import sbiff
+import util
+from benchmarks import sampling_bench, synthetic
+from model_data import ModelDataProvider, Sampling, Split
+from model_def import GPT, GPTConfig
+from tokens import Tokens
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+flags.DEFINE_integer("num_files", 200, "The number of synthetic scores.")
+flags.DEFINE_integer("max_measures", 64, "The maximum number of measures per score.")
+flags.DEFINE_integer("seed", 0, "Seed for the synthetic corpus.")
+flags.DEFINE_integer("bpe_merges", 100, "The number of BPE tokens to create.")
+flags.DEFINE_integer("batch_block_size", 256, "The block size for get_batch.")
+flags.DEFINE_integer("num_batches", 200, "The number of get_batch calls to time.")
+flags.DEFINE_integer(
+    "compressed_block_ints", 2**14, "The block size for the compressed SBIFF reads."
+)
+flags.DEFINE_integer("generate_tokens", 200, "The number of tokens to generate.")
+flags.DEFINE_integer(
+    "generate_context_stride",
+    8,
+    "The context_stride for the strided generate, out of the block size of 32.",
+)
+flags.DEFINE_string(
+    "history",
+    os.path.join(_REPO_ROOT, "benchmarks", "history.jsonl"),
+    "The JSON lines file results are appended to.",
+)
+flags.DEFINE_boolean("record", True, "Whether to append this run to --history.")
+
+
+def _Time(fn):
+    t0 = time.perf_counter()
+    res = fn()
+    return time.perf_counter() - t0, res
+
+
+def _GitCommit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=_REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=_REPO_ROOT,
+            capture_output=True,
+            text=True,
+        )
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def RunPipeline(paths):
+    """Runs each stage on `paths` in the current directory and returns its metrics."""
+    FLAGS = flags.FLAGS
+    results = {}
+
+    dt, all_tokens = _Time(lambda: [util.GetTokensFromXml(p) for p in paths])
+    num_tokens = sum(len(t) for t in all_tokens)
+    results["get_tokens_from_xml"] = {
+        "sec": dt,
+        "files_per_sec": len(paths) / dt,
+        "tokens_per_sec": num_tokens / dt,
+    }
+
+    dt, _ = _Time(lambda: prep.CountTokens(paths))
+    results["count_tokens"] = {"sec": dt, "files_per_sec": len(paths) / dt}
+
+    unique_tokens = set().union(*all_tokens) | {consts.DOC_END_TOKEN}
+    stoi = {token: i for i, token in enumerate(sorted(unique_tokens))}
+    tag_stoi = {s: i for s, i in stoi.items() if Tokens.IsTagStr(s)}
+    util.EnsureDirExists(consts.TRAINING_DATA_ROOT)
+    sbiff.Create(
+        consts.TRAINING_DATA_NUMS,
+        width=sbiff.WidthFor(len(stoi) - 1),
+        byteorder=consts.SBIFF_BYTEORDER,
+    )
+    dt, _ = _Time(lambda: prep.SinkNums(paths, stoi, tag_stoi))
+    num_base_ints = sbiff.CountInts(consts.TRAINING_DATA_NUMS)
+    results["sink_nums"] = {
+        "sec": dt,
+        "files_per_sec": len(paths) / dt,
+        "tokens_per_sec": num_base_ints / dt,
+    }
+
+    options = bpe.BpeOptions(
+        stoi=stoi,
+        src=consts.TRAINING_DATA_NUMS,
+        dst=consts.TRAINING_DATA_BPE_NUMS,
+    )
+    options.max_vocab_size = len(stoi) + FLAGS.bpe_merges
+    # BPE prints a line per merge.
+    with contextlib.redirect_stdout(io.StringIO()):
+        dt, merges = _Time(lambda: bpe._GenNewTokens(options))
+        results["bpe_gen_new_tokens"] = {
+            "sec": dt,
+            "merges_per_sec": len(merges) / dt,
+        }
+        dt, _ = _Time(lambda: bpe._WriteNewDataset(merges, options))
+    results["bpe_write_new_dataset"] = {"sec": dt, "tokens_per_sec": num_base_ints / dt}
+
+    path = consts.TRAINING_DATA_BPE_NUMS
+    dt, ints = _Time(lambda: sbiff.ReadAllInts(path))
+    results["sbiff_read_all_ints"] = {"sec": dt, "tokens_per_sec": len(ints) / dt}
+
+    def ReadDocs():
+        offset, n = 0, 0
+        end_token = stoi[consts.DOC_END_TOKEN]
+        while True:
+            _, nxt = sbiff.ReadUntilInt(path, end_token, n_offset=offset)
+            n += 1
+            if nxt == -1:
+                return n
+            offset = nxt + 1
+
+    dt, num_docs = _Time(ReadDocs)
+    results["sbiff_read_until_int"] = {"sec": dt, "docs_per_sec": num_docs / dt}
+
+    block_size = min(FLAGS.batch_block_size, len(ints) // 20)
+    dt, _ = _Time(
+        lambda: [sbiff.ReadRandomNInts(path, block_size) for _ in range(1000)]
+    )
+    results["sbiff_read_random_n_ints"] = {"sec": dt, "reads_per_sec": 1000 / dt}
+
+    provider = ModelDataProvider()
+    dt, _ = _Time(
+        lambda: [
+            provider.get_batch(Split.Train, block_size, consts.BATCH_SIZE)
+            for _ in range(FLAGS.num_batches)
+        ]
+    )
+    results["get_batch"] = {
+        "sec": dt,
+        "batches_per_sec": FLAGS.num_batches / dt,
+        "tokens_per_sec": FLAGS.num_batches * block_size * consts.BATCH_SIZE / dt,
+    }
+
+    # Picking a doc first, weighted by the square root of its length.
+    provider = ModelDataProvider(
+        sampling=Sampling.Sqrt, doc_end_int=stoi[consts.DOC_END_TOKEN]
+    )
+    dt, _ = _Time(
+        lambda: [
+            provider.get_batch(Split.Train, block_size, consts.BATCH_SIZE)
+            for _ in range(FLAGS.num_batches)
+        ]
+    )
+    results["get_batch_sqrt"] = {
+        "sec": dt,
+        "batches_per_sec": FLAGS.num_batches / dt,
+        "tokens_per_sec": FLAGS.num_batches * block_size * consts.BATCH_SIZE / dt,
+    }
+
+    # The same reads from block-compressed copies of the data.
+    compressed = {}
+    for name, src in [("base", consts.TRAINING_DATA_NUMS), ("bpe", path)]:
+        compressed[name] = src + ".z"
+        dt, _ = _Time(
+            lambda: sbiff.Convert(
+                src, compressed[name], block_ints=FLAGS.compressed_block_ints
+            )
+        )
+        results[f"sbiff_compress_{name}"] = {
+            "sec": dt,
+            "tokens_per_sec": sbiff.CountInts(src) / dt,
+            "compression_ratio": os.path.getsize(src)
+            / os.path.getsize(compressed[name]),
+        }
+    provider = ModelDataProvider(compressed["bpe"])
+    dt, _ = _Time(
+        lambda: [
+            provider.get_batch(Split.Train, block_size, consts.BATCH_SIZE)
+            for _ in range(FLAGS.num_batches)
+        ]
+    )
+    results["get_batch_compressed"] = {
+        "sec": dt,
+        "batches_per_sec": FLAGS.num_batches / dt,
+        "tokens_per_sec": FLAGS.num_batches * block_size * consts.BATCH_SIZE / dt,
+    }
+
+    # The small config from consts.py with random weights.
+    torch.manual_seed(0)
+    vocab_size = len(stoi) + len(merges)
+    config = GPTConfig(
+        block_size=32,
+        vocab_size=((vocab_size // 64) * 64) + 64,
+        n_layer=4,
+        n_head=4,
+        n_embd=64,
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = GPT(config).eval()
+    dt, _ = _Time(
+        lambda: model.generate(torch.tensor([[0]]), FLAGS.generate_tokens, top_k=200)
+    )
+    results["generate"] = {"sec": dt, "tokens_per_sec": FLAGS.generate_tokens / dt}
+    dt, _ = _Time(
+        lambda: model.generate(
+            torch.tensor([[0]]),
+            FLAGS.generate_tokens,
+            top_k=200,
+            context_stride=FLAGS.generate_context_stride,
+        )
+    )
+    results["generate_strided"] = {
+        "sec": dt,
+        "tokens_per_sec": FLAGS.generate_tokens / dt,
+    }
+
+    for r in sampling_bench.Run():
+        name = f"sampling batch={r['batch_size']} {r['case']}"
+        results[name] = {"sec": r["us_per_step"] / 1e6}
+
+    return results
+
+
+def _LastComparableRun(history_path, config):
+    if not os.path.exists(history_path):
+        return None
+    last = None
+    with open(history_path, "r") as f:
+        for line in f:
+            run = json.loads(line)
+            if run["config"] == config:
+                last = run
+    return last
+
+
+def _Report(results, previous):
+    for stage, metrics in results.items():
+        rates = ", ".join(
+            f"{k} {v:,.1f}"
+            for k, v in metrics.items()
+            if k.endswith(("_per_sec", "_ratio"))
+        )
+        change = ""
+        if previous is not None and stage in previous["results"]:
+            before = previous["results"][stage]["sec"]
+            change = (
+                f"  {(metrics['sec'] - before) / before:+.1%} vs {previous['commit']}"
+            )
+        print(f"{stage:<48} {metrics['sec']:>9.4f}s  {rates}{change}")
+
+
+def Main(argv):
+    FLAGS = flags.FLAGS
+    config = {
+        "num_files": FLAGS.num_files,
+        "max_measures": FLAGS.max_measures,
+        "seed": FLAGS.seed,
+        "bpe_merges": FLAGS.bpe_merges,
+        "batch_block_size": FLAGS.batch_block_size,
+        "num_batches": FLAGS.num_batches,
+        "generate_tokens": FLAGS.generate_tokens,
+        "generate_context_stride": FLAGS.generate_context_stride,
+        "parallelism": consts.PARALLELISM,
+        "xml_parser": "etree" if util.GetLxml() is None else "lxml",
+        "sbiff_byteorder": consts.SBIFF_BYTEORDER,
+        "compressed_block_ints": FLAGS.compressed_block_ints,
+    }
+    history_path = os.path.abspath(FLAGS.history)
+
+    cwd = os.getcwd()
+    with util.GetTempDir() as dir_path:
+        paths = synthetic.WriteCorpus(
+            os.path.join(dir_path, "corpus"),
+            FLAGS.num_files,
+            max_measures=FLAGS.max_measures,
+            seed=FLAGS.seed,
+        )
+        # Stages read and write the relative paths in consts.
+        os.chdir(dir_path)
+        try:
+            results = RunPipeline(paths)
+        finally:
+            os.chdir(cwd)
+
+    _Report(results, _LastComparableRun(history_path, config))
+    if FLAGS.record:
+        run = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _GitCommit(),
+            "config": config,
+            "results": results,
+        }
+        with open(history_path, "a") as f:
+            f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    app.run(Main)
@@ -0,0 +1,67 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# Compares sampling.Sampler against the masking path GPT.generate used before:
+#   python -m benchmarks.sampling_bench
+
+import time
+
+import torch
+from torch.nn import functional as F
+
+from sampling import Sampler
+
+VOCAB_SIZE = 20032
+BATCH_SIZES = (1, 16)
+TOP_K = 200
+STEPS = 300
+
+
+def MaskingSample(logits, temperature=1, top_k=None):
+    """The sampling code GPT.generate had before sampling.Sampler."""
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[:, [-1]]] = -float("Inf")
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+
+def _TimePerStep(fn, logits):
+    fn(logits)  # Warm up.
+    t0 = time.perf_counter()
+    for _ in range(STEPS):
+        fn(logits)
+    return (time.perf_counter() - t0) / STEPS
+
+
+def Run():
+    results = []
+    for batch_size in BATCH_SIZES:
+        logits = torch.randn(batch_size, VOCAB_SIZE)
+        cases = [
+            (f"masking top_k={TOP_K}", lambda x: MaskingSample(x, 0.8, TOP_K)),
+            (f"sampler top_k={TOP_K}", Sampler(0.8, top_k=TOP_K)),
+            (f"sampler top_k={TOP_K} top_p=0.9", Sampler(0.8, TOP_K, top_p=0.9)),
+            (f"sampler top_k={TOP_K} min_p=0.05", Sampler(0.8, TOP_K, min_p=0.05)),
+            ("masking full vocab", lambda x: MaskingSample(x, 0.8)),
+            ("sampler full vocab", Sampler(0.8)),
+            ("sampler min_p=0.05", Sampler(0.8, min_p=0.05)),
+            ("sampler top_p=0.9", Sampler(0.8, top_p=0.9)),
+        ]
+        for name, fn in cases:
+            sec = _TimePerStep(fn, logits)
+            results.append(
+                {"batch_size": batch_size, "case": name, "us_per_step": sec * 1e6}
+            )
+    return results
+
+
+if __name__ == "__main__":
+    for r in Run():
+        print(
+            f"batch {r['batch_size']:>3}  {r['case']:<36} {r['us_per_step']:>10.1f} us/step"
+        )
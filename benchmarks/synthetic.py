@@ -0,0 +1,104 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# Generates synthetic single-staff MusicXML corpora for benchmarking. The scores
+# are musically meaningless but shaped like real ones: the same tags, ignored
+# elements and attributes (identification, part-list, direction, default-x...)
+# and numeric text that goes through TranslateNum.
+
+import gzip
+import os
+import random
+from typing import List
+
+_STEPS = "CDEFGAB"
+_TYPES = [("16th", 1), ("eighth", 2), ("quarter", 4), ("half", 8)]
+
+
+def _Note(rng: random.Random, divisions: int) -> str:
+    note_type, length = rng.choice(_TYPES)
+    duration = divisions * length // 4
+    x = rng.randint(0, 400)
+    if rng.random() < 0.1:
+        return (
+            f'<note default-x="{x}"><rest/><duration>{duration}</duration>'
+            f"<voice>1</voice><type>{note_type}</type></note>"
+        )
+    alter = f"<alter>{rng.choice([-1, 1])}</alter>" if rng.random() < 0.2 else ""
+    beam = '<beam number="1">begin</beam>' if length <= 2 else ""
+    tie = '<tie type="start"/>' if rng.random() < 0.05 else ""
+    notations = (
+        '<notations><slur type="start" placement="above"/></notations>'
+        if rng.random() < 0.1
+        else ""
+    )
+    return (
+        f'<note default-x="{x}" default-y="-{rng.randint(0, 60)}">'
+        f"<pitch><step>{rng.choice(_STEPS)}</step>{alter}"
+        f"<octave>{rng.randint(3, 6)}</octave></pitch>"
+        f"<duration>{duration}</duration>{tie}<voice>1</voice>"
+        f"<type>{note_type}</type><stem>{rng.choice(['up', 'down'])}</stem>"
+        f"{beam}{notations}</note>"
+    )
+
+
+def _Measure(rng: random.Random, number: int, divisions: int) -> str:
+    parts = [f'<measure number="{number}" width="{rng.randint(150, 400)}">']
+    if number == 1:
+        parts.append(
+            f"<attributes><divisions>{divisions}</divisions>"
+            f"<key><fifths>{rng.randint(-7, 7)}</fifths><mode>major</mode></key>"
+            "<time><beats>4</beats><beat-type>4</beat-type></time>"
+            "<clef><sign>G</sign><line>2</line></clef></attributes>"
+        )
+    if rng.random() < 0.1:
+        parts.append(
+            '<direction placement="above"><direction-type><words>dolce</words>'
+            "</direction-type></direction>"
+        )
+    parts.extend(_Note(rng, divisions) for _ in range(rng.randint(2, 8)))
+    parts.append("</measure>")
+    return "".join(parts)
+
+
+def GenerateScore(rng: random.Random, num_measures: int) -> str:
+    divisions = rng.choice([1, 2, 4, 24, 96, 100, 480])
+    measures = "".join(_Measure(rng, i + 1, divisions) for i in range(num_measures))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<score-partwise version="3.1">'
+        "<identification><encoding><software>synthetic</software></encoding>"
+        "</identification>"
+        "<defaults><scaling><millimeters>7</millimeters><tenths>40</tenths></scaling></defaults>"
+        '<part-list><score-part id="P1"><part-name>Piano</part-name></score-part></part-list>'
+        f'<part id="P1">{measures}</part>'
+        "</score-partwise>"
+    )
+
+
+def WriteCorpus(
+    root: str,
+    num_files: int,
+    max_measures: int = 64,
+    gzip_fraction: float = 0.25,
+    seed: int = 0,
+) -> List[str]:
+    """Writes `num_files` synthetic scores under `root` and returns their paths."""
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    paths = []
+    for i in range(num_files):
+        xml = GenerateScore(rng, rng.randint(4, max_measures))
+        if rng.random() < gzip_fraction:
+            path = os.path.join(root, f"score_{i}.xml.gz")
+            with gzip.open(path, "wt") as f:
+                f.write(xml)
+        else:
+            path = os.path.join(root, f"score_{i}.xml")
+            with open(path, "w") as f:
+                f.write(xml)
+        paths.append(path)
+    return paths
@@ -1,12 +1,14 @@
 from dataclasses import dataclass
 import collections
-from multiprocessing import Pool, Lock
+from multiprocessing import Pool
+import os
+from typing import Optional
+
+import numpy as np
 
 import consts
 import sbiff
-
-
-lock = Lock()
+from instrument import NullProgress, Progress, StageLogger
 
 
 @dataclass
@@ -43,6 +45,14 @@ def _Validate(options: BpeOptions, ints: list[int]):
     assert produced == original, f"Produced={produced} Original={original}"
 
 
+def _MaxInt(options: BpeOptions) -> int:
+    return max(len(options.stoi), options.max_vocab_size) - 1
+
+
+def _Dtype(max_int: int):
+    return np.uint16 if max_int < 2**16 else np.uint32
+
+
 def _Merge(pair, new_int, ints):
     new_ints = []
     j = 0
@@ -56,7 +66,27 @@ def _Merge(pair, new_int, ints):
     return new_ints
 
 
-def _GenNewTokens(options: BpeOptions):
+def _MergeNp(pair, new_int, ints: np.ndarray) -> np.ndarray:
+    """_Merge for a numpy array (of any int dtype that fits `new_int`)."""
+    a, b = pair
+    starts = np.flatnonzero((ints[:-1] == a) & (ints[1:] == b))
+    if len(starts) == 0:
+        return ints
+    # Matches can only overlap when a == b, in which case they're consecutive
+    # positions in a run like 1,1,1,1. Going left to right we take every other
+    # one, counting from the start of each run of consecutive matches.
+    k = np.arange(len(starts))
+    run_start = np.maximum.accumulate(np.where(np.diff(starts, prepend=-2) != 1, k, 0))
+    starts = starts[(k - run_start) % 2 == 0]
+    keep = np.ones(len(ints), dtype=bool)
+    keep[starts + 1] = False
+    ints = ints.copy()
+    ints[starts] = new_int
+    return ints[keep]
+
+
+def _GenNewTokens(options: BpeOptions, progress: Optional[Progress] = None):
+    progress = progress or NullProgress()
     i = len(options.stoi)
     end_token = options.stoi[consts.DOC_END_TOKEN]
 
@@ -71,7 +101,11 @@ def _GenNewTokens(options: BpeOptions):
 
     merges = []
 
-    ints = sbiff.ReadUpToNInts(options.src, n=options.tokens_to_process)
+    arr = np.array(
+        sbiff.ReadUpToNInts(options.src, n=options.tokens_to_process),
+        dtype=_Dtype(_MaxInt(options)),
+    )
+    ints = arr.tolist()
     print("First 30 ints:", ints[:30])
 
     # Iterate over dataset finding the pair that occurs most frequently.
@@ -82,24 +116,25 @@ def _GenNewTokens(options: BpeOptions):
         most_common_count = -1
         prev = None
         prev_prev = None
-        for a, b in zip(ints, ints[1:]):
-            if a == end_token or b == end_token:
-                # Never pair with the end token.
-                continue
-
-            if (a, b) == prev and (a, b) != prev_prev:
-                # Don't count the same pair twice in a row unless it's also the
-                # pair before that (because 1,1,1,1 -> 2,2 is fine).
+        with progress.Timer("pair_counting"):
+            for a, b in zip(ints, ints[1:]):
+                if a == end_token or b == end_token:
+                    # Never pair with the end token.
+                    continue
+
+                if (a, b) == prev and (a, b) != prev_prev:
+                    # Don't count the same pair twice in a row unless it's also
+                    # the pair before that (because 1,1,1,1 -> 2,2 is fine).
+                    prev_prev = prev
+                    prev = (a, b)
+                    continue
+
+                pair_counts[(a, b)] += 1
+                if pair_counts[(a, b)] > most_common_count:
+                    most_common_pair = (a, b)
+                    most_common_count = pair_counts[(a, b)]
                 prev_prev = prev
                 prev = (a, b)
-                continue
-
-            pair_counts[(a, b)] += 1
-            if pair_counts[(a, b)] > most_common_count:
-                most_common_pair = (a, b)
-                most_common_count = pair_counts[(a, b)]
-            prev_prev = prev
-            prev = (a, b)
 
         # print("Most common pair:", most_common_pair, "count:", most_common_count)
         if most_common_count == 1:
@@ -112,8 +147,12 @@ def _GenNewTokens(options: BpeOptions):
         print("Creating token", "len(ints):", len(ints), most_common_pair, "->", i)
 
         # Replace all occurrences of the pair with the new token.
-        ints = _Merge(most_common_pair, i, ints)
+        with progress.Timer("merge"):
+            arr = _MergeNp(most_common_pair, i, arr)
+            # Counting pairs is faster over a list than over numpy scalars.
+            ints = arr.tolist()
         # print("After 30 ints:", ints[:30])
+        progress.Update(done=1, tokens=len(ints))
         i += 1
 
     # _Validate(options, ints)
@@ -121,21 +160,31 @@ def _GenNewTokens(options: BpeOptions):
     return merges
 
 
-def _WriteAlteredDoc(args):
-    ints, merges, options = args
-
+def Encode(ints, merges):
+    """Applies `merges` (from RunBpe or Tokens) to base ints, in order."""
     # TODO: This is brute force. Surely there's a better way.
+    max_int = merges[-1][1] if merges else max(ints, default=0)
+    arr = np.array(ints, dtype=_Dtype(max_int))
     for pair, new_int in merges:
-        ints = _Merge(pair, new_int, ints)
+        arr = _MergeNp(pair, new_int, arr)
+    return arr.tolist()
+
 
-    lock.acquire()
-    sbiff.AppendInts(options.dst, ints)
-    lock.release()
+def _WriteAlteredDoc(args):
+    ints, merges, _ = args
+    return len(ints), Encode(ints, merges)
 
 
 # Use the new vocab to rewrite the dataset with the new tokens.
-def _WriteNewDataset(merges, options: BpeOptions):
+def _WriteNewDataset(merges, options: BpeOptions, progress: Optional[Progress] = None):
+    progress = progress or NullProgress()
     end_token = options.stoi[consts.DOC_END_TOKEN]
+    if not os.path.exists(options.dst):
+        sbiff.Create(
+            options.dst,
+            width=sbiff.WidthFor(_MaxInt(options)),
+            byteorder=consts.SBIFF_BYTEORDER,
+        )
 
     def Gen():
         print("calling gen")
@@ -152,14 +201,21 @@ def _WriteNewDataset(merges, options: BpeOptions):
             offset = nxt + 1
 
     with Pool(processes=consts.PARALLELISM) as pool:
-        for _ in pool.imap(_WriteAlteredDoc, Gen()):
-            pass
+        # Write in the parent so docs stay in the same order as in src.
+        for num_ints, ints in pool.imap(_WriteAlteredDoc, Gen()):
+            sbiff.AppendInts(options.dst, ints, num_docs=1)
+            progress.Update(files=1, tokens=num_ints)
 
 
 # Given a stoi and path to an src sbiff file and a dst sbiff file, this function
 # runs BPE-like tokenization on the src file and writes the result to the dst
-# file. It returns the stoi with the new tokens added.
-def RunBpe(options: BpeOptions):
-    merges = _GenNewTokens(options)
-    _WriteNewDataset(merges, options)
+# file. It returns the stoi with the new tokens added. Both halves are reported
+# as stages to `stages` if it's given.
+def RunBpe(options: BpeOptions, stages: Optional[StageLogger] = None):
+    stages = stages or StageLogger()
+    total = max(options.max_vocab_size - len(options.stoi), 0)
+    with stages.Stage("bpe_gen_new_tokens", total=total) as progress:
+        merges = _GenNewTokens(options, progress)
+    with stages.Stage("bpe_write_new_dataset") as progress:
+        _WriteNewDataset(merges, options, progress)
     return merges
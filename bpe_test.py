@@ -11,8 +11,10 @@ import util
 import consts
 import random
 
+import numpy as np
+
 import sbiff
-from bpe import RunBpe, BpeOptions
+from bpe import RunBpe, BpeOptions, _Merge, _MergeNp
 
 
 @contextmanager
@@ -123,6 +125,39 @@ class TestBpe(unittest.TestCase):
             RunBpe(options)
             assert sbiff.ReadAllInts(post) == [4, 4, 4, 3, 0, 2, 4, 2, 3]
 
+    def test_bpe_writes_32_bit_past_16_bit_vocab(self):
+        with BpeTest() as (pre, post):
+            stoi = {str(i): i for i in range(2**16)}
+            stoi[consts.DOC_END_TOKEN] = 2**16
+            sbiff.Create(pre, width=4)
+            sbiff.AppendInts(pre, [0, 1, 0, 1, 0, 1, 2**16], num_docs=1)
+            options = BpeOptions(stoi=stoi, src=pre, dst=post)
+            options.max_vocab_size = len(stoi) + 1
+            merges = RunBpe(options)
+            assert merges == [((0, 1), 2**16 + 1)]
+            assert sbiff.ReadAllInts(post) == [2**16 + 1] * 3 + [2**16]
+            header = sbiff.ReadHeader(post)
+            assert (header.width, header.num_docs) == (4, 1)
+
+
+class TestMergeNp(unittest.TestCase):
+
+    def test_merges_runs(self):
+        ints = np.array([1, 1, 1, 1, 1, 0, 1, 1], dtype=np.uint16)
+        assert _MergeNp((1, 1), 2, ints).tolist() == [2, 2, 1, 0, 2]
+
+    def test_matches_list_merge(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            # Few distinct values so pairs and runs are common.
+            ints = [rng.randint(0, 3) for _ in range(rng.randint(0, 40))]
+            pair = (rng.randint(0, 3), rng.randint(0, 3))
+            arr = np.array(ints, dtype=np.uint16)
+            got = _MergeNp(pair, 9, arr)
+            assert got.dtype == np.uint16
+            assert got.tolist() == _Merge(pair, 9, ints), (ints, pair)
+            assert arr.tolist() == ints
+
 
 if __name__ == "__main__":
     unittest.main()
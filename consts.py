@@ -21,6 +21,17 @@ BATCH_SIZE = 8
 TRAINING_DATA_ROOT = "training_data_out"
 TRAINING_DATA_NUMS = f"{TRAINING_DATA_ROOT}/nums.bin"
 TRAINING_DATA_BPE_NUMS = f"{TRAINING_DATA_ROOT}/nums_bpe.bin"
+# One JSON line per document in nums.bin, in order: {"path": ..., "num_tokens": ...}
+TRAINING_DATA_DOCS = f"{TRAINING_DATA_ROOT}/docs.jsonl"
+# Files that `prep.py --incremental` skipped because of tokens not in the vocab.
+TRAINING_DATA_SKIPPED = f"{TRAINING_DATA_ROOT}/skipped.jsonl"
+# Files that prep dropped as (near) duplicates of a doc in nums.bin:
+# {"path": ..., "duplicate_of": ..., "exact": ..., "num_tokens": ...}
+TRAINING_DATA_DUPLICATES = f"{TRAINING_DATA_ROOT}/duplicates.jsonl"
+# How often each base token occurs in the corpus, before any pruning.
+TRAINING_DATA_TOKEN_COUNTS = f"{TRAINING_DATA_ROOT}/token_counts.json"
+# The sizes of the files above as of the last completed prep.
+TRAINING_DATA_STATE = f"{TRAINING_DATA_ROOT}/prep_state.json"
 MODEL_DATA_ROOT = "model_data_out"
 MISC_FILES_ROOT = "local"
 TRAINING_FILES_LIST = f"{MISC_FILES_ROOT}/single_staff_files.log"
@@ -28,12 +39,24 @@ TRAINING_FILES_LIST = f"{MISC_FILES_ROOT}/single_staff_files.log"
 # The number of tokens we want it have. This would normally be 500-1000 but we
 # can pair tokens ala byte-pair to create more tokens.
 MAX_NUM_DESIRED_TOKENS = 20000
-# We store the sequence of tokens as a packed list of 16-bit integers currently.
-# This means that we can have at most 2**16 tokens.
-assert MAX_NUM_DESIRED_TOKENS < 2**16, "MAX_NUM_DESIRED_TOKENS must be less than 2**16"
+# We store the sequence of tokens as a packed list of 16-bit integers, or 32-bit
+# ones when the vocab doesn't fit in 16 bits (see sbiff.py).
+assert MAX_NUM_DESIRED_TOKENS < 2**32, "MAX_NUM_DESIRED_TOKENS must be less than 2**32"
+# The byte order of the token files prep writes: "<" (little-endian, native on
+# x86 so reading them needs no byte swaps) or ">" (the original format).
+SBIFF_BYTEORDER = "<"
 
 ANY_XML_FILE = (".xml", ".musicxml", ".xml.gz", ".musicxml.gz")
 
+# The XML parser backend: "lxml", "etree" (the standard library) or "auto" to
+# use lxml when it's installed. Both produce the same tokens.
+XML_PARSER = "auto"
+
+# Whether lxml may parse files past libxml2's size and nesting depth limits.
+# These limits guard against malicious input, so only lift them for trusted
+# files that need it.
+XML_HUGE_TREE = False
+
 # Some parts of data prep are parallelized. This is the number of parallel
 # processes to use. This can scale linearly with the number of cores you have.
 # PARALLELISM = 12
@@ -41,6 +64,9 @@ PARALLELISM = 12
 
 # A special token to separate documents.
 DOC_END_TOKEN = "<|doc_end|>"
+# Stands in for tokens that are too rare to be in the vocab (see prep.py
+# --min_token_count). Only in the vocab if some tokens were pruned.
+UNK_TOKEN = "<|unk|>"
 
 # https://www.w3.org/2021/06/musicxml40/musicxml-reference/elements/
 # https://www.w3.org/2021/06/musicxml40/container-reference/elements/
@@ -0,0 +1,89 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# Rewrites existing SBIFF files (by default the prepared training data) with a
+# header and the given byte order, in place. Legacy headerless files become
+# headered ones, and big-endian ones little-endian so the data loader can map
+# them without byte swapping. With --block_ints they're block-compressed
+# instead, which training reads a block at a time (see sbiff.BlockReader).
+#
+#   python convert_sbiff.py --byteorder=little
+#   python convert_sbiff.py --block_ints=16384
+
+import json
+import os
+
+from absl import app, flags
+
+import consts
+import sbiff
+
+flags.DEFINE_list(
+    "paths",
+    [consts.TRAINING_DATA_NUMS, consts.TRAINING_DATA_BPE_NUMS],
+    "The SBIFF files to convert.",
+)
+
+flags.DEFINE_enum(
+    "byteorder",
+    "little",
+    ["little", "big"],
+    "The byte order to store the ints in.",
+)
+
+flags.DEFINE_integer(
+    "width",
+    0,
+    "The int width in bytes (2 or 4). 0 keeps the width of each file.",
+)
+
+flags.DEFINE_integer(
+    "block_ints",
+    0,
+    "Block-compress the files with this many ints per block. 0 writes them "
+    "uncompressed (which also decompresses compressed files).",
+)
+
+flags.DEFINE_string(
+    "tokens",
+    f"{consts.TRAINING_DATA_ROOT}/tokens.json",
+    "The tokens.json whose doc end token is used to count the docs in legacy "
+    "files, which don't record it.",
+)
+
+
+def Main(argv):
+    FLAGS = flags.FLAGS
+    byteorder = {"little": "<", "big": ">"}[FLAGS.byteorder]
+
+    doc_end_int = None
+    if os.path.exists(FLAGS.tokens):
+        with open(FLAGS.tokens, "r") as f:
+            doc_end_int = json.load(f)["stoi"][consts.DOC_END_TOKEN]
+
+    for path in FLAGS.paths:
+        before = sbiff.ReadHeader(path)
+        size = os.path.getsize(path)
+        sbiff.Convert(
+            path,
+            path,
+            width=FLAGS.width or None,
+            byteorder=byteorder,
+            doc_end_int=doc_end_int,
+            block_ints=FLAGS.block_ints,
+        )
+        after = sbiff.ReadHeader(path)
+        print(
+            f"{path}: {before.width * 8}-bit {before.byteorder} "
+            f"({'v' + str(before.version) if before.version else 'legacy'}) -> "
+            f"{after.width * 8}-bit {after.byteorder}, {after.num_ints} ints, "
+            f"{after.num_docs} docs, {size} -> {os.path.getsize(path)} bytes"
+            + (f" in blocks of {after.block_ints}" if after.block_ints else "")
+        )
+
+
+if __name__ == "__main__":
+    app.run(Main)
@@ -0,0 +1,25 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# The CPU inference flags shared by model_infer.py and model_server.py. Import
+# this module to define them (once) and read them from flags.FLAGS.
+
+from absl import flags
+
+from model_def import CPU_INFERENCE_MODES
+
+flags.DEFINE_enum(
+    "cpu_mode",
+    None,
+    CPU_INFERENCE_MODES,
+    "Run inference on CPU in this mode. If None, run fp32 on the default device.",
+)
+
+flags.DEFINE_integer(
+    "num_threads",
+    None,
+    "The number of intra-op threads for CPU inference. If None, torch decides.",
+)
@@ -0,0 +1,109 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# Finds duplicate docs by their base token ints: exact duplicates by a hash of
+# the whole sequence and near duplicates (e.g. the same piece exported twice)
+# by MinHash over shingles of consecutive tokens, bucketed with LSH.
+#
+# GetFingerprint() is the expensive part and runs in the prep workers next to the
+# tokenization. Deduper only compares fingerprints, in the parent process.
+
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# The number of consecutive tokens in a shingle.
+SHINGLE_SIZE = 8
+# MinHash signatures have NUM_BANDS * ROWS_PER_BAND values. Docs become
+# candidates when all the rows of a band agree, which is likely from a Jaccard
+# similarity of about (1 / NUM_BANDS) ** (1 / ROWS_PER_BAND) = 0.5 up.
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+# Candidates are duplicates if this share of their signatures agrees, which
+# estimates the Jaccard similarity of their shingles. Changing 1% of a doc's
+# tokens changes up to 8% of its shingles, for a similarity of about 0.85.
+THRESHOLD = 0.8
+
+_NUM_PERM = NUM_BANDS * ROWS_PER_BAND
+# Odd multipliers and offsets of the hash functions, fixed so fingerprints from
+# different processes (and runs) can be compared.
+_rng = np.random.default_rng(0x5EED)
+_MULTIPLIERS = _rng.integers(1, 2**63, _NUM_PERM, dtype=np.uint64) * 2 + 1
+_OFFSETS = _rng.integers(0, 2**63, _NUM_PERM, dtype=np.uint64)
+del _rng
+# The base of the polynomial hash of a shingle.
+_SHINGLE_BASE = np.uint64(0x100000001B3)
+
+
+@dataclass
+class Fingerprint:
+    exact: bytes
+    signature: np.ndarray
+
+
+def _Shingles(ints: np.ndarray) -> np.ndarray:
+    """The distinct 64-bit hashes of every SHINGLE_SIZE consecutive ints (or of
+    the whole doc if it's shorter)."""
+    k = min(SHINGLE_SIZE, len(ints))
+    n = len(ints) - k + 1
+    h = np.zeros(n, dtype=np.uint64)
+    # Overflow is the modulus.
+    with np.errstate(over="ignore"):
+        for j in range(k):
+            h = h * _SHINGLE_BASE + ints[j : j + n]
+    return np.unique(h)
+
+
+def GetFingerprint(ints: List[int]) -> Fingerprint:
+    arr = np.asarray(ints, dtype=np.uint64)
+    exact = hashlib.blake2b(arr.tobytes(), digest_size=16).digest()
+    if not len(arr):
+        return Fingerprint(exact, np.zeros(_NUM_PERM, dtype=np.uint64))
+    shingles = _Shingles(arr)
+    signature = np.empty(_NUM_PERM, dtype=np.uint64)
+    # One hash function at a time keeps the scratch space to one shingle array.
+    with np.errstate(over="ignore"):
+        for i in range(_NUM_PERM):
+            signature[i] = (shingles * _MULTIPLIERS[i] + _OFFSETS[i]).min()
+    return Fingerprint(exact, signature)
+
+
+class Deduper:
+    """Keeps the fingerprints of the docs kept so far. Add() says whether a doc
+    duplicates one of them, and if not, keeps it too."""
+
+    def __init__(self, threshold: float = THRESHOLD):
+        self.threshold = threshold
+        self._exact: Dict[bytes, int] = {}
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._signatures: List[np.ndarray] = []
+
+    def Add(self, fingerprint: Fingerprint) -> Tuple[Optional[int], bool]:
+        """Returns (the index of the kept doc it duplicates, whether it's an
+        exact duplicate), or (None, False) after keeping it as doc
+        len(kept docs). Indices count kept docs only."""
+        dup = self._exact.get(fingerprint.exact)
+        if dup is not None:
+            return dup, True
+
+        sig = fingerprint.signature
+        bands = [
+            (b, sig[b * ROWS_PER_BAND : (b + 1) * ROWS_PER_BAND].tobytes())
+            for b in range(NUM_BANDS)
+        ]
+        candidates = {i for band in bands for i in self._buckets.get(band, ())}
+        for i in sorted(candidates):
+            if np.mean(self._signatures[i] == sig) >= self.threshold:
+                return i, False
+
+        index = len(self._signatures)
+        self._exact[fingerprint.exact] = index
+        self._signatures.append(sig)
+        for band in bands:
+            self._buckets.setdefault(band, []).append(index)
+        return None, False
@@ -0,0 +1,48 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import random
+import unittest
+
+import dedup
+
+
+def _RandomDoc(rng, n):
+    return [rng.randrange(500) for _ in range(n)]
+
+
+class TestDedup(unittest.TestCase):
+
+    def test_finds_exact_and_near_duplicates(self):
+        rng = random.Random(0)
+        docs = [_RandomDoc(rng, 2000) for _ in range(20)]
+        near = list(docs[3])
+        for i in range(0, len(near), 200):
+            near[i] = 0
+        deduper = dedup.Deduper()
+        for doc in docs:
+            assert deduper.Add(dedup.GetFingerprint(doc)) == (None, False)
+        assert deduper.Add(dedup.GetFingerprint(list(docs[7]))) == (7, True)
+        assert deduper.Add(dedup.GetFingerprint(near)) == (3, False)
+        # Not a duplicate of a kept doc, so it's kept.
+        assert deduper.Add(dedup.GetFingerprint(docs[3][:1000])) == (None, False)
+
+    def test_short_docs(self):
+        deduper = dedup.Deduper()
+        for doc in [[], [1], [1, 2, 3], [3, 2, 1]]:
+            assert deduper.Add(dedup.GetFingerprint(doc)) == (None, False)
+        assert deduper.Add(dedup.GetFingerprint([1, 2, 3])) == (2, True)
+
+    def test_fingerprints_are_stable(self):
+        # Workers and runs must agree, so the hash functions can't be random.
+        doc = _RandomDoc(random.Random(1), 100)
+        a, b = dedup.GetFingerprint(doc), dedup.GetFingerprint(doc)
+        assert a.exact == b.exact and (a.signature == b.signature).all()
+        assert len(a.signature) == dedup.NUM_BANDS * dedup.ROWS_PER_BAND
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# An on-disk cache of the element stream of each XML file (see
+# util.GetElementsFromXmlRoot) so repeated prep runs don't re-read, decompress
+# and re-parse every file. Entries are keyed by the hash of the file's raw bytes
+# and of the element filters in consts, so files that change or a change to
+# ALLOWED_TAG_NAMES/TAG_NAMES_TO_IGNORE miss the cache. So does a change of the
+# parser backend (and its limits), which can differ on malformed or non-UTF-8
+# files. Attribute filtering and number translation happen after the cache, so
+# tuning ATTRIBUTES_TO_IGNORE or WHITELISTED_NUMS reuses it.
+
+import hashlib
+import json
+import os
+from typing import List, Optional
+
+import consts
+import util
+
+# Bump this when the element stream format changes.
+_FORMAT_VERSION = 1
+
+
+def _FilterHash() -> str:
+    h = hashlib.sha256(str(_FORMAT_VERSION).encode())
+    for names in [consts.ALLOWED_TAG_NAMES, consts.TAG_NAMES_TO_IGNORE]:
+        h.update(json.dumps(sorted(names)).encode())
+    backend = util.XmlParserBackend()
+    if backend == "lxml":
+        backend += f" huge_tree={consts.XML_HUGE_TREE}"
+    h.update(backend.encode())
+    return h.hexdigest()[:16]
+
+
+class ElementCache:
+    """A directory of JSON element streams with LRU eviction down to max_bytes.
+
+    Lookups and writes are safe from many processes. Eviction walks the whole
+    directory, so call Evict once after a batch of work, not per file.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 10 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._filter_hash = _FilterHash()
+
+    def Key(self, path: str) -> str:
+        h = hashlib.sha256(self._filter_hash.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _Path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    def Get(self, key: str) -> Optional[List]:
+        path = self._Path(key)
+        try:
+            with open(path, "r") as f:
+                elements = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark it as recently used for eviction.
+        os.utime(path)
+        return elements
+
+    def Put(self, key: str, elements: List):
+        path = self._Path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(elements, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def Evict(self) -> int:
+        """Deletes the least recently used entries until the cache fits in
+        max_bytes. Returns the number of entries deleted."""
+        entries = []
+        for dir_path, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        num_deleted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            num_deleted += 1
+        return num_deleted
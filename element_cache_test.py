@@ -0,0 +1,95 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import random
+import time
+import unittest
+from unittest import mock
+
+import consts
+import util
+from benchmarks import synthetic
+from element_cache import ElementCache
+
+
+def _WriteScore(dir_path, seed):
+    path = os.path.join(dir_path, f"{seed}.xml")
+    with open(path, "w") as f:
+        f.write(synthetic.GenerateScore(random.Random(seed), 8))
+    return path
+
+
+class TestElementCache(unittest.TestCase):
+
+    def test_reuses_elements_across_token_settings(self):
+        with util.GetTempDir() as dir_path:
+            path = _WriteScore(dir_path, 0)
+            cache = ElementCache(os.path.join(dir_path, "cache"))
+            assert util.GetTokensFromXml(path, cache) == util.GetTokensFromXml(path)
+
+            # Hits don't parse the file, even with different attribute and
+            # number settings.
+            with mock.patch.object(util, "ParseXml", side_effect=AssertionError):
+                with mock.patch.object(consts, "ATTRIBUTES_TO_IGNORE", set()):
+                    with mock.patch.object(consts, "WHITELISTED_NUMS", set()):
+                        tokens = util.GetTokensFromXml(path, cache)
+            with mock.patch.object(consts, "ATTRIBUTES_TO_IGNORE", set()):
+                with mock.patch.object(consts, "WHITELISTED_NUMS", set()):
+                    assert tokens == util.GetTokensFromXml(path)
+            assert tokens != util.GetTokensFromXml(path)
+
+    def test_misses_on_changes(self):
+        with util.GetTempDir() as dir_path:
+            path = _WriteScore(dir_path, 0)
+            root = os.path.join(dir_path, "cache")
+            key = ElementCache(root).Key(path)
+            with open(path, "a") as f:
+                f.write(" ")
+            new_key = ElementCache(root).Key(path)
+            assert new_key != key
+            ignored = consts.TAG_NAMES_TO_IGNORE | {"beam"}
+            with mock.patch.object(consts, "TAG_NAMES_TO_IGNORE", ignored):
+                assert ElementCache(root).Key(path) != new_key
+
+    def test_misses_on_another_parser_backend(self):
+        with util.GetTempDir() as dir_path:
+            path = _WriteScore(dir_path, 0)
+            root = os.path.join(dir_path, "cache")
+            keys = set()
+            for backend in ["etree", "lxml"]:
+                with mock.patch.object(consts, "XML_PARSER", backend):
+                    keys.add(ElementCache(root).Key(path))
+            with mock.patch.object(consts, "XML_PARSER", "lxml"):
+                with mock.patch.object(consts, "XML_HUGE_TREE", True):
+                    keys.add(ElementCache(root).Key(path))
+            assert len(keys) == 3
+
+    def test_evicts_least_recently_used(self):
+        with util.GetTempDir() as dir_path:
+            cache = ElementCache(os.path.join(dir_path, "cache"))
+            paths = [_WriteScore(dir_path, seed) for seed in range(4)]
+            keys = [cache.Key(p) for p in paths]
+            for i, (path, key) in enumerate(zip(paths, keys)):
+                cache.Put(key, util.GetElementsFromXml(path))
+                # Make the access order unambiguous.
+                t = time.time() - 100 + i
+                os.utime(cache._Path(key), (t, t))
+            cache.Get(keys[0])
+
+            sizes = [os.path.getsize(cache._Path(k)) for k in keys]
+            cache.max_bytes = sizes[0] + sizes[3]
+            assert cache.Evict() == 2
+            assert [cache.Get(k) is not None for k in keys] == [
+                True,
+                False,
+                False,
+                True,
+            ]
+
+
+if __name__ == "__main__":
+    unittest.main()
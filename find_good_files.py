@@ -40,10 +40,36 @@ def has_one_staff(xml: ET.Element):
     return xml.find("./part/measure/note/staff") is None
 
 
+def part_list_size_lxml(etree, data: bytes, chunk_size=4096):
+    """Returns the number of children of the top-level part-list, or None if
+    there isn't one. The part-list is near the top of the file, so this feeds
+    lxml's pull parser only as much of the file as it takes to find it."""
+    parser = etree.XMLPullParser(
+        events=("end",), tag="part-list", **util.LxmlParserOptions()
+    )
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i : i + chunk_size])
+        for _, elem in parser.read_events():
+            parent = elem.getparent()
+            if parent is not None and parent.getparent() is None:
+                return len(elem)
+    return None
+
+
+def is_single_staff(path: str):
+    etree = util.GetLxml()
+    if etree is not None:
+        # Most files have more than one part. Rule those out without parsing
+        # the whole file.
+        if part_list_size_lxml(etree, util.ReadFileAsBytes(path)) != 1:
+            return False
+    xml = util.ParseXml(path)
+    return has_one_part(xml) and has_one_staff(xml)
+
+
 def write_if_one_staff(path: str):
     try:
-        xml = util.ParseXml(path)
-        if has_one_part(xml) and has_one_staff(xml):
+        if is_single_staff(path):
             _WRITE_LOCK.acquire()
             with open(consts.TRAINING_FILES_LIST, "a") as f:
                 f.write(path + "\n")
@@ -0,0 +1,60 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import unittest
+from unittest import mock
+
+import consts
+import util
+from find_good_files import is_single_staff
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+
+def _Score(part_list: str, note: str) -> str:
+    return (
+        f"<score-partwise><part-list>{part_list}</part-list><part><measure>"
+        f"<note>{note}</note></measure></part></score-partwise>"
+    )
+
+
+_ONE_PART = '<score-part id="P1"/>'
+_SCORES = {
+    "single.xml": (_Score(_ONE_PART, "<step>C</step>"), True),
+    "two_parts.xml": (_Score(_ONE_PART + '<score-part id="P2"/>', ""), False),
+    "group.xml": (_Score('<part-group type="start"/>' + _ONE_PART, ""), False),
+    "two_staves.xml": (_Score(_ONE_PART, "<staff>1</staff>"), False),
+    "nested_staff.xml": (_Score(_ONE_PART, "<x><staff>1</staff></x>"), True),
+    "no_part_list.xml": ("<score-partwise><part/></score-partwise>", False),
+    "malformed.xml": ("<score-partwise><part-list>", False),
+}
+
+
+class TestFindGoodFiles(unittest.TestCase):
+
+    def test_single_staff(self):
+        backends = ["etree"] + (["lxml"] if lxml is not None else [])
+        with util.GetTempDir() as dir_path:
+            for name, (xml, expected) in _SCORES.items():
+                path = os.path.join(dir_path, name)
+                with open(path, "w") as f:
+                    f.write(xml)
+                for backend in backends:
+                    with mock.patch.object(consts, "XML_PARSER", backend):
+                        try:
+                            res = is_single_staff(path)
+                        except Exception:
+                            # write_if_one_staff skips files that raise.
+                            res = False
+                        assert res == expected, (name, backend)
+
+
+if __name__ == "__main__":
+    unittest.main()
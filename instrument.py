@@ -0,0 +1,211 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# Structured timing and progress reporting for long-running jobs like prep.py.
+# Each stage emits JSON lines:
+#   {"event": "stage_start", "stage": ...}
+#   {"event": "progress", "stage": ..., "files": ..., "tokens": ...,
+#    "files_per_sec": ..., "tokens_per_sec": ..., "eta_sec": ..., ...}
+#   {"event": "stage_end", "stage": ..., "elapsed_sec": ..., "peak_rss_mb": ..., ...}
+
+from contextlib import contextmanager
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Optional, TextIO
+
+
+def _CurrentRssMb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def _MaxRssMb(who) -> float:
+    # ru_maxrss is in KB on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class _RssSampler:
+    """Tracks the peak RSS of this process while a stage runs.
+
+    ru_maxrss can't be reset, so on its own it only gives the peak since the
+    process started. Where /proc is available, sample the current RSS instead.
+    """
+
+    def __init__(self, interval_sec=0.2):
+        self.peak_mb = _CurrentRssMb()
+        self._interval_sec = interval_sec
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak_mb is not None:
+            self._thread = threading.Thread(target=self._Run, daemon=True)
+            self._thread.start()
+
+    def _Run(self):
+        while not self._stop.wait(self._interval_sec):
+            self.peak_mb = max(self.peak_mb, _CurrentRssMb() or 0)
+
+    def Stop(self) -> float:
+        if self._thread is None:
+            return _MaxRssMb(resource.RUSAGE_SELF)
+        self._stop.set()
+        self._thread.join()
+        return max(self.peak_mb, _CurrentRssMb() or 0)
+
+
+class Progress:
+    """Counters for a single stage. Rates and ETA are derived from them."""
+
+    def __init__(self, logger: "StageLogger", stage: str, total: Optional[int]):
+        self._logger = logger
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.files = 0
+        self.tokens = 0
+        self.subtimings = {}
+        self.start = time.time()
+        self._last_emit = self.start
+
+    def Update(self, done=0, files=0, tokens=0):
+        """Adds to the counters. `done` counts units of `total` (e.g. merges)."""
+        self.done += done
+        self.files += files
+        self.tokens += tokens
+        now = time.time()
+        if now - self._last_emit >= self._logger.interval_sec:
+            self._last_emit = now
+            self._logger.Emit("progress", **self.Snapshot())
+
+    @contextmanager
+    def Timer(self, name: str):
+        """Accumulates the time spent in a named part of the stage."""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.subtimings[name] = self.subtimings.get(name, 0.0) + time.time() - t0
+
+    def Snapshot(self) -> dict:
+        elapsed = max(time.time() - self.start, 1e-9)
+        res = {"stage": self.stage, "elapsed_sec": round(elapsed, 3)}
+        if self.files:
+            res["files"] = self.files
+            res["files_per_sec"] = round(self.files / elapsed, 2)
+        if self.tokens:
+            res["tokens"] = self.tokens
+            res["tokens_per_sec"] = round(self.tokens / elapsed, 2)
+        if self.total:
+            res["done"] = self.done
+            res["total"] = self.total
+            if self.done:
+                res["eta_sec"] = round(
+                    elapsed / self.done * (self.total - self.done), 1
+                )
+        if self.subtimings:
+            res["subtimings_sec"] = {k: round(v, 3) for k, v in self.subtimings.items()}
+        rss = _CurrentRssMb()
+        if rss is not None:
+            res["rss_mb"] = round(rss, 1)
+        return res
+
+
+class StageLogger:
+    """Times named stages and writes their progress as JSON lines to `out`.
+
+    With `out=None` nothing is written, so library code can always accept a
+    StageLogger. `profile_stage` runs that one stage under a profiler (cProfile,
+    or pyinstrument if asked for and installed) and writes the result to
+    `profile_out`. Profilers only see this process, not pool workers.
+    """
+
+    def __init__(
+        self,
+        out: Optional[TextIO] = None,
+        interval_sec: float = 10.0,
+        profile_stage: Optional[str] = None,
+        profile_out: Optional[str] = None,
+        profiler: str = "cprofile",
+    ):
+        self.out = out
+        self.interval_sec = interval_sec
+        self.profile_stage = profile_stage
+        self.profile_out = profile_out
+        self.profiler = profiler
+
+    def Emit(self, event: str, **fields):
+        if self.out is None:
+            return
+        self.out.write(json.dumps({"event": event, "time": time.time(), **fields}))
+        self.out.write("\n")
+        self.out.flush()
+
+    @contextmanager
+    def _Profile(self, name: str):
+        if name != self.profile_stage:
+            yield
+            return
+        out = self.profile_out or f"{name}.prof"
+        if self.profiler == "pyinstrument":
+            try:
+                import pyinstrument
+            except ImportError:
+                logging.warning("pyinstrument is not installed, using cProfile.")
+            else:
+                profiler = pyinstrument.Profiler()
+                profiler.start()
+                try:
+                    yield
+                finally:
+                    profiler.stop()
+                    with open(out, "w") as f:
+                        f.write(profiler.output_html())
+                return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(out)
+
+    @contextmanager
+    def Stage(self, name: str, total: Optional[int] = None):
+        """Runs the body as stage `name`, yielding its Progress."""
+        progress = Progress(self, name, total)
+        # No need to sample RSS if nothing is reported.
+        rss = _RssSampler() if self.out is not None else None
+        self.Emit("stage_start", stage=name, total=total)
+        try:
+            with self._Profile(name):
+                yield progress
+        finally:
+            if rss is not None:
+                self.Emit(
+                    "stage_end",
+                    **progress.Snapshot(),
+                    peak_rss_mb=round(rss.Stop(), 1),
+                    # The largest pool worker that has exited so far.
+                    children_peak_rss_mb=round(_MaxRssMb(resource.RUSAGE_CHILDREN), 1),
+                )
+
+
+def StderrStageLogger(**kwargs) -> StageLogger:
+    return StageLogger(sys.stderr, **kwargs)
+
+
+def NullProgress(stage: str = "") -> Progress:
+    """A Progress that reports nothing, for code run outside of a stage."""
+    return Progress(StageLogger(), stage, None)
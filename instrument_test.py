@@ -0,0 +1,67 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import io
+import json
+import os
+import pstats
+import unittest
+
+import util
+from instrument import StageLogger
+
+
+def _Events(out: io.StringIO):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+class TestStageLogger(unittest.TestCase):
+
+    def test_emits_stage_lines(self):
+        out = io.StringIO()
+        stages = StageLogger(out, interval_sec=0)
+        with stages.Stage("parse", total=4) as progress:
+            for _ in range(2):
+                with progress.Timer("inner"):
+                    progress.Update(done=1, files=1, tokens=10)
+
+        events = _Events(out)
+        assert [e["event"] for e in events] == [
+            "stage_start",
+            "progress",
+            "progress",
+            "stage_end",
+        ]
+        assert all(e["stage"] == "parse" for e in events)
+        end = events[-1]
+        assert end["files"] == 2
+        assert end["tokens"] == 20
+        assert end["done"] == 2 and end["total"] == 4
+        assert end["eta_sec"] >= 0
+        assert end["tokens_per_sec"] > 0
+        assert end["peak_rss_mb"] > 0
+        assert "inner" in end["subtimings_sec"]
+
+    def test_silent_without_out(self):
+        stages = StageLogger()
+        with stages.Stage("parse") as progress:
+            progress.Update(files=1)
+        assert progress.files == 1
+
+    def test_profiles_named_stage(self):
+        with util.GetTempDir() as dir_path:
+            path = os.path.join(dir_path, "parse.prof")
+            stages = StageLogger(profile_stage="parse", profile_out=path)
+            with stages.Stage("other"):
+                pass
+            assert not os.path.exists(path)
+            with stages.Stage("parse"):
+                sorted(range(1000))
+            assert pstats.Stats(path).total_calls > 0
+
+
+if __name__ == "__main__":
+    unittest.main()
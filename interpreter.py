@@ -5,6 +5,7 @@
 # https://opensource.org/licenses/MIT.
 
 import sys
+from typing import Callable, Optional
 
 from tokens import Tokens
 import consts
@@ -44,8 +45,11 @@ class Interpreter:
         start_token: int,
         tokens: Tokens,
         live_file_out: str = f"{consts.MISC_FILES_ROOT}/live.xml",
+        out: Optional[Callable[[str], None]] = None,
     ):
         self.live_file_out = live_file_out
+        # Where the interpreted XML is written as it is produced. Defaults to stdout.
+        self.out = out if out is not None else sys.stdout.write
         self.tokens = tokens
         self.start_token = start_token
         self.started = False
@@ -66,7 +70,7 @@ class Interpreter:
         self.file_prev = _gen_top()
 
     def _std_out(self, s: str):
-        sys.stdout.write(s)
+        self.out(s)
         self.file_prev += s
 
         if self.live_file_out:
@@ -117,6 +121,9 @@ class Interpreter:
         tokens = self.tokens.Translate(super_token)
         for token in tokens:
             token_str = self.tokens.GetStr(token)
+            if token_str == consts.UNK_TOKEN:
+                # Some pruned token, which we can't write out.
+                continue
             if self.tokens.TokenIsTag(token):
                 indent = self.scaled_indents[token_str]
 
@@ -5,9 +5,9 @@
 # https://opensource.org/licenses/MIT.
 
 from enum import Enum
-import struct
-import torch
-from enum import Enum
+import json
+from typing import Dict, Optional, Tuple
+import numpy as np
 import torch
 import sbiff
 
@@ -19,28 +19,149 @@ class Split(Enum):
     Val = "Val"
 
 
+class Sampling(Enum):
+    """How get_batch picks the windows of a batch.
+
+    Window: uniformly over every position, so docs are picked in proportion to
+    their length (the original behavior, which needs no doc index).
+    Uniform: every doc as likely as any other.
+    Sqrt: docs in proportion to the square root of their length.
+    Curriculum: uniformly over the shortest docs, where set_curriculum_stage()
+    says what fraction of them (by length) are in play.
+
+    Apart from Window, a doc is picked first and then a window inside it. Docs
+    shorter than a window are always read from their start, so the model sees
+    them whole (followed by the next doc, like any window that crosses a doc end).
+    """
+
+    Window = "Window"
+    Uniform = "Uniform"
+    Sqrt = "Sqrt"
+    Curriculum = "Curriculum"
+
+
+def _DocEndInt() -> int:
+    with open(f"{consts.TRAINING_DATA_ROOT}/tokens.json", "r") as f:
+        return json.load(f)["stoi"][consts.DOC_END_TOKEN]
+
+
 class ModelDataProvider:
     """Provides batches of data for training and validation."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        sampling: Sampling = Sampling.Window,
+        doc_end_int: Optional[int] = None,
+        curriculum_stage: float = 0.25,
+    ):
         self._device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.all_ints = sbiff.ReadAllInts(consts.TRAINING_DATA_BPE_NUMS)
+        path = path or consts.TRAINING_DATA_BPE_NUMS
+        if sbiff.ReadHeader(path).block_ints:
+            self.all_ints = sbiff.BlockReader(path)
+        else:
+            # A read-only memmap of the file, so the data is paged in as it's
+            # used rather than loaded into a list of Python ints.
+            self.all_ints = sbiff.ReadArray(path)
         split = int(0.9 * len(self.all_ints))
         split = split - (split & 1)  # Make sure it splits on an even number.
-        self._train_ints = self.all_ints[:split]
-        self._val_ints = self.all_ints[split:]
+        self._ranges = {
+            Split.Train: (0, split),
+            Split.Val: (split, len(self.all_ints)),
+        }
+
+        self._sampling = sampling
+        self._docs = {}
+        if sampling != Sampling.Window:
+            if doc_end_int is None:
+                doc_end_int = _DocEndInt()
+            self._docs = self._IndexDocs(doc_end_int)
+            self.set_curriculum_stage(curriculum_stage)
+
+    def _IndexDocs(self, doc_end_int: int) -> Dict[Split, Tuple[np.ndarray, ...]]:
+        """Returns the (starts, lengths) of the docs in each split. Docs are cut
+        at the split, and anything after the last doc end counts as a doc."""
+        if isinstance(self.all_ints, sbiff.BlockReader):
+            chunk_size, ends = 2**24, []
+            for i in range(0, len(self.all_ints), chunk_size):
+                chunk = self.all_ints.Read(i, chunk_size)
+                ends.append(np.flatnonzero(chunk == doc_end_int) + i)
+            ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+        else:
+            ends = np.flatnonzero(self.all_ints == doc_end_int)
+        docs = {}
+        for split, (start, end) in self._ranges.items():
+            starts = ends[(ends >= start) & (ends < end - 1)] + 1
+            starts = np.concatenate([[start], starts]).astype(np.int64)
+            lengths = np.diff(starts, append=end)
+            docs[split] = (starts, lengths)
+        return docs
 
-    def get_batch(self, split: Split, block_size: int, batch_size: int):
-        data = self._train_ints if split == Split.Train else self._val_ints
-        ix = torch.randint(low=1, high=len(data) - block_size, size=(batch_size,))
-        x = torch.stack([torch.tensor(data[i : i + block_size]) for i in ix])
-        y = torch.stack([torch.tensor(data[i + 1 : i + block_size + 1]) for i in ix])
+    def set_curriculum_stage(self, stage: float):
+        """Recomputes the doc weights, with the given share of the shortest docs
+        for Sampling.Curriculum (and the stage ignored otherwise)."""
+        assert 0 < stage <= 1, stage
+        self._cum_weights = {}
+        for split, (_, lengths) in self._docs.items():
+            if self._sampling == Sampling.Uniform:
+                weights = np.ones(len(lengths))
+            elif self._sampling == Sampling.Sqrt:
+                weights = np.sqrt(lengths)
+            else:
+                # At least one doc is always in play.
+                num = max(1, int(stage * len(lengths)))
+                weights = np.zeros(len(lengths))
+                weights[np.argsort(lengths, kind="stable")[:num]] = 1
+            self._cum_weights[split] = torch.from_numpy(np.cumsum(weights))
+
+    def _SampleOffsets(
+        self, split: Split, block_size: int, batch_size: int, sampling: Sampling
+    ):
+        """Returns the first position of each window, per `sampling`."""
+        start, end = self._ranges[split]
+        if sampling == Sampling.Window:
+            ix = torch.randint(low=1, high=end - start - block_size, size=(batch_size,))
+            return ix.numpy() + start
+
+        # One draw picks the doc (by inverse CDF of the weights) and one picks
+        # the window inside it.
+        cum_weights = self._cum_weights[split]
+        u = torch.rand((2, batch_size), dtype=torch.float64)
+        docs = torch.searchsorted(cum_weights, u[0] * cum_weights[-1], right=True)
+        docs = docs.clamp_(max=len(cum_weights) - 1).numpy()
+        starts, lengths = self._docs[split]
+        spans = np.maximum(lengths[docs] - block_size, 1)
+        offsets = starts[docs] + (u[1].numpy() * spans).astype(np.int64)
+        # A window at the very end of the split would run past it.
+        return np.minimum(offsets, end - block_size - 1)
+
+    def get_batch(
+        self,
+        split: Split,
+        block_size: int,
+        batch_size: int,
+        sampling: Optional[Sampling] = None,
+    ):
+        """Returns a batch of (x, y) windows. `sampling` overrides the provider's
+        own for this batch, e.g. Sampling.Window for evaluating on the data as it
+        is rather than as it's weighted for training. Other overrides need the
+        provider to have been created with doc sampling."""
+        if sampling is None:
+            sampling = self._sampling
+        assert sampling == Sampling.Window or self._docs, sampling
+        offsets = self._SampleOffsets(split, block_size, batch_size, sampling)
+        # Gather x and y (y is x shifted by one) in one go, then convert to
+        # int64 once. That's also where big-endian files get byte swapped.
+        if isinstance(self.all_ints, sbiff.BlockReader):
+            reads = [self.all_ints.Read(i, block_size + 1) for i in offsets.tolist()]
+            rows = np.stack(reads)
+        else:
+            rows = self.all_ints[offsets[:, None] + np.arange(block_size + 1)]
+        xy = torch.from_numpy(rows.astype(np.int64))
 
         if self._device == "cuda":
             # pin arrays x,y, which allows us to move them to GPU asynchronously non_blocking=True)
-            x, y = x.pin_memory().to(
-                self._device, non_blocking=True
-            ), y.pin_memory().to(self._device, non_blocking=True)
+            xy = xy.pin_memory().to(self._device, non_blocking=True)
         else:
-            x, y = x.to(self._device), y.to(self._device)
-        return x, y
+            xy = xy.to(self._device)
+        return xy[:, :-1].contiguous(), xy[:, 1:].contiguous()
@@ -0,0 +1,120 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import random
+import unittest
+
+import torch
+
+import sbiff
+import util
+from model_data import ModelDataProvider, Sampling, Split
+
+
+class TestModelDataProvider(unittest.TestCase):
+
+    def test_batches_are_the_same_for_every_format(self):
+        rng = random.Random(0)
+        ints = [rng.randrange(2**16) for _ in range(5000)]
+        with util.GetTempDir() as dir_path:
+            legacy = os.path.join(dir_path, "legacy.bin")
+            sbiff.AppendInts(legacy, ints)
+            little = os.path.join(dir_path, "little.bin")
+            sbiff.Convert(legacy, little, byteorder="<")
+            compressed = os.path.join(dir_path, "compressed.bin")
+            sbiff.Convert(legacy, compressed, block_ints=100)
+
+            for split, data in [(Split.Train, ints[:4500]), (Split.Val, ints[4500:])]:
+                # What get_batch did when it read the file into a list.
+                torch.manual_seed(0)
+                ix = torch.randint(low=1, high=len(data) - 64, size=(8,))
+                x = torch.stack([torch.tensor(data[i : i + 64]) for i in ix])
+                y = torch.stack([torch.tensor(data[i + 1 : i + 65]) for i in ix])
+
+                for path in [legacy, little, compressed]:
+                    torch.manual_seed(0)
+                    xb, yb = ModelDataProvider(path).get_batch(split, 64, 8)
+                    assert xb.dtype == torch.int64
+                    assert torch.equal(xb, x) and torch.equal(yb, y), path
+
+
+def _WriteDocs(path, lengths):
+    """Docs of the given lengths, each filled with its index + 1 and ended by 0."""
+    ints = []
+    for i, length in enumerate(lengths):
+        ints.extend([i + 1] * (length - 1) + [0])
+    sbiff.Create(path, byteorder="<")
+    sbiff.AppendInts(path, ints, num_docs=len(lengths))
+
+
+class TestDocSampling(unittest.TestCase):
+
+    def _FirstDocs(self, provider, block_size=16, num_batches=50):
+        """The doc each window of a few Train batches starts in."""
+        x, _ = provider.get_batch(Split.Train, block_size, 40 * num_batches)
+        return (x[:, 0] - 1).tolist(), x
+
+    def test_uniform_picks_docs_evenly(self):
+        with util.GetTempDir() as dir_path:
+            path = os.path.join(dir_path, "docs.bin")
+            # 9 short docs and one 100x longer one. Train ends 70 ints into the
+            # next doc, which counts as an 11th.
+            _WriteDocs(path, [10] * 9 + [1000] + [100] * 2)
+            torch.manual_seed(0)
+            provider = ModelDataProvider(path, Sampling.Uniform, doc_end_int=0)
+            firsts, x = self._FirstDocs(provider)
+            counts = torch.bincount(torch.tensor(firsts), minlength=11)
+            assert counts.min() > 0.06 * len(firsts), counts
+            # Short docs are read from their start.
+            short = x[torch.tensor(firsts) < 9]
+            assert (short[:, 9] == 0).all()
+
+            torch.manual_seed(0)
+            window = ModelDataProvider(path)
+            firsts, _ = self._FirstDocs(window)
+            assert sum(d == 9 for d in firsts) > 0.8 * len(firsts)
+
+    def test_curriculum_stage(self):
+        with util.GetTempDir() as dir_path:
+            path = os.path.join(dir_path, "docs.bin")
+            # Train is docs 0-4 and the first 70 ints of doc 5.
+            _WriteDocs(path, [40, 20, 30, 10] + [100] * 2)
+            torch.manual_seed(0)
+            provider = ModelDataProvider(
+                path, Sampling.Curriculum, doc_end_int=0, curriculum_stage=1 / 3
+            )
+            # Only the shortest third: 1 (20 ints) and 3 (10).
+            firsts, _ = self._FirstDocs(provider, block_size=8)
+            assert set(firsts) == {1, 3}
+            provider.set_curriculum_stage(1.0)
+            firsts, _ = self._FirstDocs(provider, block_size=8)
+            assert set(firsts) == {0, 1, 2, 3, 4, 5}
+
+    def test_window_override(self):
+        with util.GetTempDir() as dir_path:
+            path = os.path.join(dir_path, "docs.bin")
+            _WriteDocs(path, [40, 20, 30, 10] + [100] * 2)
+            provider = ModelDataProvider(
+                path, Sampling.Curriculum, doc_end_int=0, curriculum_stage=1 / 3
+            )
+            # Plain windows, like for evaluation, whatever the curriculum stage.
+            torch.manual_seed(0)
+            x, _ = provider.get_batch(Split.Train, 8, 2000, sampling=Sampling.Window)
+            torch.manual_seed(0)
+            expected, _ = ModelDataProvider(path).get_batch(Split.Train, 8, 2000)
+            assert torch.equal(x, expected)
+            firsts, _ = self._FirstDocs(provider, block_size=8)
+            assert set(firsts) == {1, 3}
+
+            with self.assertRaises(AssertionError):
+                ModelDataProvider(path).get_batch(
+                    Split.Train, 8, 4, sampling=Sampling.Uniform
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
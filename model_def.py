@@ -11,15 +11,19 @@
 import json
 import math
 import inspect
+import time
 from dataclasses import dataclass
 from typing import Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 import consts
 from tokens import Tokens
 from interpreter import Interpreter
+from sampling import Sampler
+from validator import BatchValidator, InvalidTokenError
 
 
 # @torch.jit.script # good to enable when not using torch.compile, disable when using (our default)
@@ -50,6 +54,11 @@ class LayerNorm(nn.Module):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
 
+# How many queries the attention fallback (without scaled_dot_product_attention)
+# handles at a time.
+MANUAL_ATTN_CHUNK_SIZE = 256
+
+
 class CausalSelfAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -64,24 +73,19 @@ class CausalSelfAttention(nn.Module):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         self.dropout = config.dropout
-        # flash attention make GPU go brrrrr but support is only in PyTorch nightly and still a bit scary
-        self.flash = (
-            hasattr(torch.nn.functional, "scaled_dot_product_attention")
-            and self.dropout == 0.0
-        )
+        # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
+        self.flash = hasattr(torch.nn.functional, "scaled_dot_product_attention")
         if not self.flash:
-            print(
-                "WARNING: using slow attention. Flash Attention atm needs PyTorch nightly and dropout=0.0"
-            )
-            # causal mask to ensure that attention is only applied to the left in the input sequence
-            self.register_buffer(
-                "bias",
-                torch.tril(torch.ones(config.block_size, config.block_size)).view(
-                    1, 1, config.block_size, config.block_size
-                ),
-            )
+            print("WARNING: using slow attention. Flash Attention needs PyTorch >= 2.0")
 
-    def forward(self, x):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints saved the causal mask of the slow path as a buffer.
+        state_dict.pop(prefix + "bias", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, kv=None):
+        """`kv` is a (k, v, start) layer of a KVCache: x continues the `start`
+        tokens already in k and v, and its own keys and values are added."""
         (
             B,
             T,
@@ -100,19 +104,47 @@ class CausalSelfAttention(nn.Module):
             1, 2
         )  # (B, nh, T, hs)
 
+        start = 0
+        if kv is not None:
+            k_cache, v_cache, start = kv
+            k_cache[:, :, start : start + T] = k
+            v_cache[:, :, start : start + T] = v
+            k, v = k_cache[:, :, : start + T], v_cache[:, :, : start + T]
+
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
+            # is_causal lines the mask up with the first key, so it's only right
+            # without cached tokens. A single new token may attend to everything.
+            attn_mask = None
+            if start and T > 1:
+                attn_mask = torch.ones(T, start + T, dtype=torch.bool, device=x.device)
+                attn_mask = attn_mask.tril(diagonal=start)
             y = torch.nn.functional.scaled_dot_product_attention(
-                q, k, v, attn_mask=None, dropout_p=self.dropout, is_causal=True
+                q,
+                k,
+                v,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout if self.training else 0.0,
+                is_causal=start == 0,
             )
         else:
-            # manual implementation of attention
-            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:, :, :T, :T] == 0, float("-inf"))
-            att = F.softmax(att, dim=-1)
-            att = self.attn_dropout(att)
-            y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+            # manual implementation of attention, MANUAL_ATTN_CHUNK_SIZE queries at
+            # a time so the whole (B, nh, T, T) attention matrix is never resident
+            scale = 1.0 / math.sqrt(k.size(-1))
+            ys = []
+            for i in range(0, T, MANUAL_ATTN_CHUNK_SIZE):
+                q_chunk = q[:, :, i : i + MANUAL_ATTN_CHUNK_SIZE]
+                att = (q_chunk @ k.transpose(-2, -1)) * scale
+                # causal mask: query r (position start + i + r) sees keys up to it
+                mask = torch.ones(
+                    q_chunk.size(2), start + T, dtype=torch.bool, device=x.device
+                ).tril(diagonal=start + i)
+                att = att.masked_fill(~mask, float("-inf"))
+                att = F.softmax(att, dim=-1)
+                att = self.attn_dropout(att)
+                ys.append(att @ v)  # (B, nh, c, T) x (B, nh, T, hs) -> (B, nh, c, hs)
+            y = torch.cat(ys, dim=2)
         y = (
             y.transpose(1, 2).contiguous().view(B, T, C)
         )  # re-assemble all head outputs side by side
@@ -145,12 +177,61 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv=None):
+        x = x + self.attn(self.ln_1(x), kv)
         x = x + self.mlp(self.ln_2(x))
         return x
 
 
+def _finished(validator) -> bool:
+    """Whether the validator has nothing left to accept, i.e. every row ended
+    its doc."""
+    if validator is None:
+        return False
+    if isinstance(validator, BatchValidator):
+        return bool(validator.finished.all())
+    return validator.finished
+
+
+def _try_register(validator, tok: int) -> bool:
+    """Registers tok with either kind of validator and returns whether it was valid."""
+    if isinstance(validator, BatchValidator):
+        toks = torch.tensor([tok], device=validator.last_token.device)
+        return bool(validator.register(toks))
+    try:
+        validator.register_new_token(tok)
+        return True
+    except InvalidTokenError:
+        return False
+
+
+class KVCache:
+    """The keys and values of every layer for the tokens run through the model
+    so far, so each generation step only has to run the model on new tokens.
+
+    Holds up to block_size tokens. Positions restart from 0 after reset(), like
+    the cropped window generation falls back to past block_size.
+    """
+
+    def __init__(self, config, batch_size, device, dtype=torch.float32):
+        shape = (
+            config.n_layer,
+            batch_size,
+            config.n_head,
+            config.block_size,
+            config.n_embd // config.n_head,
+        )
+        self.k = torch.zeros(shape, device=device, dtype=dtype)
+        self.v = torch.zeros(shape, device=device, dtype=dtype)
+        self.length = 0
+
+    def layer(self, i):
+        return self.k[i], self.v[i], self.length
+
+    def reset(self):
+        self.length = 0
+
+
 @dataclass
 class GPTConfig:
     block_size: int
@@ -162,6 +243,12 @@ class GPTConfig:
     bias: bool = (
         True  # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
     )
+    # In training mode, recompute each Block's activations in the backward pass
+    # instead of keeping them.
+    gradient_checkpointing: bool = False
+    # In training mode, compute the loss this many positions at a time so the
+    # (b, t, vocab_size) logits are never all resident. 0 computes them at once.
+    loss_chunk_size: int = 0
 
 
 class GPT(nn.Module):
@@ -221,13 +308,17 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def hidden_states(self, idx, cache: Optional[KVCache] = None):
+        """Runs the transformer on idx and returns the final (b, t, n_embd) activations,
+        i.e. everything but the lm_head. With a `cache`, idx continues the tokens
+        in it and is added to it."""
         device = idx.device
         b, t = idx.size()
+        start = 0 if cache is None else cache.length
         assert (
-            t <= self.config.block_size
-        ), f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(
+            start + t <= self.config.block_size
+        ), f"Cannot forward sequence of length {start + t}, block size is only {self.config.block_size}"
+        pos = torch.arange(start, start + t, dtype=torch.long, device=device).unsqueeze(
             0
         )  # shape (1, t)
 
@@ -237,11 +328,25 @@ class GPT(nn.Module):
             pos
         )  # position embeddings of shape (1, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        recompute = self.config.gradient_checkpointing and self.training
+        for i, block in enumerate(self.transformer.h):
+            if recompute and cache is None:
+                x = checkpoint(block, x, use_reentrant=False)
+            else:
+                x = block(x, None if cache is None else cache.layer(i))
         x = self.transformer.ln_f(x)
+        if cache is not None:
+            cache.length += t
+        return x
+
+    def forward(self, idx, targets=None, cache: Optional[KVCache] = None):
+        x = self.hidden_states(idx, cache)
 
-        if targets is not None:
+        if targets is not None and self.config.loss_chunk_size and self.training:
+            # The full logits are never needed for training, only the loss.
+            logits = None
+            loss = self._chunked_loss(x, targets)
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(
@@ -256,6 +361,28 @@ class GPT(nn.Module):
 
         return logits, loss
 
+    def _chunked_loss(self, x, targets):
+        """The same loss as cross entropy over lm_head(x), computed
+        loss_chunk_size positions at a time. Each chunk's logits are recomputed
+        in the backward pass rather than kept, so only one chunk's are resident."""
+
+        def chunk_loss(x_chunk, targets_chunk):
+            logits = self.lm_head(x_chunk)
+            return F.cross_entropy(
+                logits, targets_chunk, ignore_index=-1, reduction="sum"
+            )
+
+        x = x.reshape(-1, x.size(-1))
+        targets = targets.reshape(-1)
+        n = self.config.loss_chunk_size
+        loss = sum(
+            checkpoint(
+                chunk_loss, x[i : i + n], targets[i : i + n], use_reentrant=False
+            )
+            for i in range(0, x.size(0), n)
+        )
+        return loss / (targets != -1).sum()
+
     def crop_block_size(self, block_size):
         # model surgery to decrease the block size if necessary
         # e.g. we may load the GPT2 pretrained model checkpoint (block size 1024)
@@ -265,8 +392,6 @@ class GPT(nn.Module):
         self.transformer.wpe.weight = nn.Parameter(
             self.transformer.wpe.weight[:block_size]
         )
-        for block in self.transformer.h:
-            block.attn.bias = block.attn.bias[:, :, :block_size, :block_size]
 
     def configure_optimizers(self, weight_decay, learning_rate, betas, device_type):
         """
@@ -341,8 +466,10 @@ class GPT(nn.Module):
 
         return optimizer
 
-    def estimate_mfu(self, fwdbwd_per_iter, dt):
-        """estimate model flops utilization (MFU) in units of A100 bfloat16 peak FLOPS"""
+    def estimate_mfu(self, fwdbwd_per_iter, dt, flops_promised=312e12):
+        """estimate model flops utilization (MFU) as a ratio of flops_promised,
+        which defaults to A100 bfloat16 peak FLOPS. See measure_peak_flops for
+        other hardware."""
         # first estimate the number of flops we do per iteration.
         # see PaLM paper Appendix B as ref: https://arxiv.org/abs/2204.02311
         N = self.get_num_params()
@@ -351,9 +478,8 @@ class GPT(nn.Module):
         flops_per_token = 6 * N + 12 * L * H * Q * T
         flops_per_fwdbwd = flops_per_token * T
         flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
-        # express our flops throughput as ratio of A100 bfloat16 peak flops
+        # express our flops throughput as ratio of the peak flops
         flops_achieved = flops_per_iter * (1.0 / dt)  # per second
-        flops_promised = 312e12  # A100 GPU bfloat16 peak flops is 312 TFLOPS
         mfu = flops_achieved / flops_promised
         return mfu
 
@@ -366,41 +492,79 @@ class GPT(nn.Module):
         temperature=1,
         top_k=None,
         interpreter: Optional[Interpreter] = None,
+        stats: Optional[dict] = None,
+        top_p=None,
+        min_p=None,
+        draft_model: Optional["GPT"] = None,
+        num_draft_tokens=4,
+        context_stride=1,
     ):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        `validator` is either a Validator, whose rejected samples are drawn again, or a
+        BatchValidator, whose legal tokens mask the logits before sampling.
+        Generation stops early once the validator is finished, i.e. the doc ended;
+        BatchValidator rows that finished before the others are padded with the
+        doc end token.
+        If `stats` is given, it is filled with the number of generated tokens and the number
+        of tokens the validator rejected.
+        If `draft_model` is given, generation is speculative: see _generate_speculative.
+
+        Past block_size the context is a sliding window that moves `context_stride`
+        tokens at a time: the oldest tokens are dropped, the rest of the window is
+        run through the model once, and the next context_stride - 1 tokens only run
+        themselves. context_stride=1 is exact, i.e. every token sees the last
+        block_size tokens, but runs the whole window per token. Larger strides are
+        an approximation where tokens see between block_size - context_stride + 1
+        and block_size tokens, for a whole window every context_stride tokens.
+        Speculative generation always uses the exact window.
         """
+        assert 1 <= context_stride <= self.config.block_size, context_stride
+
+        sampler = Sampler(temperature, top_k, top_p, min_p)
+        if draft_model is not None:
+            draft_sampler = Sampler(temperature, top_k, top_p, min_p)
+            return self._generate_speculative(
+                idx,
+                max_new_tokens,
+                draft_model,
+                num_draft_tokens,
+                sampler,
+                draft_sampler,
+                validator,
+                interpreter,
+                stats,
+            )
+
+        # The prompt (or its last block_size tokens) is run through the model in
+        # one pass that fills the KV cache, after which each step only runs the
+        # new token. Once the cache is full, it's refilled from the last
+        # block_size - context_stride + 1 tokens.
+        block_size = self.config.block_size
+        cache = KVCache(
+            self.config, idx.size(0), idx.device, self.transformer.wte.weight.dtype
+        )
+        logits, _ = self(idx[:, -block_size:], cache=cache)
+        logits = logits[:, -1, :]
 
         i = 0
         while i < max_new_tokens:
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = (
-                idx
-                if idx.size(1) <= self.config.block_size
-                else idx[:, -self.config.block_size :]
-            )
-
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float("Inf")
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-
-            idx_next = torch.multinomial(probs, num_samples=1)
-
-            if validator is not None:
+            if isinstance(validator, BatchValidator):
+                # only sample tokens that are valid in every row
+                idx_next = sampler(validator.mask_logits_(logits))
+                validator.register(idx_next)
+            else:
+                idx_next = sampler(logits)
+
+            if validator is not None and not isinstance(validator, BatchValidator):
                 try:
                     validator.register_new_token(idx_next.item())
-                except Exception:
-                    # Try again.
+                except InvalidTokenError:
+                    # Try again with the same logits.
+                    if stats is not None:
+                        stats["num_rejected"] = stats.get("num_rejected", 0) + 1
                     continue
 
             idx = torch.cat((idx, idx_next), dim=1)
@@ -409,11 +573,180 @@ class GPT(nn.Module):
                 interpreter.live_interpret(idx_next.item())
 
             i += 1
+            if i == max_new_tokens or _finished(validator):
+                break
+
+            # forward the model to get the logits for the next step
+            if cache.length == block_size:
+                cache.reset()
+                window = block_size - context_stride + 1
+                logits, _ = self(idx[:, -window:], cache=cache)
+            else:
+                logits, _ = self(idx_next, cache=cache)
+            logits = logits[:, -1, :]
+
+        if stats is not None:
+            stats["num_generated"] = stats.get("num_generated", 0) + i
+        return idx
+
+    def _verify_logits(self, seq, n, k):
+        """Returns the (k + 1, vocab_size) logits predicting seq[0, n + j] from
+        seq[0, :n + j] for j in 0..k, i.e. what k + 1 steps of plain generation
+        would have seen, from a single forward pass."""
+        block_size = self.config.block_size
+        if n + k <= block_size:
+            # Every prefix fits, so they are all rows of one causal pass.
+            return self.lm_head(self.hidden_states(seq)[0, n - 1 :])
+
+        # Otherwise plain generation would have cropped each prefix to its own
+        # last block_size tokens, so batch those windows (right-padded).
+        windows = [seq[0, max(0, n + j - block_size) : n + j] for j in range(k + 1)]
+        lengths = torch.tensor([len(w) for w in windows], device=seq.device)
+        batch = torch.zeros(
+            (k + 1, int(lengths.max())), dtype=torch.long, device=seq.device
+        )
+        for j, w in enumerate(windows):
+            batch[j, : len(w)] = w
+        x = self.hidden_states(batch)
+        return self.lm_head(x[torch.arange(k + 1, device=seq.device), lengths - 1])
+
+    def _generate_speculative(
+        self,
+        idx,
+        max_new_tokens,
+        draft_model,
+        num_draft_tokens,
+        sampler,
+        draft_sampler,
+        validator,
+        interpreter,
+        stats,
+    ):
+        """
+        Speculative decoding (https://arxiv.org/abs/2211.17192): the small draft model
+        proposes num_draft_tokens tokens one at a time and this model scores all of them
+        in a single forward pass. Each proposal x is accepted with probability
+        min(1, p(x) / q(x)) where p and q are this model's and the draft's (filtered)
+        distributions; the first rejected one is replaced by a sample from
+        norm(max(p - q, 0)). That makes every emitted token an exact sample from p.
+
+        The validator then checks the emitted tokens in order. An invalid one is
+        dropped together with everything after it and that position is sampled again
+        next round, which is the same "sample until valid" rule generate applies.
+        """
+        assert idx.size(0) == 1, "speculative decoding supports a batch size of 1"
+        assert draft_model.config.vocab_size == self.config.vocab_size
 
+        num_drafted = num_accepted = num_rejected = num_forwards = 0
+        i = 0
+        while i < max_new_tokens and not _finished(validator):
+            n = idx.size(1)
+            k = min(num_draft_tokens, max_new_tokens - i)
+
+            # Draft k tokens.
+            seq = idx
+            q = []
+            for _ in range(k):
+                draft_cond = seq[:, -draft_model.config.block_size :]
+                logits, _ = draft_model(draft_cond)
+                q.append(draft_sampler.probs(logits[:, -1, :])[0])
+                seq = torch.cat((seq, torch.multinomial(q[-1], 1)[None]), dim=1)
+
+            # Score them (and the token after them) with this model.
+            p = sampler.probs(self._verify_logits(seq, n, k))
+            num_forwards += 1
+            num_drafted += k
+
+            new_tokens = []
+            for j in range(k):
+                x = seq[0, n + j]
+                if torch.rand(()) * q[j][x] >= p[j, x]:
+                    # Rejected, so sample this position from the residual instead.
+                    residual = torch.clamp(p[j] - q[j], min=0)
+                    new_tokens.append(torch.multinomial(residual, 1).item())
+                    break
+                new_tokens.append(x.item())
+                num_accepted += 1
+            else:
+                # Everything was accepted so the extra position is free.
+                new_tokens.append(torch.multinomial(p[k], 1).item())
+
+            for tok in new_tokens[: max_new_tokens - i]:
+                if validator is not None and not _try_register(validator, tok):
+                    num_rejected += 1
+                    break
+                idx = torch.cat((idx, torch.tensor([[tok]], device=idx.device)), dim=1)
+                if interpreter is not None:
+                    interpreter.live_interpret(tok)
+                i += 1
+                if _finished(validator):
+                    break
+
+        if stats is not None:
+            stats["num_generated"] = stats.get("num_generated", 0) + i
+            stats["num_rejected"] = stats.get("num_rejected", 0) + num_rejected
+            stats["num_drafted"] = stats.get("num_drafted", 0) + num_drafted
+            stats["num_accepted"] = stats.get("num_accepted", 0) + num_accepted
+            stats["num_forwards"] = stats.get("num_forwards", 0) + num_forwards
         return idx
 
 
-def get_model_and_config():
+@torch.no_grad()
+def measure_peak_flops(device, dtype=torch.float32, n=2048, iters=10):
+    """Measures the FLOPS of an n x n matmul on `device`. This is a practical
+    peak for estimate_mfu on hardware without a published number (e.g. CPUs)."""
+    a = torch.randn(n, n, device=device, dtype=dtype)
+    b = torch.randn(n, n, device=device, dtype=dtype)
+    sync = torch.cuda.synchronize if "cuda" in str(device) else lambda: None
+    a @ b  # warm up
+    sync()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        a @ b
+    sync()
+    return 2 * n**3 * iters / (time.perf_counter() - t0)
+
+
+def load_model_for_inference(ckpt_path, device):
+    """Builds the model and loads the weights saved by model_train.py into it."""
+    # Checkpoints pickle a GPTConfig, which newer torch refuses by default.
+    checkpoint = torch.load(ckpt_path, map_location=device, weights_only=False)
+    if "config" in checkpoint:
+        # Lets a differently sized model (e.g. a draft model) be loaded as is.
+        model = GPT(checkpoint["config"])
+    else:
+        model, _ = get_model_and_config()
+    model.load_state_dict(checkpoint["model"])
+    return model.to(device).eval()
+
+
+# Ways of running inference on CPU-only machines. "int8" dynamically quantizes
+# every nn.Linear (c_attn, c_proj, c_fc and lm_head) to int8 weights while
+# activations stay fp32. "bf16" casts the whole model to bfloat16.
+CPU_INFERENCE_MODES = ("fp32", "int8", "bf16")
+
+
+def prepare_for_cpu_inference(model, mode="fp32", num_threads=None):
+    """Prepares `model` for CPU inference in `mode` and returns the model to use."""
+    assert mode in CPU_INFERENCE_MODES, f"Unknown CPU inference mode: {mode}"
+    if num_threads is not None:
+        # Intra-op threads. The default is every core, which oversubscribes
+        # machines that run several inference processes side by side.
+        torch.set_num_threads(num_threads)
+    model = model.to("cpu").eval()
+    if mode == "int8":
+        # Returns a quantized deep copy. The embedding tied to lm_head keeps its
+        # fp32 weights since only the nn.Linear side is swapped out.
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8
+        )
+    elif mode == "bf16":
+        model = model.to(torch.bfloat16)
+    return model
+
+
+def get_model_and_config(**kwargs):
+    """`kwargs` are passed on to GPTConfig, e.g. its training options."""
     tokens_path = f"{consts.TRAINING_DATA_ROOT}/tokens.json"
     num_tokens = Tokens.Load(tokens_path).Size()
     # "padded up to nearest multiple of 64 for efficiency" -Karpathy
@@ -426,5 +759,6 @@ def get_model_and_config():
         n_head=consts.NUM_HEAD,
         n_embd=consts.NUM_EMBD,
         block_size=consts.BLOCK_SIZE,
+        **kwargs,
     )
     return GPT(config), config
@@ -0,0 +1,292 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import unittest
+from unittest import mock
+
+import torch
+
+import consts
+import model_def
+from model_def import GPT, GPTConfig, KVCache
+from model_test_util import TinyGPT
+from sampling import Sampler
+from tokens import Tokens
+from validator import BatchValidator, TransitionTables, Validator
+
+
+def _TinyGPT(seed, **kwargs):
+    return TinyGPT(seed, sharpen=20, **kwargs)
+
+
+@torch.no_grad()
+def _JointOfNextTwo(model, prefix):
+    """Exact probabilities of every pair of next two tokens."""
+    p1 = torch.softmax(model(prefix)[0][0, -1], -1)
+    joint = torch.zeros(4, 4)
+    for a in range(4):
+        seq = torch.cat((prefix, torch.tensor([[a]])), dim=1)
+        seq = seq[:, -model.config.block_size :]
+        joint[a] = p1[a] * torch.softmax(model(seq)[0][0, -1], -1)
+    return joint
+
+
+class TestSpeculativeGenerate(unittest.TestCase):
+
+    def _assert_matches_main_model(self, prefix, num_draft_tokens):
+        model = _TinyGPT(0)
+        draft = _TinyGPT(1, n_layer=1, n_embd=8)
+        expected = _JointOfNextTwo(model, prefix)
+
+        torch.manual_seed(0)
+        counts = torch.zeros(4, 4)
+        n = 4000
+        for _ in range(n):
+            res = model.generate(
+                prefix, 2, draft_model=draft, num_draft_tokens=num_draft_tokens
+            )
+            a, b = res[0, -2:].tolist()
+            counts[a, b] += 1
+        assert torch.allclose(counts / n, expected, atol=0.03), (counts / n, expected)
+
+    def test_distribution_matches_main_model(self):
+        self._assert_matches_main_model(torch.tensor([[0, 1, 2]]), 3)
+
+    def test_distribution_matches_main_model_past_block_size(self):
+        self._assert_matches_main_model(torch.tensor([[0, 1, 2, 3, 0, 1, 2, 3]]), 2)
+
+    def test_reports_stats(self):
+        model = _TinyGPT(0)
+        draft = _TinyGPT(1, n_layer=1, n_embd=8)
+        stats = {}
+        res = model.generate(
+            torch.tensor([[0]]), 6, draft_model=draft, num_draft_tokens=3, stats=stats
+        )
+        assert res.size(1) == 7
+        assert stats["num_generated"] == 6
+        assert 0 <= stats["num_accepted"] <= stats["num_drafted"]
+        assert stats["num_forwards"] <= 6
+
+
+class TestKVCache(unittest.TestCase):
+
+    @torch.no_grad()
+    def _assert_cached_logits_match(self, model):
+        seq = torch.tensor([[0, 1, 2, 3, 3, 2, 1, 0]])
+        cache = KVCache(model.config, 1, seq.device)
+        # Prefill part of it, then a chunk, then one token at a time.
+        for start, end in [(0, 3), (3, 5), (5, 6), (6, 7), (7, 8)]:
+            logits, _ = model(seq[:, start:end], cache=cache)
+            expected, _ = model(seq[:, :end])
+            assert torch.allclose(logits, expected, atol=1e-5), (logits, expected)
+        assert cache.length == 8
+
+    def test_logits_match_uncached(self):
+        self._assert_cached_logits_match(_TinyGPT(0))
+
+    def test_logits_match_uncached_without_flash(self):
+        model = _TinyGPT(0)
+        for block in model.transformer.h:
+            block.attn.flash = False
+        with mock.patch.object(model_def, "MANUAL_ATTN_CHUNK_SIZE", 3):
+            self._assert_cached_logits_match(model)
+
+    @torch.no_grad()
+    def test_generate_matches_cropped_context_past_block_size(self):
+        model = _TinyGPT(0)
+        prefix = torch.tensor([[0, 1, 2, 3, 0]])
+        torch.manual_seed(0)
+        res = model.generate(prefix, 12)
+
+        # What generate did before the cache: rerun the cropped context.
+        torch.manual_seed(0)
+        sampler = Sampler()
+        idx = prefix
+        for _ in range(12):
+            logits, _ = model(idx[:, -model.config.block_size :])
+            idx = torch.cat((idx, sampler(logits[:, -1, :])), dim=1)
+        assert torch.equal(res, idx), (res, idx)
+
+    @torch.no_grad()
+    def test_generate_with_context_stride(self):
+        model = _TinyGPT(0)
+        torch.manual_seed(0)
+        res = model.generate(torch.tensor([[0, 1, 2]]), 20, context_stride=3)
+
+        # The window starts over with the last 6 tokens whenever it reaches 8.
+        torch.manual_seed(0)
+        sampler = Sampler()
+        idx, window_start = torch.tensor([[0, 1, 2]]), 0
+        for _ in range(20):
+            if idx.size(1) - window_start > 8:
+                window_start = idx.size(1) - 6
+            logits, _ = model(idx[:, window_start:])
+            idx = torch.cat((idx, sampler(logits[:, -1, :])), dim=1)
+        assert torch.equal(res, idx), (res, idx)
+
+
+class TestGenerateWithValidator(unittest.TestCase):
+
+    def _tables(self, tok2tok):
+        stoi = {"<score-partwise>": 0, "C": 1, consts.DOC_END_TOKEN: 2}
+        # Nothing follows the doc end token, like in prep's lookups.
+        return TransitionTables(Tokens(stoi, []), 4, lookups=(tok2tok, {0: {0}}))
+
+    @torch.no_grad()
+    def test_pads_finished_rows_and_stops(self):
+        tables = self._tables({0: {1}, 1: {2}})
+        validator = BatchValidator([0, 1], tables)
+        stats = {}
+        res = _TinyGPT(0).generate(
+            torch.tensor([[0], [1]]), 30, validator=validator, stats=stats
+        )
+        assert res.tolist() == [[0, 1, 2], [1, 2, 2]]
+        assert validator.finished.all()
+        assert stats["num_generated"] == 2
+
+    @torch.no_grad()
+    def test_scalar_validator_stops_at_doc_end(self):
+        stoi = {"<score-partwise>": 0, "C": 1, consts.DOC_END_TOKEN: 2, "D": 3}
+        lookups = ({0: {1}, 1: {2}}, {0: {0}})
+        validator = Validator(0, Tokens(stoi, []), lookups=lookups)
+        stats = {}
+        res = _TinyGPT(0).generate(
+            torch.tensor([[0]]), 30, validator=validator, stats=stats
+        )
+        assert res.tolist() == [[0, 1, 2]]
+        assert validator.finished
+        assert stats["num_generated"] == 2
+
+    @torch.no_grad()
+    def test_scalar_validator_rejects_padding(self):
+        # Token 3 is past tokens.Size(), i.e. vocab padding.
+        stoi = {"<score-partwise>": 0, "C": 1, consts.DOC_END_TOKEN: 2}
+        validator = Validator(0, Tokens(stoi, []), lookups=({0: {1}, 1: {2}}, {0: {0}}))
+        samples = [torch.tensor([[t]]) for t in (3, 1, 3, 2)]
+        stats = {}
+        with mock.patch.object(Sampler, "__call__", side_effect=samples):
+            res = _TinyGPT(0).generate(
+                torch.tensor([[0]]), 30, validator=validator, stats=stats
+            )
+        assert res.tolist() == [[0, 1, 2]]
+        assert stats["num_rejected"] == 2
+
+    @torch.no_grad()
+    def test_generates_past_doc_end(self):
+        tables = self._tables({0: {1}, 1: {1, 2}})
+        model = _TinyGPT(0)
+        num_finished = 0
+        for seed in range(5):
+            torch.manual_seed(seed)
+            validator = BatchValidator([0, 1], tables)
+            # A high temperature ends docs early and at different steps.
+            res = model.generate(
+                torch.tensor([[0], [1]]), 30, validator=validator, temperature=100
+            )
+            num_finished += validator.finished.sum().item()
+            for row, finished in zip(res.tolist(), validator.finished.tolist()):
+                # A doc, then doc end padding if it ended.
+                end = row.index(2) if finished else len(row)
+                assert set(row[1:end]) <= {1}
+                assert set(row[end:]) <= {2}
+        assert num_finished > 0
+
+
+class TestCpuInference(unittest.TestCase):
+
+    def test_int8(self):
+        model = _TinyGPT(0)
+        quantized = model_def.prepare_for_cpu_inference(model, "int8")
+        # A quantized copy, so the fp32 model is still there to compare with.
+        assert isinstance(model.lm_head, torch.nn.Linear)
+        qlinear = torch.ao.nn.quantized.dynamic.Linear
+        assert isinstance(quantized.lm_head, qlinear)
+        for block in quantized.transformer.h:
+            assert isinstance(block.attn.c_attn, qlinear)
+            assert isinstance(block.mlp.c_proj, qlinear)
+        assert quantized.generate(torch.tensor([[0, 1]]), 10).shape == (1, 12)
+
+    def test_bf16(self):
+        model = model_def.prepare_for_cpu_inference(_TinyGPT(0), "bf16")
+        assert all(p.dtype == torch.bfloat16 for p in model.parameters())
+        assert not model.training
+        assert model.generate(torch.tensor([[0, 1]]), 10).shape == (1, 12)
+
+    def test_num_threads(self):
+        with mock.patch.object(torch, "set_num_threads") as set_num_threads:
+            model_def.prepare_for_cpu_inference(_TinyGPT(0), "fp32")
+            set_num_threads.assert_not_called()
+            model_def.prepare_for_cpu_inference(_TinyGPT(0), "fp32", num_threads=3)
+            set_num_threads.assert_called_once_with(3)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(AssertionError):
+            model_def.prepare_for_cpu_inference(_TinyGPT(0), "fp8")
+
+
+class TestAttention(unittest.TestCase):
+
+    @torch.no_grad()
+    def test_fallback_matches_flash(self):
+        model = _TinyGPT(0)
+        x = torch.randint(4, (2, 8))
+        expected, _ = model(x, x)
+        for block in model.transformer.h:
+            block.attn.flash = False
+        # 3 doesn't divide the 8 queries, so the last chunk is shorter.
+        with mock.patch.object(model_def, "MANUAL_ATTN_CHUNK_SIZE", 3):
+            logits, _ = model(x, x)
+        assert torch.allclose(logits, expected, atol=1e-5)
+
+    def test_loads_legacy_mask_buffers(self):
+        model = _TinyGPT(0)
+        state_dict = model.state_dict()
+        for i in range(model.config.n_layer):
+            state_dict[f"transformer.h.{i}.attn.bias"] = torch.ones(1, 1, 8, 8)
+        _TinyGPT(1).load_state_dict(state_dict)
+
+
+class TestMemoryEfficientTraining(unittest.TestCase):
+
+    def _loss_and_grads(self, **kwargs):
+        torch.manual_seed(0)
+        config = GPTConfig(
+            block_size=8, vocab_size=32, n_layer=2, n_head=2, n_embd=16, **kwargs
+        )
+        model = GPT(config).train()
+        torch.manual_seed(1)
+        x = torch.randint(32, (3, 8))
+        y = torch.randint(32, (3, 8))
+        y[0, :3] = -1  # Ignored positions.
+        logits, loss = model(x, y)
+        loss.backward()
+        return logits, loss, {n: p.grad for n, p in model.named_parameters()}
+
+    def test_matches_full_logits(self):
+        _, expected_loss, expected_grads = self._loss_and_grads()
+        # 7 doesn't divide the 24 positions, so the last chunk is shorter.
+        logits, loss, grads = self._loss_and_grads(
+            gradient_checkpointing=True, loss_chunk_size=7
+        )
+        assert logits is None
+        assert torch.allclose(loss, expected_loss, atol=1e-6), (loss, expected_loss)
+        for name, grad in expected_grads.items():
+            assert torch.allclose(grads[name], grad, atol=1e-6), name
+
+    def test_eval_is_unchanged(self):
+        torch.manual_seed(0)
+        config = GPTConfig(block_size=8, vocab_size=32, n_layer=1, n_head=2, n_embd=16)
+        model = GPT(config).eval()
+        x = torch.randint(32, (2, 8))
+        expected_logits, expected_loss = model(x, x)
+        config.gradient_checkpointing, config.loss_chunk_size = True, 5
+        logits, loss = model(x, x)
+        assert torch.equal(logits, expected_logits)
+        assert torch.equal(loss, expected_loss)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,34 +5,224 @@
 # https://opensource.org/licenses/MIT.
 
 import os
-import torch
 import random
+import time
+from typing import List
+
+import torch
+from torch.nn import functional as F
+from absl import app, flags
 
 import consts
+import cpu_flags  # Defines --cpu_mode and --num_threads.
+import util
 from validator import Validator
 from interpreter import Interpreter
 from tokens import Tokens
-from model_def import get_model_and_config
+from model_def import load_model_for_inference, prepare_for_cpu_inference
 
+flags.DEFINE_string(
+    "prompt_xml",
+    None,
+    "A MusicXML file to continue. Its tokens prime the model, the Validator and "
+    "the Interpreter instead of a sampled start token.",
+)
 
-tokens = Tokens.Load(os.path.join(consts.TRAINING_DATA_ROOT, "tokens.json"))
+flags.DEFINE_integer("max_new_tokens", 5000, "The number of tokens to generate.")
 
+flags.DEFINE_integer(
+    "context_stride",
+    1,
+    "Past the block size, how many tokens the context window moves at a time "
+    "(see GPT.generate). 1 is exact, larger is approximate but faster.",
+)
 
-starts = tokens.GetStartsOrDie()
-start = random.choice(starts)
-validator = Validator(start, tokens)
-interpreter = Interpreter(start, tokens)
-ckpt_path = os.path.join(consts.MODEL_DATA_ROOT, "ckpt.pt")
-checkpoint = torch.load(
-    ckpt_path, map_location="cuda" if torch.cuda.is_available() else "cpu"
+flags.DEFINE_integer(
+    "seed",
+    None,
+    "Seed for picking the start token and sampling. If None, runs are random.",
 )
-state_dict = checkpoint["model"]
-model, _ = get_model_and_config()
-model.load_state_dict(state_dict)
-model.generate(
-    torch.tensor([[start]]),
-    max_new_tokens=5000,
-    validator=validator,
-    interpreter=interpreter,
+
+flags.DEFINE_boolean(
+    "compare_fp32",
+    False,
+    "Also generate with the fp32 model on the same seed and check that the "
+    "--cpu_mode model stays within the tolerances below.",
+)
+
+flags.DEFINE_string(
+    "draft_ckpt",
+    None,
+    "A checkpoint of a small model trained on the same tokens.json (e.g. the "
+    "4-layer config in consts.py). If set, generation is speculative.",
 )
-tokens = res[0].tolist()
+
+flags.DEFINE_integer(
+    "num_draft_tokens", 4, "The number of tokens the draft model proposes per step."
+)
+
+flags.DEFINE_boolean(
+    "measure_speedup",
+    False,
+    "With --draft_ckpt, also generate without the draft model on the same seed "
+    "and report the wall-clock speedup.",
+)
+
+# Tolerances for --compare_fp32. Both models are teacher-forced on the fp32
+# output, which isolates numerical drift from sampling divergence:
+# - the mean KL(fp32 || cpu_mode) of the next-token distributions,
+# - how often both models agree on the most likely next token,
+# - the difference in the share of samples the Validator rejected while
+#   generating freely from the same seed.
+MAX_MEAN_KL = 0.05
+MIN_TOP1_AGREEMENT = 0.95
+MAX_REJECTION_RATE_DELTA = 0.02
+
+CKPT_PATH = os.path.join(consts.MODEL_DATA_ROOT, "ckpt.pt")
+
+
+def GetPrompt(path: str, tokens: Tokens) -> List[int]:
+    """The (BPE) tokens of a MusicXML file, without the doc end token."""
+    prompt = tokens.EncodeStrs(util.GetTokensFromXml(path))
+    if not prompt:
+        raise ValueError(f"No tokens in {path}")
+    return prompt
+
+
+def Generate(
+    model,
+    prompt: List[int],
+    tokens: Tokens,
+    seed: int,
+    device: str,
+    interpret: bool,
+    draft_model=None,
+):
+    """Continues `prompt`, which starts with a start token."""
+    validator = Validator(prompt[0], tokens)
+    validator.prime(prompt[1:])
+    interpreter = None
+    if interpret:
+        interpreter = Interpreter(prompt[0], tokens)
+        for tok in prompt[1:]:
+            interpreter.live_interpret(tok)
+    torch.manual_seed(seed)
+    stats = {}
+    t0 = time.time()
+    # The whole prompt is run through the model in one pass (see GPT.generate).
+    res = model.generate(
+        torch.tensor([prompt], device=device),
+        max_new_tokens=flags.FLAGS.max_new_tokens,
+        validator=validator,
+        interpreter=interpreter,
+        stats=stats,
+        draft_model=draft_model,
+        num_draft_tokens=flags.FLAGS.num_draft_tokens,
+        context_stride=flags.FLAGS.context_stride,
+    )
+    dt = time.time() - t0
+    num_sampled = stats["num_generated"] + stats.get("num_rejected", 0)
+    stats["rejection_rate"] = stats.get("num_rejected", 0) / max(num_sampled, 1)
+    stats["tokens_per_sec"] = stats["num_generated"] / dt
+    return res, stats
+
+
+@torch.no_grad()
+def CompareToFp32(model, fp32_model, seq: torch.Tensor, vocab_size: int):
+    """Teacher-forces `seq` through both models and measures their drift."""
+    block_size = fp32_model.config.block_size
+    x = seq[:, : block_size + 1]
+    ref_logits, _ = fp32_model(x[:, :-1], x[:, 1:])
+    logits, _ = model(x[:, :-1], x[:, 1:])
+    # Ignore the padding at the end of the vocabulary.
+    ref_logp = F.log_softmax(ref_logits[..., :vocab_size].float(), dim=-1)
+    logp = F.log_softmax(logits[..., :vocab_size].float(), dim=-1)
+    kl = (ref_logp.exp() * (ref_logp - logp)).sum(-1).mean().item()
+    agreement = (ref_logp.argmax(-1) == logp.argmax(-1)).float().mean().item()
+    return kl, agreement
+
+
+def WithinTolerances(kl: float, agreement: float, rejection_delta: float) -> bool:
+    """Whether a CPU mode's drift from fp32 (see CompareToFp32) is acceptable."""
+    return (
+        kl <= MAX_MEAN_KL
+        and agreement >= MIN_TOP1_AGREEMENT
+        and rejection_delta <= MAX_REJECTION_RATE_DELTA
+    )
+
+
+def Main(argv):
+    FLAGS = flags.FLAGS
+    util.EnsureDirExists(consts.MISC_FILES_ROOT)
+
+    seed = FLAGS.seed if FLAGS.seed is not None else random.randrange(2**31)
+    random.seed(seed)
+
+    tokens = Tokens.Load(os.path.join(consts.TRAINING_DATA_ROOT, "tokens.json"))
+    if FLAGS.prompt_xml is not None:
+        prompt = GetPrompt(FLAGS.prompt_xml, tokens)
+    else:
+        prompt = random.choices(tokens.GetStartsOrDie(), tokens.GetStartWeights())
+
+    if FLAGS.cpu_mode is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = load_model_for_inference(CKPT_PATH, device)
+    else:
+        device = "cpu"
+        model = prepare_for_cpu_inference(
+            load_model_for_inference(CKPT_PATH, device),
+            FLAGS.cpu_mode,
+            FLAGS.num_threads,
+        )
+
+    draft_model = None
+    if FLAGS.draft_ckpt is not None:
+        draft_model = load_model_for_inference(FLAGS.draft_ckpt, device)
+        if FLAGS.cpu_mode is not None:
+            draft_model = prepare_for_cpu_inference(draft_model, FLAGS.cpu_mode)
+
+    res, stats = Generate(
+        model, prompt, tokens, seed, device, interpret=True, draft_model=draft_model
+    )
+    print(
+        f"\nmode {FLAGS.cpu_mode or 'default'}: {stats['num_generated']} tokens, "
+        f"{stats['tokens_per_sec']:.2f} tokens/sec, "
+        f"{torch.get_num_threads()} threads, seed {seed}, "
+        f"validator rejection rate {stats['rejection_rate']:.4f}"
+    )
+
+    if draft_model is not None:
+        print(
+            f"speculative: accepted {stats['num_accepted']}/{stats['num_drafted']} "
+            f"drafted tokens ({stats['num_accepted'] / max(stats['num_drafted'], 1):.2%}), "
+            f"{stats['num_generated'] / stats['num_forwards']:.2f} tokens per main model pass"
+        )
+        if FLAGS.measure_speedup:
+            _, plain_stats = Generate(
+                model, prompt, tokens, seed, device, interpret=False
+            )
+            print(
+                f"without draft: {plain_stats['tokens_per_sec']:.2f} tokens/sec "
+                f"(speedup {stats['tokens_per_sec'] / plain_stats['tokens_per_sec']:.2f}x)"
+            )
+
+    if FLAGS.compare_fp32 and FLAGS.cpu_mode not in (None, "fp32"):
+        fp32_model = load_model_for_inference(CKPT_PATH, device)
+        fp32_res, fp32_stats = Generate(
+            fp32_model, prompt, tokens, seed, device, interpret=False
+        )
+        kl, agreement = CompareToFp32(model, fp32_model, fp32_res, tokens.Size())
+        rejection_delta = abs(stats["rejection_rate"] - fp32_stats["rejection_rate"])
+        ok = WithinTolerances(kl, agreement, rejection_delta)
+        print(
+            f"fp32: {fp32_stats['tokens_per_sec']:.2f} tokens/sec "
+            f"(speedup {stats['tokens_per_sec'] / fp32_stats['tokens_per_sec']:.2f}x), "
+            f"mean kl {kl:.4f} (max {MAX_MEAN_KL}), "
+            f"top-1 agreement {agreement:.4f} (min {MIN_TOP1_AGREEMENT}), "
+            f"rejection rate delta {rejection_delta:.4f} (max {MAX_REJECTION_RATE_DELTA}): "
+            f"{'PASS' if ok else 'FAIL'}"
+        )
+
+
+if __name__ == "__main__":
+    app.run(Main)
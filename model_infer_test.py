@@ -0,0 +1,60 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import copy
+import unittest
+
+import torch
+
+import model_infer
+from model_def import prepare_for_cpu_inference
+from model_test_util import TinyGPT
+
+
+class TestCompareToFp32(unittest.TestCase):
+
+    def setUp(self):
+        self.fp32_model = TinyGPT(vocab_size=64, block_size=16, n_embd=32, sharpen=20)
+        # Longer than the block size, which the comparison crops.
+        self.seq = torch.randint(
+            0, 60, (1, 40), generator=torch.Generator().manual_seed(0)
+        )
+
+    def test_cpu_modes_are_within_tolerances(self):
+        for mode in ["int8", "bf16"]:
+            model = prepare_for_cpu_inference(copy.deepcopy(self.fp32_model), mode)
+            kl, agreement = model_infer.CompareToFp32(
+                model, self.fp32_model, self.seq, 60
+            )
+            assert kl < model_infer.MAX_MEAN_KL / 10, (mode, kl)
+            assert model_infer.WithinTolerances(kl, agreement, 0.0), mode
+
+    def test_drifted_model_fails(self):
+        # As if the conversion had mixed up the rows of lm_head.
+        model = copy.deepcopy(self.fp32_model)
+        model.lm_head = torch.nn.Linear(32, 64, bias=False)
+        model.lm_head.weight.data = self.fp32_model.lm_head.weight.data.roll(1, 0)
+        kl, agreement = model_infer.CompareToFp32(model, self.fp32_model, self.seq, 60)
+        assert kl > model_infer.MAX_MEAN_KL
+        assert agreement < model_infer.MIN_TOP1_AGREEMENT
+        assert not model_infer.WithinTolerances(kl, agreement, 0.0)
+
+    def test_identical_model(self):
+        kl, agreement = model_infer.CompareToFp32(
+            self.fp32_model, self.fp32_model, self.seq, 60
+        )
+        assert abs(kl) < 1e-6 and agreement == 1.0
+
+    def test_tolerances(self):
+        ok = (model_infer.MAX_MEAN_KL, model_infer.MIN_TOP1_AGREEMENT, 0.0)
+        assert model_infer.WithinTolerances(*ok)
+        assert not model_infer.WithinTolerances(0.06, 1.0, 0.0)
+        assert not model_infer.WithinTolerances(0.0, 0.9, 0.0)
+        assert not model_infer.WithinTolerances(0.0, 1.0, 0.03)
+
+
+if __name__ == "__main__":
+    unittest.main()
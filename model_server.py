@@ -0,0 +1,254 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# A long-lived local generation service. The model, Tokens and validator lookups
+# are loaded once and stay resident. Concurrent requests are batched together
+# into shared forward passes and each request's MusicXML is streamed back as
+# the Interpreter produces it.
+#
+#   python model_server.py --port=8000
+#   curl -N -d '{"max_new_tokens": 500, "seed": 1}' localhost:8000/generate
+
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from typing import List
+
+import torch
+from absl import app, flags
+
+import consts
+import cpu_flags  # Defines --cpu_mode and --num_threads.
+from interpreter import Interpreter
+from model_def import load_model_for_inference, prepare_for_cpu_inference
+from sampling import Sampler
+from tokens import Tokens
+from validator import BatchValidator, TransitionTables
+
+flags.DEFINE_string("host", "127.0.0.1", "The address to listen on.")
+
+flags.DEFINE_integer("port", 8000, "The port to listen on.")
+
+flags.DEFINE_integer(
+    "max_batch_size",
+    8,
+    "The maximum number of requests that share a forward pass.",
+)
+
+
+@dataclass
+class _Request:
+    max_new_tokens: int
+    sampler: Sampler
+    generator: torch.Generator
+    validator: BatchValidator
+    interpreter: Interpreter
+    idx: List[int]
+    # Chunks of interpreted XML for the HTTP handler. None marks the end.
+    out: queue.Queue = field(default_factory=queue.Queue)
+    num_generated: int = 0
+    cancelled: bool = False
+
+    def done(self):
+        return (
+            self.cancelled
+            or self.num_generated >= self.max_new_tokens
+            or bool(self.validator.finished.item())
+        )
+
+
+class GenerationService:
+    """Generates for many requests at once with a single resident model.
+
+    Requests are queued by `submit` and picked up by a background thread that
+    steps every active request with one forward pass per token. Logits are
+    masked with each request's BatchValidator (sharing one set of transition
+    tables), so every step produces a valid token for every request. Sequences of
+    different lengths are right-padded: attention is causal so the padding
+    never influences the logits at each row's last real position.
+
+    A request is done once it emits the doc end token or reaches its
+    max_new_tokens. An error while stepping one request only ends that request:
+    if the batched forward pass fails, each request is run on its own so the
+    others carry on.
+    """
+
+    def __init__(self, model, tokens: Tokens, device: str, max_batch_size: int):
+        self.model = model
+        self.tokens = tokens
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.tables = TransitionTables(tokens, model.config.vocab_size, device=device)
+        self.starts = tokens.GetStartsOrDie()
+        self.start_weights = tokens.GetStartWeights()
+        self._pending = queue.Queue()
+        self._active: List[_Request] = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        max_new_tokens=1000,
+        temperature=1.0,
+        top_k=None,
+        top_p=None,
+        min_p=None,
+        seed=None,
+    ):
+        seed = seed if seed is not None else random.randrange(2**31)
+        start = random.Random(seed).choices(self.starts, self.start_weights)[0]
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(seed)
+        req = _Request(
+            max_new_tokens=max_new_tokens,
+            sampler=Sampler(temperature, top_k, top_p, min_p),
+            generator=generator,
+            validator=BatchValidator([start], self.tables),
+            interpreter=None,
+            idx=[start],
+        )
+        req.interpreter = Interpreter(
+            start, self.tokens, live_file_out=None, out=req.out.put
+        )
+        self._pending.put(req)
+        return req
+
+    def _run(self):
+        while True:
+            if not self._active:
+                # Nothing to do, so wait for the next request.
+                self._active.append(self._pending.get())
+            while len(self._active) < self.max_batch_size:
+                try:
+                    self._active.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            self._step()
+            for req in [r for r in self._active if r.done()]:
+                req.out.put(None)
+                self._active.remove(req)
+
+    @staticmethod
+    def _fail(req: _Request):
+        # End the request rather than leaving its client hanging.
+        logging.exception("Generation failed for a request.")
+        req.cancelled = True
+
+    @torch.no_grad()
+    def _logits(self, reqs: List[_Request]) -> torch.Tensor:
+        """The masked next token logits of every request, in one forward pass."""
+        block_size = self.model.config.block_size
+        contexts = [r.idx[-block_size:] for r in reqs]
+        lengths = [len(c) for c in contexts]
+        idx = torch.zeros(
+            (len(contexts), max(lengths)), dtype=torch.long, device=self.device
+        )
+        for row, context in enumerate(contexts):
+            idx[row, : len(context)] = torch.tensor(context)
+        x = self.model.hidden_states(idx)
+        rows = torch.arange(len(contexts), device=self.device)
+        last = torch.tensor(lengths, device=self.device) - 1
+        logits = self.model.lm_head(x[rows, last])
+        # Only sample tokens the validator accepts.
+        legal = torch.cat([r.validator.legal() for r in reqs])
+        return logits.masked_fill_(~legal, -float("Inf"))
+
+    def _step(self):
+        try:
+            logits = self._logits(self._active)
+            steps = list(zip(self._active, logits))
+        except Exception:
+            logging.exception("Batched forward pass failed, running requests alone.")
+            steps = []
+            for req in self._active:
+                try:
+                    steps.append((req, self._logits([req])[0]))
+                except Exception:
+                    self._fail(req)
+
+        for req, req_logits in steps:
+            try:
+                tok = req.sampler(req_logits[None], req.generator)
+                req.validator.register(tok)
+                tok = tok.item()
+                req.idx.append(tok)
+                req.num_generated += 1
+                if tok != self.tables.doc_end:
+                    req.interpreter.live_interpret(tok)
+            except Exception:
+                self._fail(req)
+
+
+def _MakeHandler(service: GenerationService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self.send_error(404)
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = json.loads(body or b"{}")
+                req = service.submit(
+                    max_new_tokens=int(params.get("max_new_tokens", 1000)),
+                    temperature=float(params.get("temperature", 1.0)),
+                    top_k=int(params["top_k"]) if params.get("top_k") else None,
+                    top_p=float(params["top_p"]) if params.get("top_p") else None,
+                    min_p=float(params["min_p"]) if params.get("min_p") else None,
+                    seed=params.get("seed"),
+                )
+            except (ValueError, TypeError, AssertionError) as e:
+                self.send_error(400, str(e))
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/xml; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                while True:
+                    s = req.out.get()
+                    if s is None:
+                        break
+                    data = s.encode()
+                    if not data:
+                        # An empty chunk would end the response.
+                        continue
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away so stop generating for it.
+                req.cancelled = True
+
+    return Handler
+
+
+def Main(argv):
+    FLAGS = flags.FLAGS
+    tokens = Tokens.Load(os.path.join(consts.TRAINING_DATA_ROOT, "tokens.json"))
+    ckpt_path = os.path.join(consts.MODEL_DATA_ROOT, "ckpt.pt")
+    if FLAGS.cpu_mode is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = load_model_for_inference(ckpt_path, device)
+    else:
+        device = "cpu"
+        model = load_model_for_inference(ckpt_path, device)
+        model = prepare_for_cpu_inference(model, FLAGS.cpu_mode, FLAGS.num_threads)
+
+    service = GenerationService(model, tokens, device, FLAGS.max_batch_size)
+    server = ThreadingHTTPServer((FLAGS.host, FLAGS.port), _MakeHandler(service))
+    print(f"Serving on http://{FLAGS.host}:{FLAGS.port}/generate")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    app.run(Main)
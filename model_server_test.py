@@ -0,0 +1,168 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import http.client
+import json
+import threading
+import unittest
+from unittest import mock
+
+import consts
+import model_server
+import validator
+from model_server import GenerationService
+from model_test_util import TinyGPT
+from tokens import Tokens
+
+_STOI = {"<score-partwise>": 0, "<part>": 1, "C": 2, consts.DOC_END_TOKEN: 3}
+_TAGS = {0: {1}, 1: {1}}
+
+
+def _Service(tok2tok, model=None, max_batch_size=8):
+    """A GenerationService whose worker thread hasn't started yet, so requests
+    submitted before _Start() are all in its first batch."""
+    with mock.patch.object(
+        validator, "LoadLookups", return_value=(tok2tok, _TAGS)
+    ), mock.patch.object(threading.Thread, "start"):
+        return GenerationService(
+            model or TinyGPT(n_layer=1), Tokens(_STOI, []), "cpu", max_batch_size
+        )
+
+
+def _Start(service):
+    threading.Thread.start(service._thread)
+
+
+def _Read(req):
+    chunks = []
+    while True:
+        s = req.out.get(timeout=60)
+        if s is None:
+            return "".join(chunks)
+        chunks.append(s)
+
+
+class TestGenerationService(unittest.TestCase):
+
+    def test_batched_matches_alone(self):
+        tok2tok = {0: {1}, 1: {2}, 2: {2}}
+        service = _Service(tok2tok)
+        reqs = [service.submit(max_new_tokens=n, seed=n) for n in (3, 10, 6)]
+        batch_sizes = []
+        hidden_states = service.model.hidden_states
+
+        def Record(idx):
+            batch_sizes.append(idx.size(0))
+            return hidden_states(idx)
+
+        with mock.patch.object(service.model, "hidden_states", side_effect=Record):
+            _Start(service)
+            outs = [_Read(r) for r in reqs]
+        assert batch_sizes[:3] == [3, 3, 3]
+        assert [r.num_generated for r in reqs] == [3, 10, 6]
+
+        for req, out in zip(reqs, outs):
+            alone = _Service(tok2tok)
+            alone_req = alone.submit(
+                max_new_tokens=req.max_new_tokens, seed=req.max_new_tokens
+            )
+            _Start(alone)
+            assert _Read(alone_req) == out
+            assert alone_req.idx == req.idx
+
+    def test_finishes_at_doc_end(self):
+        service = _Service({0: {1}, 1: {2}, 2: {3}})
+        req = service.submit(max_new_tokens=100, seed=0)
+        _Start(service)
+        out = _Read(req)
+        assert req.idx == [0, 1, 2, 3]
+        assert not req.cancelled
+        assert consts.DOC_END_TOKEN not in out
+
+    def test_cancelled_request_ends_alone(self):
+        service = _Service({0: {1}, 1: {2}, 2: {2}})
+        cancelled = service.submit(max_new_tokens=100, seed=0)
+        other = service.submit(max_new_tokens=5, seed=1)
+        cancelled.cancelled = True
+        _Start(service)
+        _Read(cancelled)
+        _Read(other)
+        assert cancelled.num_generated <= 1
+        assert other.num_generated == 5
+
+    def test_failure_only_ends_its_request(self):
+        service = _Service({0: {1}, 1: {2}, 2: {2}})
+        failing = service.submit(max_new_tokens=5, seed=0)
+        other = service.submit(max_new_tokens=5, seed=1)
+        failing.sampler = mock.Mock(side_effect=RuntimeError("bad probabilities"))
+        with self.assertLogs(level="ERROR"):
+            _Start(service)
+            _Read(failing)
+            _Read(other)
+        assert failing.cancelled and failing.num_generated == 0
+        assert not other.cancelled and other.num_generated == 5
+
+    def test_failed_batch_runs_requests_alone(self):
+        service = _Service({0: {1}, 1: {2}, 2: {2}})
+        reqs = [service.submit(max_new_tokens=4, seed=s) for s in range(2)]
+        hidden_states = service.model.hidden_states
+
+        def SingleRowOnly(idx):
+            if idx.size(0) > 1:
+                raise RuntimeError("out of memory")
+            return hidden_states(idx)
+
+        with mock.patch.object(
+            service.model, "hidden_states", side_effect=SingleRowOnly
+        ), self.assertLogs(level="ERROR"):
+            _Start(service)
+            for req in reqs:
+                _Read(req)
+        for req in reqs:
+            assert not req.cancelled and req.num_generated == 4
+
+
+class TestHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.service = _Service({0: {1}, 1: {2}, 2: {2, 3}})
+        _Start(self.service)
+        self.server = model_server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), model_server._MakeHandler(self.service)
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _Post(self, path, body):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=60)
+        conn.request("POST", path, body=body)
+        res = conn.getresponse()
+        data = res.read().decode()
+        conn.close()
+        return res, data
+
+    def test_streams_generation(self):
+        params = {"max_new_tokens": 6, "seed": 3, "top_k": 2}
+        res, data = self._Post("/generate", json.dumps(params))
+        assert res.status == 200
+        assert res.getheader("Transfer-Encoding") == "chunked"
+
+        req = self.service.submit(max_new_tokens=6, seed=3, top_k=2)
+        assert data == _Read(req)
+        assert "<score-partwise>" in data and "<part" in data
+
+    def test_bad_requests(self):
+        res, _ = self._Post("/generate", "not json")
+        assert res.status == 400
+        res, _ = self._Post("/other", "{}")
+        assert res.status == 404
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+# Helpers shared by the model tests.
+
+import torch
+
+from model_def import GPT, GPTConfig
+
+
+def TinyGPT(
+    seed=0, vocab_size=4, block_size=8, n_layer=2, n_embd=16, sharpen=1.0
+) -> GPT:
+    """A small randomly initialized GPT in eval mode. Its output distributions
+    are near uniform, so `sharpen` scales lm_head (and the embedding tied to it)
+    for tests that need a few likely tokens."""
+    torch.manual_seed(seed)
+    config = GPTConfig(
+        block_size=block_size,
+        vocab_size=vocab_size,
+        n_layer=n_layer,
+        n_head=2,
+        n_embd=n_embd,
+        bias=False,
+    )
+    model = GPT(config).eval()
+    if sharpen != 1.0:
+        model.lm_head.weight.data *= sharpen
+    return model
@@ -8,18 +8,16 @@
 # https://github.com/karpathy/nanoGPT/blob/master/train.py
 
 import os
+import csv
+import json
 import time
 import math
 from contextlib import nullcontext
 import torch
 
 import consts
-from model_def import get_model_and_config
-from model_data import ModelDataProvider, Split
-
-
-data_provider = ModelDataProvider()
-
+from model_def import get_model_and_config, measure_peak_flops
+from model_data import ModelDataProvider, Sampling, Split
 
 out_dir = consts.MODEL_DATA_ROOT
 ckpt_path = os.path.join(out_dir, "ckpt.pt")
@@ -32,6 +30,15 @@ always_save_checkpoint = True  # if True, always save a checkpoint after each ev
 gradient_accumulation_steps = 5  # used to simulate larger batch sizes
 dropout = 0.0  # for pretraining 0 is good, for finetuning try 0.1+
 bias = False  # do we use bias inside LayerNorm and Linear layers?
+# memory, both trade compute for a bigger batch size
+gradient_checkpointing = False  # recompute each Block's activations in backward
+loss_chunk_size = 0  # e.g. 4096 to never hold all (B, T, vocab) logits, 0 to disable
+# data
+data_sampling = Sampling.Window  # how batches pick docs, see model_data.Sampling
+curriculum_start = (
+    0.25  # with Sampling.Curriculum, the share of (shortest) docs at first
+)
+curriculum_iters = 100000  # ... growing linearly to all of them at this iteration
 # adamw optimizer
 learning_rate = 6e-4  # max learning rate
 max_iters = 600000  # total number of training iterations
@@ -48,6 +55,17 @@ min_lr = 6e-5  # minimum learning rate, should be ~= learning_rate/10 per Chinch
 backend = "nccl"  # 'nccl', 'gloo', etc.
 # system
 dtype = "bfloat16"  # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
+# metrics
+peak_flops = None  # peak FLOPS for MFU, e.g. 312e12 for A100 bf16. None measures a matmul on this device
+# per-iteration tokens/sec, mfu and losses. .jsonl or .csv, None to disable
+metrics_log = os.path.join(out_dir, "train_metrics.jsonl")
+# also time data/forward/backward/optimizer separately. On cuda this syncs after
+# each of them, which stops the data fetch from overlapping the GPU work
+step_breakdown = False
+
+data_provider = ModelDataProvider(
+    sampling=data_sampling, curriculum_stage=curriculum_start
+)
 
 # (because not ddp), we are running on a single gpu, and one process
 master_process = True
@@ -74,11 +92,67 @@ ctx = (
     else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 )
 
+if peak_flops is None:
+    peak_flops = measure_peak_flops(
+        device, ptdtype if device_type == "cuda" else torch.float32
+    )
+    print(f"measured matmul peak: {peak_flops / 1e12:.2f} TFLOPS")
+
+
+def sync():
+    # cuda runs asynchronously, so wait for it before reading the clock. Only
+    # for the step breakdown, as it costs the CPU/GPU overlap.
+    if step_breakdown and device_type == "cuda":
+        torch.cuda.synchronize()
+
+
+METRIC_FIELDS = [
+    "iter",
+    "time",
+    "loss",
+    "lr",
+    "step_ms",
+    "data_ms",
+    "forward_ms",
+    "backward_ms",
+    "optimizer_ms",
+    "eval_ms",
+    "tokens_per_sec",
+    "mfu",
+    "train_loss",
+    "val_loss",
+]
+
+
+class MetricsLog:
+    """Appends one row per logged iteration as JSON lines or CSV (by extension)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.csv = path is not None and path.endswith(".csv")
+        if self.csv and not os.path.exists(path):
+            with open(path, "w", newline="") as f:
+                csv.DictWriter(f, METRIC_FIELDS).writeheader()
+
+    def write(self, row):
+        if self.path is None:
+            return
+        with open(self.path, "a", newline="") as f:
+            if self.csv:
+                csv.DictWriter(f, METRIC_FIELDS).writerow(row)
+            else:
+                f.write(json.dumps(row) + "\n")
+
+
+metrics = MetricsLog(metrics_log if master_process else None)
+
 iter_num = 0
 best_val_loss = 1e9
 
 
-model, config = get_model_and_config()
+model, config = get_model_and_config(
+    gradient_checkpointing=gradient_checkpointing, loss_chunk_size=loss_chunk_size
+)
 model.to(device)
 
 checkpoint = None
@@ -108,6 +182,8 @@ checkpoint = None
 
 
 # helps estimate an arbitrarily accurate loss over either split using many batches
+# Evaluation always reads plain windows, so losses stay comparable across evals
+# whatever data_sampling (and curriculum stage) training uses.
 @torch.no_grad()
 def estimate_loss():
     out = {}
@@ -115,7 +191,9 @@ def estimate_loss():
     for split in [Split.Train, Split.Val]:
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
-            X, Y = data_provider.get_batch(split, consts.BLOCK_SIZE, consts.BATCH_SIZE)
+            X, Y = data_provider.get_batch(
+                split, consts.BLOCK_SIZE, consts.BATCH_SIZE, sampling=Sampling.Window
+            )
             with ctx:
                 _, loss = model(X, Y)
             losses[k] = loss.item()
@@ -147,8 +225,11 @@ t0 = time.time()
 local_iter_num = 0  # number of iterations in the lifetime of this process
 raw_model = model
 running_mfu = -1.0
+tokens_per_iter = gradient_accumulation_steps * consts.BATCH_SIZE * consts.BLOCK_SIZE
 
 while True:
+    timings = {"data": 0.0, "forward": 0.0, "backward": 0.0, "optimizer": 0.0}
+    eval_row = {}
     # determine and set the learning rate for this iteration
     lr = get_lr(iter_num) if decay_lr else learning_rate
     for param_group in optimizer.param_groups:
@@ -156,7 +237,17 @@ while True:
 
     # evaluate the loss on train/val sets and write checkpoints
     if iter_num % eval_interval == 0 and master_process:
+        if data_sampling == Sampling.Curriculum:
+            progress = min(iter_num / curriculum_iters, 1.0)
+            data_provider.set_curriculum_stage(
+                curriculum_start + (1 - curriculum_start) * progress
+            )
+        te = time.time()
         losses = estimate_loss()
+        eval_row = {
+            "train_loss": losses[Split.Train].item(),
+            "val_loss": losses[Split.Val].item(),
+        }
         print(
             f"step {iter_num}: train loss {losses[Split.Train]:.4f}, val loss {losses[Split.Val]:.4f}"
         )
@@ -172,20 +263,32 @@ while True:
                 }
                 print(f"saving checkpoint to {ckpt_path}")
                 torch.save(checkpoint, ckpt_path)
+        # Including the checkpoint, so the step's own time can leave it out.
+        eval_row["eval_ms"] = (time.time() - te) * 1000
     if iter_num == 0 and eval_only:
         break
 
     # forward backward update, with optional gradient accumulation to simulate larger batch size
     # and using the GradScaler if data type is float16
+    # note: with step_breakdown, the syncs stop the data fetch from
+    # overlapping with the GPU forward pass.
     for micro_step in range(gradient_accumulation_steps):
+        ts = time.time()
         with ctx:
             logits, loss = model(X, Y)
-        # immediately async prefetch next batch while model is doing the forward pass on the GPU
+        sync()
+        timings["forward"] += time.time() - ts
+        ts = time.time()
         X, Y = data_provider.get_batch(
             Split.Train, consts.BLOCK_SIZE, consts.BATCH_SIZE
         )
+        timings["data"] += time.time() - ts
+        ts = time.time()
         # backward pass, with gradient scaling if training in fp16
         scaler.scale(loss).backward()
+        sync()
+        timings["backward"] += time.time() - ts
+    ts = time.time()
     # clip the gradient
     if grad_clip != 0.0:
         scaler.unscale_(optimizer)
@@ -195,20 +298,46 @@ while True:
     scaler.update()
     # flush the gradients as soon as we can, no need for this memory anymore
     optimizer.zero_grad(set_to_none=True)
+    sync()
+    timings["optimizer"] += time.time() - ts
 
     # timing and logging
     t1 = time.time()
-    dt = t1 - t0
+    # The training step's own time, without any eval before it.
+    dt = t1 - t0 - eval_row.get("eval_ms", 0.0) / 1000
     t0 = t1
     if iter_num % log_interval == 0 and master_process:
         lossf = loss.item()  # loss as float. note: this is a CPU-GPU sync point
         if local_iter_num >= 5:  # let the training loop settle a bit
             mfu = raw_model.estimate_mfu(
-                consts.BATCH_SIZE * gradient_accumulation_steps, dt
+                consts.BATCH_SIZE * gradient_accumulation_steps, dt, peak_flops
             )
             running_mfu = mfu if running_mfu == -1.0 else 0.9 * running_mfu + 0.1 * mfu
+        tokens_per_sec = tokens_per_iter / dt
+        breakdown = ""
+        if step_breakdown:
+            breakdown = ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in timings.items())
+            breakdown = f" ({breakdown})"
         print(
-            f"iter {iter_num}: loss {lossf:.4f}, time {dt * 1000:.2f}ms, mfu {running_mfu * 100:.2f}%"
+            f"iter {iter_num}: loss {lossf:.4f}, time {dt * 1000:.2f}ms{breakdown}, "
+            f"{tokens_per_sec:.0f} tok/s, mfu {running_mfu * 100:.2f}%"
+        )
+        metrics.write(
+            {
+                "iter": iter_num,
+                "time": t1,
+                "loss": lossf,
+                "lr": lr,
+                "step_ms": dt * 1000,
+                **(
+                    {f"{k}_ms": v * 1000 for k, v in timings.items()}
+                    if step_breakdown
+                    else {}
+                ),
+                "tokens_per_sec": tokens_per_sec,
+                "mfu": running_mfu,
+                **eval_row,
+            }
         )
     iter_num += 1
     local_iter_num += 1
@@ -6,19 +6,24 @@
 
 # TODO: Refactor this because it's quite messy.
 
-from multiprocessing import Pool, Lock
+from multiprocessing import Pool
 import json
 import collections
+import os
 import sbiff
-from typing import List, Set
+import sys
+import numpy as np
+from typing import List, Optional
 from absl import app, flags
 
 import util
 import consts
-from vocab import Vocab
-from bpe import RunBpe, BpeOptions
+import dedup
+from element_cache import ElementCache
+from bpe import Encode, RunBpe, BpeOptions
+from instrument import NullProgress, Progress, StageLogger
 from tokens import Tokens
-
+from validator import LoadLookups
 
 flags.DEFINE_integer(
     "max_paths",
@@ -26,82 +31,546 @@ flags.DEFINE_integer(
     "The maximum number of paths to process. If None, all paths will be processed.",
 )
 
+flags.DEFINE_boolean(
+    "incremental",
+    False,
+    "Only add the paths that aren't in the prepared data yet, reusing its vocab "
+    "and merges. Files with tokens outside the vocab are skipped and listed in "
+    "skipped.jsonl.",
+)
+
+flags.DEFINE_string(
+    "cache_dir",
+    f"{consts.MISC_FILES_ROOT}/element_cache",
+    "Where to cache the parsed elements of each file between runs. Empty to "
+    "disable the cache.",
+)
+
+flags.DEFINE_float(
+    "cache_max_gb",
+    10.0,
+    "The cache is trimmed to this size, least recently used first, after each run.",
+)
+
+flags.DEFINE_integer(
+    "vocab_chunk_size",
+    64,
+    "How many files each worker counts the tokens of before sending the counts "
+    "back while building the vocab.",
+)
+
+flags.DEFINE_integer(
+    "min_token_count",
+    1,
+    "Tokens that occur fewer times in the corpus are left out of the vocab and "
+    "replaced by an UNK token. Tags are always kept. 1 keeps every token.",
+)
+
+flags.DEFINE_boolean(
+    "dedup",
+    True,
+    "Drop docs that duplicate (or nearly duplicate) an earlier one before "
+    "writing the training data. They're listed in duplicates.jsonl. With "
+    "--incremental, new docs are also checked against the prepared ones.",
+)
+
+flags.DEFINE_float(
+    "dedup_threshold",
+    dedup.THRESHOLD,
+    "The estimated Jaccard similarity of their token shingles from which docs "
+    "count as near duplicates.",
+)
+
 flags.DEFINE_integer(
     "max_base_tokens_for_bpe",
     50000000,
     "The maximum number of base tokens to use for BPE.",
 )
 
+flags.DEFINE_string(
+    "metrics_out",
+    None,
+    "Where to write per-stage timing and progress as JSON lines. Defaults to stderr.",
+)
+
+flags.DEFINE_float(
+    "metrics_interval_sec",
+    10.0,
+    "How often to report progress within a stage.",
+)
+
+flags.DEFINE_string(
+    "profile_stage",
+    None,
+    "A stage to profile: vocab, sink_nums, bpe_gen_new_tokens, "
+    "bpe_write_new_dataset, save_tokens or, with --incremental, dedup_index and "
+    "sink_nums_incremental. Only this process is profiled, not the pool workers.",
+)
 
-def GetUniqueTokens(paths: List[str]) -> Set[str]:
-    lock = Lock()
-    all_unique_tokens = set()
+flags.DEFINE_enum(
+    "profiler",
+    "cprofile",
+    ["cprofile", "pyinstrument"],
+    "The profiler used for --profile_stage.",
+)
 
-    def cb(unique_tokens: Set[str]):
-        nonlocal all_unique_tokens
-        lock.acquire()
-        all_unique_tokens |= unique_tokens
-        lock.release()
+flags.DEFINE_string(
+    "profile_out",
+    None,
+    "Where to write the profile. Defaults to <stage>.prof.",
+)
 
-    apply_results = []
+
+def _CountTokensInFiles(args):
+    paths, cache = args
+    counts = collections.Counter()
+    for path in paths:
+        counts.update(util.GetTokensFromXml(path, cache))
+    return counts, len(paths)
+
+
+def CountTokens(
+    paths: List[str],
+    progress: Optional[Progress] = None,
+    cache: Optional[ElementCache] = None,
+    chunk_size: int = 64,
+) -> collections.Counter:
+    """Counts every token in the files. Each worker counts `chunk_size` files
+    at a time and only sends back their combined counts."""
+    progress = progress or NullProgress()
+    counts = collections.Counter()
+    chunks = (
+        (paths[i : i + chunk_size], cache) for i in range(0, len(paths), chunk_size)
+    )
     with Pool(consts.PARALLELISM) as p:
-        for path in paths:
-            apply_result = p.apply_async(util.GetUniqueTokens, (path,), callback=cb)
-            apply_results.append(apply_result)
-        for apply_result in apply_results:
-            apply_result.wait()
-    return all_unique_tokens
+        for chunk_counts, num_files in p.imap_unordered(_CountTokensInFiles, chunks):
+            counts.update(chunk_counts)
+            progress.Update(done=num_files, files=num_files)
+    return counts
+
+
+def BuildStoi(counts: collections.Counter, min_count: int = 1) -> dict:
+    """The base vocab: the tokens with at least `min_count` occurrences (in
+    sorted order, so it doesn't depend on the order of the files), the doc end
+    token and, if any tokens were left out, UNK_TOKEN.
+
+    Tags are always kept, however rare. UNK_TOKEN isn't a tag, so a pruned tag
+    would drop out of the tag2tag transitions and the interpreter would put its
+    element's contents in the parent element.
+    """
+    tokens = sorted(
+        t for t, n in counts.items() if n >= min_count or Tokens.IsTagStr(t)
+    )
+    tokens.append(consts.DOC_END_TOKEN)
+    if len(tokens) <= len(counts):
+        tokens.append(consts.UNK_TOKEN)
+    return {token: i for i, token in enumerate(tokens)}
+
+
+def _PairCodes(ints: np.ndarray, size: int) -> np.ndarray:
+    """The distinct adjacent pairs (a, b) of `ints` as a * size + b."""
+    codes = np.unique(ints[:-1] * size + ints[1:])
+    # Half the size to send back to the parent for any realistic base vocab.
+    return codes.astype(np.uint32) if size * size <= 2**32 else codes
+
+
+def _Transitions(tokens: List[str], stoi: dict, tag_stoi: dict):
+    """Returns the ints of the tokens and their token-to-token and tag-to-tag
+    transitions as pair codes (see _PairCodes and Adjacency.Add)."""
+    unk = stoi.get(consts.UNK_TOKEN)
+    if unk is None:
+        ints = [stoi[t] for t in tokens]
+    else:
+        ints = [stoi.get(t, unk) for t in tokens]
+
+    # Tags have the same ints as in stoi.
+    arr = np.array(ints, dtype=np.int64)
+    is_tag = np.zeros(len(stoi), dtype=bool)
+    is_tag[list(tag_stoi.values())] = True
+    tags = arr[is_tag[arr]]
+
+    return ints, _PairCodes(arr, len(stoi)), _PairCodes(tags, len(stoi))
+
+
+class Adjacency:
+    """Which base tokens (or tags) follow which, as a (size, size) boolean
+    matrix that collects the pair codes from _Transitions."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.matrix = np.zeros((size, size), dtype=bool)
+
+    def Add(self, pair_codes: np.ndarray):
+        self.matrix.reshape(-1)[pair_codes] = True
+
+    def AddLookup(self, lookup: dict):
+        """Adds a lookup like those of validator.LoadLookups."""
+        for k, v in lookup.items():
+            self.matrix[k, list(v)] = True
 
+    def ToLookup(self) -> dict:
+        """Returns {token: [the tokens that follow it]} for tokens with any."""
+        rows, cols = np.nonzero(self.matrix)
+        starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        return {
+            int(rows[start]): group.tolist()
+            for start, group in zip(starts, np.split(cols, starts[1:]))
+        }
 
-def Collect(path, stoi, tag_stoi):
-    tokens = util.GetTokensFromXml(path)
+
+def Collect(path, stoi, tag_stoi, cache=None):
+    tokens = util.GetTokensFromXml(path, cache)
     tokens.append(consts.DOC_END_TOKEN)
-    ints = [stoi[t] for t in tokens]
-    tags = [tag_stoi[t] for t in tokens if t in tag_stoi]
+    return _Transitions(tokens, stoi, tag_stoi)
+
+
+def _CollectWithFingerprint(args):
+    path, stoi, tag_stoi, cache, with_fingerprint = args
+    ints, tok_pairs, tag_pairs = Collect(path, stoi, tag_stoi, cache)
+    # Without the doc end token, which every doc has.
+    fingerprint = dedup.GetFingerprint(ints[:-1]) if with_fingerprint else None
+    return path, ints, tok_pairs, tag_pairs, fingerprint
 
-    tok2tok, tag2tag = collections.defaultdict(set), collections.defaultdict(set)
-    for i in range(1, len(ints)):
-        tok2tok[ints[i - 1]].add(ints[i])
-    for i in range(1, len(tags)):
-        tag2tag[tags[i - 1]].add(tags[i])
 
-    return ints, tok2tok, tag2tag
+def CollectKnown(args):
+    """Like Collect but for a fixed vocab, also encoding the doc with `merges`.
+
+    Returns (path, ints, bpe_ints, tok_pairs, tag_pairs, unseen, fingerprint).
+    If the doc has tokens that aren't in `stoi`, they're returned in `unseen`
+    and everything else is None, unless `stoi` has UNK_TOKEN to map them to.
+    Tags are never mapped to UNK_TOKEN (see BuildStoi), so a doc with an unseen
+    tag is always skipped. The fingerprint is None unless `with_fingerprint`.
+    """
+    path, stoi, tag_stoi, merges, cache, with_fingerprint = args
+    tokens = util.GetTokensFromXml(path, cache)
+    tokens.append(consts.DOC_END_TOKEN)
+    unseen = sorted({t for t in tokens if t not in stoi})
+    has_unk = consts.UNK_TOKEN in stoi
+    if unseen and (not has_unk or any(Tokens.IsTagStr(t) for t in unseen)):
+        return path, None, None, None, None, unseen, None
+    ints, tok_pairs, tag_pairs = _Transitions(tokens, stoi, tag_stoi)
+    # Without the doc end token, like _CollectWithFingerprint.
+    fingerprint = dedup.GetFingerprint(ints[:-1]) if with_fingerprint else None
+    return path, ints, Encode(ints, merges), tok_pairs, tag_pairs, [], fingerprint
+
 
+def _AppendDoc(path: str, num_tokens: int):
+    with open(consts.TRAINING_DATA_DOCS, "a") as f:
+        f.write(json.dumps({"path": path, "num_tokens": num_tokens}) + "\n")
 
-def SinkNums(paths: List[str], stoi: dict, tag_stoi: dict):
-    """Writes tokens to file while accumulating validation dicts."""
 
-    tok2tok, tag2tag = collections.defaultdict(set), collections.defaultdict(set)
-    lock = Lock()
+def _ReadJsonLines(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f]
 
-    def cb(args):
-        nonlocal tok2tok, tag2tag
-        ints, _tok2tok, _tag2tag = args
-        lock.acquire()
-        for k, v in _tok2tok.items():
-            tok2tok[k] |= v
-        for k, v in _tag2tag.items():
-            tag2tag[k] |= v
-        sbiff.AppendInts(consts.TRAINING_DATA_NUMS, ints)
-        lock.release()
 
-    apply_results = []
+def _SaveLookups(tok2tok: Adjacency, tag2tag: Adjacency):
+    with open(consts.TRAINING_DATA_ROOT + "/tok2tok.json", "w") as f:
+        json.dump(tok2tok.ToLookup(), f)
+    with open(consts.TRAINING_DATA_ROOT + "/tag2tag.json", "w") as f:
+        json.dump(tag2tag.ToLookup(), f)
+
+
+def _CountStarts(stoi: dict) -> dict:
+    """Counts the first (BPE) token of every doc in TRAINING_DATA_BPE_NUMS."""
+    ints = sbiff.ReadArray(consts.TRAINING_DATA_BPE_NUMS)
+    ends = np.flatnonzero(ints == stoi[consts.DOC_END_TOKEN])
+    firsts = np.concatenate([[0], ends[:-1] + 1]) if len(ends) else []
+    return dict(collections.Counter(ints[firsts].tolist()))
+
+
+def _SaveState():
+    """Records the size of everything prep has written so far.
+
+    This is the commit point of a run: an incremental run that dies before
+    reaching it is rolled back to the previous state by the next one.
+    """
+    state = {
+        "num_docs": len(_ReadJsonLines(consts.TRAINING_DATA_DOCS)),
+        "num_ints": sbiff.CountInts(consts.TRAINING_DATA_NUMS),
+        "num_bpe_ints": sbiff.CountInts(consts.TRAINING_DATA_BPE_NUMS),
+        "num_skipped": len(_ReadJsonLines(consts.TRAINING_DATA_SKIPPED)),
+        "num_duplicates": len(_ReadJsonLines(consts.TRAINING_DATA_DUPLICATES)),
+    }
+    tmp = consts.TRAINING_DATA_STATE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, consts.TRAINING_DATA_STATE)
+
+
+def _RollBackToState() -> dict:
+    """Drops anything written after the last completed run and returns its state."""
+    if not os.path.exists(consts.TRAINING_DATA_STATE):
+        raise FileNotFoundError(
+            f"{consts.TRAINING_DATA_STATE} not found. Run a full prep before "
+            "using --incremental."
+        )
+    with open(consts.TRAINING_DATA_STATE, "r") as f:
+        state = json.load(f)
+    sbiff.TruncateInts(consts.TRAINING_DATA_NUMS, state["num_ints"], state["num_docs"])
+    sbiff.TruncateInts(
+        consts.TRAINING_DATA_BPE_NUMS, state["num_bpe_ints"], state["num_docs"]
+    )
+    for path, n in [
+        (consts.TRAINING_DATA_DOCS, state["num_docs"]),
+        (consts.TRAINING_DATA_SKIPPED, state["num_skipped"]),
+        # States from before incremental dedup didn't count these.
+        (consts.TRAINING_DATA_DUPLICATES, state.get("num_duplicates")),
+    ]:
+        lines = _ReadJsonLines(path)[:n]
+        with open(path, "w") as f:
+            f.writelines(json.dumps(line) + "\n" for line in lines)
+    return state
+
+
+def SinkNums(
+    paths: List[str],
+    stoi: dict,
+    tag_stoi: dict,
+    progress: Optional[Progress] = None,
+    cache: Optional[ElementCache] = None,
+    deduper: Optional[dedup.Deduper] = None,
+):
+    """Writes tokens to file while accumulating validation dicts.
+
+    With a `deduper`, docs that duplicate an earlier one (in `paths` order) are
+    dropped and listed in TRAINING_DATA_DUPLICATES instead. The workers
+    fingerprint the docs as they tokenize them.
+    """
+
+    progress = progress or NullProgress()
+    tok2tok, tag2tag = Adjacency(len(stoi)), Adjacency(len(stoi))
+    kept_paths, duplicates = [], []
+
+    args = ((path, stoi, tag_stoi, cache, deduper is not None) for path in paths)
     with Pool(consts.PARALLELISM) as p:
-        for path in paths:
-            apply_result = p.apply_async(Collect, (path, stoi, tag_stoi), callback=cb)
-            apply_results.append(apply_result)
-        for apply_result in apply_results:
-            apply_result.wait()
+        # imap keeps the docs in path order, so the first copy of a doc is kept.
+        for path, ints, tok_pairs, tag_pairs, fingerprint in p.imap(
+            _CollectWithFingerprint, args, chunksize=8
+        ):
+            progress.Update(done=1, files=1, tokens=len(ints))
+            if deduper is not None:
+                dup, exact = deduper.Add(fingerprint)
+                if dup is not None:
+                    duplicates.append(
+                        {
+                            "path": path,
+                            "duplicate_of": kept_paths[dup],
+                            "exact": exact,
+                            "num_tokens": len(ints),
+                        }
+                    )
+                    continue
+            kept_paths.append(path)
+            tok2tok.Add(tok_pairs)
+            tag2tag.Add(tag_pairs)
+            sbiff.AppendInts(consts.TRAINING_DATA_NUMS, ints, num_docs=1)
+            _AppendDoc(path, len(ints))
+
+    if deduper is not None:
+        _SaveDuplicates(duplicates)
 
     return tok2tok, tag2tag
 
 
-def Main(argv):
+def _SaveDuplicates(duplicates: List[dict]):
+    """Appends the dropped docs to TRAINING_DATA_DUPLICATES and reports them."""
+    if duplicates:
+        with open(consts.TRAINING_DATA_DUPLICATES, "a") as f:
+            f.writelines(json.dumps(d) + "\n" for d in duplicates)
+    saved = sum(d["num_tokens"] for d in duplicates)
+    total = saved + sbiff.CountInts(consts.TRAINING_DATA_NUMS)
+    num_exact = sum(d["exact"] for d in duplicates)
+    print(
+        f"Dropped {len(duplicates)} duplicate docs ({num_exact} exact), "
+        f"saving {saved} of {total} tokens ({saved / max(total, 1):.1%})."
+    )
+
+
+def _AddPreparedDocs(
+    deduper: dedup.Deduper, stoi: dict, progress: Optional[Progress] = None
+) -> List[str]:
+    """Fingerprints the docs already in TRAINING_DATA_NUMS into `deduper` and
+    returns the paths of the ones it kept, i.e. by index as Deduper.Add reports
+    duplicates. Rebuilding this from the training data rather than saving it
+    keeps it in step with whatever _RollBackToState left."""
+    progress = progress or NullProgress()
+    paths = [d["path"] for d in _ReadJsonLines(consts.TRAINING_DATA_DOCS)]
+    ints = sbiff.ReadArray(consts.TRAINING_DATA_NUMS)
+    ends = np.flatnonzero(ints == stoi[consts.DOC_END_TOKEN])
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    assert len(ends) == len(paths), (len(ends), len(paths))
+
+    kept_paths = []
+    # Without the doc end tokens, like _CollectWithFingerprint.
+    docs = (ints[start:end] for start, end in zip(starts, ends))
+    with Pool(consts.PARALLELISM) as p:
+        for path, fingerprint in zip(
+            paths, p.imap(dedup.GetFingerprint, docs, chunksize=64)
+        ):
+            progress.Update(done=1, files=1)
+            if deduper.Add(fingerprint)[0] is None:
+                kept_paths.append(path)
+    return kept_paths
+
+
+def Prep(
+    paths: List[str],
+    stages: StageLogger,
+    max_vocab_size: Optional[int] = None,
+    cache: Optional[ElementCache] = None,
+    deduper: Optional[dedup.Deduper] = None,
+    min_token_count: int = 1,
+    vocab_chunk_size: int = 64,
+):
+    """Builds the vocab, training data, lookups and BPE merges from scratch."""
     # Clear any previous prepared data.
     util.ClearIfExists(consts.TRAINING_DATA_ROOT)
 
     util.EnsureDirExists(consts.TRAINING_DATA_ROOT)
 
+    # Establish the base vocabulary.
+    with stages.Stage("vocab", total=len(paths)) as progress:
+        counts = CountTokens(paths, progress, cache, vocab_chunk_size)
+    with open(consts.TRAINING_DATA_TOKEN_COUNTS, "w") as f:
+        json.dump(dict(counts.most_common()), f)
+
+    stoi = BuildStoi(counts, min_token_count)
+    if consts.UNK_TOKEN in stoi:
+        pruned = [n for t, n in counts.items() if t not in stoi]
+        print(
+            f"Replaced {len(pruned)} tokens with fewer than {min_token_count} "
+            f"occurrences ({sum(pruned)} in all) by {consts.UNK_TOKEN}."
+        )
+    tag_stoi = {s: i for s, i in stoi.items() if Tokens.IsTagStr(s)}
+    sbiff.Create(
+        consts.TRAINING_DATA_NUMS,
+        width=sbiff.WidthFor(len(stoi) - 1),
+        byteorder=consts.SBIFF_BYTEORDER,
+    )
+
+    # Use vocab to write the training data to file and collect the validation dicts.
+    with stages.Stage("sink_nums", total=len(paths)) as progress:
+        tok2tok, tag2tag = SinkNums(paths, stoi, tag_stoi, progress, cache, deduper)
+
+    # Dump these now -- we'll use them to validate things later.
+    _SaveLookups(tok2tok, tag2tag)
+
+    options = BpeOptions(
+        stoi=stoi,
+        src=consts.TRAINING_DATA_NUMS,
+        dst=consts.TRAINING_DATA_BPE_NUMS,
+    )
+    if max_vocab_size is not None:
+        options.max_vocab_size = max_vocab_size
+    merges = RunBpe(options, stages)
+    with stages.Stage("save_tokens"):
+        Tokens(stoi, merges, _CountStarts(stoi)).Save(
+            consts.TRAINING_DATA_ROOT + "/tokens.json"
+        )
+        _SaveState()
+
+
+def PrepIncremental(
+    paths: List[str],
+    stages: StageLogger,
+    cache: Optional[ElementCache] = None,
+    deduper: Optional[dedup.Deduper] = None,
+):
+    """Adds the paths that aren't prepared yet, keeping the vocab and merges.
+
+    New docs are tokenized with the existing base vocab, encoded with the
+    existing merges and appended to both SBIFF files and the doc index. Their
+    transitions are unioned into the lookups. Docs with unseen tokens are
+    skipped and recorded in TRAINING_DATA_SKIPPED so a later full prep (which
+    rebuilds the vocab) can pick them up.
+
+    With a `deduper`, the prepared docs are fingerprinted into it first, and new
+    docs that duplicate one of them (or an earlier new doc) are dropped and
+    listed in TRAINING_DATA_DUPLICATES, like in SinkNums.
+    """
+    _RollBackToState()
+    with open(consts.TRAINING_DATA_ROOT + "/tokens.json", "r") as f:
+        data = json.load(f)
+    stoi, merges = data["stoi"], data["merges"]
+    tag_stoi = {s: i for s, i in stoi.items() if Tokens.IsTagStr(s)}
+    tok2tok, tag2tag = Adjacency(len(stoi)), Adjacency(len(stoi))
+    for adjacency, lookup in zip((tok2tok, tag2tag), LoadLookups()):
+        adjacency.AddLookup(lookup)
+
+    done = {d["path"] for d in _ReadJsonLines(consts.TRAINING_DATA_DOCS)}
+    done |= {d["path"] for d in _ReadJsonLines(consts.TRAINING_DATA_SKIPPED)}
+    done |= {d["path"] for d in _ReadJsonLines(consts.TRAINING_DATA_DUPLICATES)}
+    new_paths = list(dict.fromkeys(p for p in paths if p not in done))
+    print(f"{len(new_paths)} new paths, {len(done)} already prepared or skipped.")
+
+    kept_paths = []
+    if deduper is not None and new_paths:
+        num_docs = len(_ReadJsonLines(consts.TRAINING_DATA_DOCS))
+        with stages.Stage("dedup_index", total=num_docs) as progress:
+            kept_paths = _AddPreparedDocs(deduper, stoi, progress)
+
+    skipped, duplicates = [], []
+    with stages.Stage("sink_nums_incremental", total=len(new_paths)) as progress:
+        args = (
+            (path, stoi, tag_stoi, merges, cache, deduper is not None)
+            for path in new_paths
+        )
+        with Pool(consts.PARALLELISM) as p:
+            # imap keeps the docs in the same order in both SBIFF files.
+            for path, ints, bpe_ints, tok_pairs, tag_pairs, unseen, fp in p.imap(
+                CollectKnown, args, chunksize=8
+            ):
+                progress.Update(done=1, files=1, tokens=len(ints or []))
+                if unseen:
+                    skipped.append({"path": path, "unseen": unseen})
+                    continue
+                if deduper is not None:
+                    dup, exact = deduper.Add(fp)
+                    if dup is not None:
+                        duplicates.append(
+                            {
+                                "path": path,
+                                "duplicate_of": kept_paths[dup],
+                                "exact": exact,
+                                "num_tokens": len(ints),
+                            }
+                        )
+                        continue
+                    kept_paths.append(path)
+                tok2tok.Add(tok_pairs)
+                tag2tag.Add(tag_pairs)
+                sbiff.AppendInts(consts.TRAINING_DATA_NUMS, ints, num_docs=1)
+                sbiff.AppendInts(consts.TRAINING_DATA_BPE_NUMS, bpe_ints, num_docs=1)
+                _AppendDoc(path, len(ints))
+
+    if skipped:
+        print(f"Skipped {len(skipped)} paths with tokens outside the vocab.")
+        with open(consts.TRAINING_DATA_SKIPPED, "a") as f:
+            f.writelines(json.dumps(s) + "\n" for s in skipped)
+    if deduper is not None:
+        _SaveDuplicates(duplicates)
+    _SaveLookups(tok2tok, tag2tag)
+    Tokens(stoi, merges, _CountStarts(stoi)).Save(
+        consts.TRAINING_DATA_ROOT + "/tokens.json"
+    )
+    _SaveState()
+
+
+def Main(argv):
+    FLAGS = flags.FLAGS
+
+    metrics_out = open(FLAGS.metrics_out, "w") if FLAGS.metrics_out else sys.stderr
+    stages = StageLogger(
+        metrics_out,
+        interval_sec=FLAGS.metrics_interval_sec,
+        profile_stage=FLAGS.profile_stage,
+        profile_out=FLAGS.profile_out,
+        profiler=FLAGS.profiler,
+    )
+
     # Get the paths to all the training files.
     with open(consts.TRAINING_FILES_LIST, "r") as f:
         paths = f.read().split("\n")[:-1]
@@ -109,32 +578,28 @@ def Main(argv):
     if flags.FLAGS.max_paths is not None:
         paths = paths[: flags.FLAGS.max_paths]
 
-    # Establish the base vocabulary.
-    unique_tokens = GetUniqueTokens(paths)
-    unique_tokens.add(consts.DOC_END_TOKEN)
-
-    stoi = {token: i for i, token in enumerate(unique_tokens)}
-    tag_stoi = {s: i for s, i in stoi.items() if Vocab.is_tag(s)}
-
-    # Use vocab to write the training data to file and collect the validation dicts.
-    tok2tok, tag2tag = SinkNums(paths, stoi, tag_stoi)
-    tok2tok = {k: list(v) for k, v in tok2tok.items()}
-    tag2tag = {k: list(v) for k, v in tag2tag.items()}
+    cache = None
+    if FLAGS.cache_dir:
+        cache = ElementCache(FLAGS.cache_dir, int(FLAGS.cache_max_gb * 2**30))
+
+    deduper = dedup.Deduper(FLAGS.dedup_threshold) if FLAGS.dedup else None
+    if FLAGS.incremental:
+        PrepIncremental(paths, stages, cache, deduper)
+    else:
+        Prep(
+            paths,
+            stages,
+            cache=cache,
+            deduper=deduper,
+            min_token_count=FLAGS.min_token_count,
+            vocab_chunk_size=FLAGS.vocab_chunk_size,
+        )
 
-    # Dump these now -- we'll use them to validate things later.
-    with open(consts.TRAINING_DATA_ROOT + "/tok2tok.json", "w") as f:
-        json.dump(tok2tok, f)
-    with open(consts.TRAINING_DATA_ROOT + "/tag2tag.json", "w") as f:
-        json.dump(tag2tag, f)
+    if cache is not None:
+        cache.Evict()
 
-    merges = RunBpe(
-        BpeOptions(
-            stoi=stoi,
-            src=consts.TRAINING_DATA_NUMS,
-            dst=consts.TRAINING_DATA_BPE_NUMS,
-        )
-    )
-    Tokens(stoi, merges).Save(consts.TRAINING_DATA_ROOT + "/tokens.json")
+    if metrics_out is not sys.stderr:
+        metrics_out.close()
 
 
 if __name__ == "__main__":
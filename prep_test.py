@@ -0,0 +1,300 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import collections
+from contextlib import contextmanager
+import gzip
+import json
+import os
+import random
+import unittest
+
+import consts
+import dedup
+import prep
+import sbiff
+import util
+from benchmarks import synthetic
+from bpe import Encode
+from instrument import StageLogger
+from interpreter import Interpreter
+from tokens import Tokens
+from validator import LoadLookups
+
+_UNSEEN = (
+    "<score-partwise><part><measure><note><pitch><step>Z</step></pitch></note>"
+    "</measure></part></score-partwise>"
+)
+
+
+@contextmanager
+def _InTempDir():
+    cwd = os.getcwd()
+    with util.GetTempDir() as dir_path:
+        os.chdir(dir_path)
+        try:
+            yield dir_path
+        finally:
+            os.chdir(cwd)
+
+
+def _WriteScores(root, n, seed):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n):
+        path = os.path.join(root, f"{seed}_{i}.xml")
+        with open(path, "w") as f:
+            f.write(synthetic.GenerateScore(rng, 4))
+        paths.append(path)
+    return paths
+
+
+def _Docs():
+    with open(consts.TRAINING_DATA_DOCS, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestIncrementalPrep(unittest.TestCase):
+
+    def test_appends_new_docs(self):
+        with _InTempDir() as dir_path:
+            old_paths = _WriteScores(dir_path, 12, seed=0)
+            new_paths = _WriteScores(dir_path, 6, seed=1)
+            unseen_path = os.path.join(dir_path, "unseen.xml")
+            with open(unseen_path, "w") as f:
+                f.write(_UNSEEN)
+
+            stages = StageLogger()
+            prep.Prep(old_paths, stages)
+            assert set(d["path"] for d in _Docs()) == set(old_paths)
+            nums = sbiff.ReadAllInts(consts.TRAINING_DATA_NUMS)
+            bpe_nums = sbiff.ReadAllInts(consts.TRAINING_DATA_BPE_NUMS)
+            tok2tok, _ = LoadLookups()
+            tokens_path = consts.TRAINING_DATA_ROOT + "/tokens.json"
+            with open(tokens_path, "r") as f:
+                data = json.load(f)
+
+            all_paths = old_paths + new_paths + [unseen_path]
+            prep.PrepIncremental(all_paths, stages)
+
+            # Only the new docs were added, in order, with the old vocab.
+            docs = _Docs()
+            added = [d["path"] for d in docs[len(old_paths) :]]
+            assert unseen_path not in added
+            assert added and set(added) <= set(new_paths)
+            tag_stoi = {s: i for s, i in data["stoi"].items() if Tokens.IsTagStr(s)}
+            expected, expected_bpe = list(nums), list(bpe_nums)
+            for path in added:
+                ints, _, _ = prep.Collect(path, data["stoi"], tag_stoi)
+                expected += ints
+                expected_bpe += Encode(ints, data["merges"])
+            assert sbiff.ReadAllInts(consts.TRAINING_DATA_NUMS) == expected
+            assert sbiff.ReadAllInts(consts.TRAINING_DATA_BPE_NUMS) == expected_bpe
+            # The vocab and merges are kept and the new docs' starts counted.
+            with open(tokens_path, "r") as f:
+                new_data = json.load(f)
+            assert new_data["stoi"] == data["stoi"]
+            assert new_data["merges"] == data["merges"]
+            assert sum(data["start_counts"].values()) == len(old_paths)
+            assert sum(new_data["start_counts"].values()) == len(docs)
+
+            # The new transitions are added to the old ones.
+            new_tok2tok, _ = LoadLookups()
+            for k, v in tok2tok.items():
+                assert v <= new_tok2tok[k]
+
+            with open(consts.TRAINING_DATA_SKIPPED, "r") as f:
+                skipped = [json.loads(line) for line in f]
+            assert {"path": unseen_path, "unseen": ["Z"]} in skipped
+
+            # A second run has nothing left to do, and a half-written run
+            # is rolled back.
+            sbiff.AppendInts(consts.TRAINING_DATA_NUMS, [1, 2, 3])
+            prep.PrepIncremental(all_paths, stages)
+            assert sbiff.ReadAllInts(consts.TRAINING_DATA_NUMS) == expected
+            assert len(_Docs()) == len(docs)
+
+
+class TestVocab(unittest.TestCase):
+
+    def test_counts_tokens_in_chunks(self):
+        with util.GetTempDir() as dir_path:
+            paths = _WriteScores(dir_path, 10, seed=0)
+            expected = collections.Counter()
+            for path in paths:
+                expected.update(util.GetTokensFromXml(path))
+            for chunk_size in [1, 3, 64]:
+                assert prep.CountTokens(paths, chunk_size=chunk_size) == expected
+
+    def test_build_stoi(self):
+        counts = collections.Counter({"<b>": 3, "a": 1, "<a>": 2})
+        assert prep.BuildStoi(counts) == {
+            "<a>": 0,
+            "<b>": 1,
+            "a": 2,
+            consts.DOC_END_TOKEN: 3,
+        }
+        assert prep.BuildStoi(counts, min_count=2) == {
+            "<a>": 0,
+            "<b>": 1,
+            consts.DOC_END_TOKEN: 2,
+            consts.UNK_TOKEN: 3,
+        }
+        # Rare tags are kept.
+        assert prep.BuildStoi(counts, min_count=4) == prep.BuildStoi(
+            counts, min_count=2
+        )
+
+    def test_rare_tag_round_trips_through_interpreter(self):
+        strs = [
+            "<score-partwise>",
+            "<part>",
+            "<measure>",
+            '<note print-object="no">',
+            "<pitch>",
+            "<step>",
+            "E",
+            "<octave>",
+            "4",
+            "<note>",
+            "<pitch>",
+            "<step>",
+            "C",
+            "<octave>",
+            "4",
+        ]
+        counts = collections.Counter(strs * 2)
+        counts.update(["<note>", "<pitch>", "<step>", "<octave>", "C", "4"] * 5)
+
+        def Interpret(min_count):
+            tokens = Tokens(prep.BuildStoi(counts, min_count), [])
+            ints = tokens.EncodeStrs(strs)
+            out = []
+            interpreter = Interpreter(
+                ints[0], tokens, live_file_out=None, out=out.append
+            )
+            for i in ints[1:]:
+                interpreter.live_interpret(i)
+            return "".join(out)
+
+        full, pruned = Interpret(1), Interpret(3)
+        assert '<note print-object="no">' in pruned
+        # Only the rare text is left out, and the rest nests the same.
+        assert pruned == full.replace("E", "")
+
+    def test_maps_rare_tokens_to_unk(self):
+        with _InTempDir() as dir_path:
+            paths = _WriteScores(dir_path, 4, seed=0)
+            prep.Prep(paths, StageLogger(), min_token_count=3)
+            with open(consts.TRAINING_DATA_TOKEN_COUNTS, "r") as f:
+                counts = json.load(f)
+            tokens = Tokens.Load(consts.TRAINING_DATA_ROOT + "/tokens.json")
+            unk = tokens._base_stoi[consts.UNK_TOKEN]
+            assert not tokens.TokenIsTag(unk)
+
+            expected = []
+            for path in paths:
+                for t in util.GetTokensFromXml(path) + [consts.DOC_END_TOKEN]:
+                    rare = counts.get(t, 3) < 3
+                    expected.append(unk if rare else tokens._base_stoi[t])
+            assert unk in expected
+            assert sbiff.ReadAllInts(consts.TRAINING_DATA_NUMS) == expected
+
+
+class TestTransitions(unittest.TestCase):
+
+    def test_matches_adjacent_pairs(self):
+        rng = random.Random(0)
+        stoi = {t: i for i, t in enumerate(["<a>", "<b>", "x", "y", "<c>", "z"])}
+        tag_stoi = {s: i for s, i in stoi.items() if Tokens.IsTagStr(s)}
+        for _ in range(50):
+            tokens = [rng.choice(list(stoi)) for _ in range(rng.randrange(1, 30))]
+            ints, tok_pairs, tag_pairs = prep._Transitions(tokens, stoi, tag_stoi)
+            assert ints == [stoi[t] for t in tokens]
+            tags = [stoi[t] for t in tokens if t in tag_stoi]
+
+            expected_tok2tok, expected_tag2tag = {}, {}
+            for seq, expected in [(ints, expected_tok2tok), (tags, expected_tag2tag)]:
+                for a, b in zip(seq, seq[1:]):
+                    expected[a] = sorted(set(expected.get(a, [])) | {b})
+            tok2tok, tag2tag = prep.Adjacency(len(stoi)), prep.Adjacency(len(stoi))
+            tok2tok.Add(tok_pairs)
+            tag2tag.Add(tag_pairs)
+            assert tok2tok.ToLookup() == expected_tok2tok
+            assert tag2tag.ToLookup() == expected_tag2tag
+
+            # Round trip through the lookup format the Validator loads.
+            copy = prep.Adjacency(len(stoi))
+            copy.AddLookup({k: set(v) for k, v in expected_tok2tok.items()})
+            assert (copy.matrix == tok2tok.matrix).all()
+
+
+class TestDedupPrep(unittest.TestCase):
+
+    def test_drops_duplicates(self):
+        with _InTempDir() as dir_path:
+            paths = _WriteScores(dir_path, 8, seed=0)
+            # A gzipped copy of one score and one with a note's stem flipped.
+            with open(paths[2], "r") as f:
+                xml = f.read()
+            copy_path = os.path.join(dir_path, "copy.xml.gz")
+            with gzip.open(copy_path, "wt") as f:
+                f.write(xml)
+            near_path = os.path.join(dir_path, "near.xml")
+            with open(near_path, "w") as f:
+                stem = "<stem>up</stem>" if "<stem>up" in xml else "<stem>down</stem>"
+                flipped = "<stem>down</stem>" if "up" in stem else "<stem>up</stem>"
+                f.write(xml.replace(stem, flipped, 1))
+            all_paths = [paths[0], copy_path] + paths[1:] + [near_path]
+
+            prep.Prep(all_paths, StageLogger(), deduper=dedup.Deduper())
+
+            kept = [paths[0], copy_path, paths[1]] + paths[3:]
+            assert [d["path"] for d in _Docs()] == kept
+            with open(consts.TRAINING_DATA_DUPLICATES, "r") as f:
+                duplicates = [json.loads(line) for line in f]
+            assert [(d["path"], d["duplicate_of"]) for d in duplicates] == [
+                (paths[2], copy_path),
+                (near_path, copy_path),
+            ]
+            assert [d["exact"] for d in duplicates] == [True, False]
+
+            # Incremental runs don't add them back.
+            prep.PrepIncremental(all_paths, StageLogger())
+            assert len(_Docs()) == len(paths)
+
+    def test_incremental_drops_duplicates(self):
+        with _InTempDir() as dir_path:
+            paths = _WriteScores(dir_path, 6, seed=0)
+            prep.Prep(paths[:4], StageLogger(), deduper=dedup.Deduper())
+
+            # An .xml.gz next to a prepared .xml, and a new doc exported twice.
+            copy_path = paths[1] + ".gz"
+            with open(paths[1], "rb") as f, gzip.open(copy_path, "wb") as g:
+                g.write(f.read())
+            new_copy_path = os.path.join(dir_path, "new_copy.xml")
+            with open(paths[5], "rb") as f, open(new_copy_path, "wb") as g:
+                g.write(f.read())
+            # 0_4.xml has tokens outside the vocab.
+            all_paths = paths[:4] + [paths[5], copy_path, new_copy_path]
+
+            prep.PrepIncremental(all_paths, StageLogger(), deduper=dedup.Deduper())
+            assert [d["path"] for d in _Docs()] == paths[:4] + [paths[5]]
+            with open(consts.TRAINING_DATA_DUPLICATES, "r") as f:
+                duplicates = [json.loads(line) for line in f]
+            assert [(d["path"], d["duplicate_of"]) for d in duplicates] == [
+                (copy_path, paths[1]),
+                (new_copy_path, paths[5]),
+            ]
+
+            # Without a deduper, everything new is added.
+            prep.Prep(paths[:4], StageLogger(), deduper=None)
+            prep.PrepIncremental(all_paths, StageLogger())
+            assert len(_Docs()) == len(all_paths)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+from typing import Optional
+
+import torch
+
+
+class Sampler:
+    """Samples the next token from logits with top-k, top-p and min-p filtering.
+
+    Instead of masking the whole (b, vocab_size) logits with -inf and running a
+    vocab-wide softmax, this takes the top-k slice once and does everything else
+    on that slice: temperature, the top-p/min-p cutoffs and the sampling itself.
+    top_k=None means the slice is the whole vocabulary, which top-p needs when
+    used on its own. That sorts every row, so combine top-p with a top_k (a few
+    hundred is plenty) whenever the nucleus is known to be small. Without top-p
+    nothing needs sorting, so the whole vocabulary is used as it is, with only
+    temperature and min-p applied.
+
+    The slice and its scratch space live in buffers that are allocated on first
+    use and reused for as long as the batch size, k and device stay the same,
+    so steady-state generation does no vocab-sized allocations per step.
+    """
+
+    def __init__(
+        self,
+        temperature: float = 1.0,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        min_p: Optional[float] = None,
+    ):
+        assert temperature > 0, "temperature must be positive"
+        assert top_p is None or 0 < top_p <= 1, "top_p must be in (0, 1]"
+        assert min_p is None or 0 <= min_p <= 1, "min_p must be in [0, 1]"
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self._key = None
+
+    def _ensure_buffers(self, logits: torch.Tensor, k: int):
+        key = (logits.size(0), k, logits.device, logits.dtype)
+        if key == self._key:
+            return
+        b, device = logits.size(0), logits.device
+        self._key = key
+        self._vals = torch.empty((b, k), dtype=logits.dtype, device=device)
+        self._idx = torch.empty((b, k), dtype=torch.long, device=device)
+        self._weights = torch.empty((b, k), dtype=torch.float, device=device)
+        self._scratch = torch.empty((b, k), dtype=torch.float, device=device)
+        self._mask = torch.empty((b, k), dtype=torch.bool, device=device)
+        self._col = torch.empty((b, 1), dtype=torch.float, device=device)
+        self._choice = torch.empty((b, 1), dtype=torch.long, device=device)
+
+    def _is_full_vocab(self, logits: torch.Tensor) -> bool:
+        """Whether the weights are over the whole vocabulary in its own order,
+        with no top-k slice in self._idx."""
+        use_top_p = self.top_p is not None and self.top_p < 1
+        return not use_top_p and (self.top_k is None or self.top_k >= logits.size(-1))
+
+    def _filtered_weights(self, logits: torch.Tensor) -> torch.Tensor:
+        """Returns the unnormalized (b, k) weights of the top-k slice in self._idx,
+        or the (b, vocab_size) weights of every token if _is_full_vocab."""
+        k = logits.size(-1) if self.top_k is None else min(self.top_k, logits.size(-1))
+        self._ensure_buffers(logits, k)
+        # Weights are exp((logit - max) / temperature), i.e. 1 for the most
+        # likely token.
+        w = self._weights
+        if self._is_full_vocab(logits):
+            w.copy_(logits)
+            torch.amax(w, dim=-1, keepdim=True, out=self._col)
+        else:
+            torch.topk(logits, k, dim=-1, sorted=True, out=(self._vals, self._idx))
+            # The slice is sorted so the row max is the first column.
+            w.copy_(self._vals)
+            self._col.copy_(w[:, :1])
+        w.sub_(self._col).div_(self.temperature).exp_()
+
+        if self.top_p is not None and self.top_p < 1:
+            # Keep the smallest prefix whose mass reaches top_p, i.e. drop a
+            # token once the mass strictly before it already exceeds top_p.
+            torch.cumsum(w, dim=-1, out=self._scratch)
+            self._col.copy_(self._scratch[:, -1:]).mul_(self.top_p)
+            self._scratch.sub_(w)
+            torch.gt(self._scratch, self._col, out=self._mask)
+            w.masked_fill_(self._mask, 0.0)
+
+        if self.min_p is not None and self.min_p > 0:
+            # p / p_max is exactly the weight, so no normalization is needed.
+            torch.lt(w, self.min_p, out=self._mask)
+            w.masked_fill_(self._mask, 0.0)
+
+        return w
+
+    def __call__(self, logits: torch.Tensor, generator=None) -> torch.Tensor:
+        """Samples one token per row of (b, vocab_size) logits. Returns a (b, 1) LongTensor."""
+        w = self._filtered_weights(logits)
+        # multinomial normalizes the weights itself.
+        torch.multinomial(w, num_samples=1, generator=generator, out=self._choice)
+        if self._is_full_vocab(logits):
+            return self._choice.clone()
+        return torch.gather(self._idx, 1, self._choice)
+
+    def probs(self, logits: torch.Tensor) -> torch.Tensor:
+        """Returns the full (b, vocab_size) distribution that __call__ samples from."""
+        w = self._filtered_weights(logits)
+        if self._is_full_vocab(logits):
+            return w / w.sum(dim=-1, keepdim=True)
+        probs = torch.zeros(logits.shape, dtype=torch.float, device=logits.device)
+        probs.scatter_(1, self._idx, w)
+        return probs.div_(probs.sum(dim=-1, keepdim=True))
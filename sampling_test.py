@@ -0,0 +1,84 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import unittest
+
+import torch
+
+from sampling import Sampler
+
+
+def _Logits(probs):
+    return torch.log(torch.tensor([probs]))
+
+
+def _Sampled(sampler, logits, n=500):
+    generator = torch.Generator().manual_seed(0)
+    return {sampler(logits, generator).item() for _ in range(n)}
+
+
+class TestSampler(unittest.TestCase):
+
+    def test_top_k_1_is_argmax(self):
+        logits = torch.randn(4, 100)
+        res = Sampler(top_k=1)(logits)
+        assert res.shape == (4, 1)
+        assert res[:, 0].tolist() == logits.argmax(-1).tolist()
+
+    def test_top_k_only_samples_top_k(self):
+        logits = _Logits([0.1, 0.4, 0.2, 0.3])
+        assert _Sampled(Sampler(top_k=2), logits) == {1, 3}
+
+    def test_top_p_keeps_smallest_set_reaching_p(self):
+        logits = _Logits([0.1, 0.5, 0.1, 0.3])
+        assert _Sampled(Sampler(top_p=0.7), logits) == {1, 3}
+        assert _Sampled(Sampler(top_p=0.4), logits) == {1}
+
+    def test_min_p_is_relative_to_most_likely(self):
+        logits = _Logits([0.1, 0.5, 0.15, 0.25])
+        assert _Sampled(Sampler(min_p=0.5), logits) == {1, 3}
+
+    def test_matches_top_k_distribution(self):
+        torch.manual_seed(0)
+        logits = torch.randn(1, 50)
+        sampler = Sampler(temperature=0.7, top_k=5)
+        generator = torch.Generator().manual_seed(0)
+        counts = torch.zeros(50)
+        for _ in range(20000):
+            counts[sampler(logits, generator).item()] += 1
+
+        v, ix = torch.topk(logits[0] / 0.7, 5)
+        expected = torch.zeros(50)
+        expected[ix] = torch.softmax(v, dim=-1)
+        assert torch.allclose(counts / counts.sum(), expected, atol=0.02)
+
+    def test_full_vocab_without_top_p(self):
+        torch.manual_seed(0)
+        logits = torch.randn(2, 50)
+        expected = torch.softmax(logits / 0.7, dim=-1)
+        sampler = Sampler(temperature=0.7)
+        assert torch.allclose(sampler.probs(logits), expected, atol=1e-6)
+        assert sampler(logits).shape == (2, 1)
+
+        expected[expected < 0.2 * expected.amax(-1, keepdim=True)] = 0
+        expected /= expected.sum(-1, keepdim=True)
+        sampler = Sampler(temperature=0.7, min_p=0.2)
+        assert torch.allclose(sampler.probs(logits), expected, atol=1e-6)
+        generator = torch.Generator().manual_seed(0)
+        for _ in range(100):
+            res = sampler(logits, generator)
+            assert (expected.gather(1, res) > 0).all()
+
+    def test_reuses_buffers(self):
+        sampler = Sampler(top_k=10, top_p=0.9)
+        sampler(torch.randn(3, 100))
+        ptr = sampler._weights.data_ptr()
+        sampler(torch.randn(3, 100))
+        assert sampler._weights.data_ptr() == ptr
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,52 +1,213 @@
 # A file to manage reading from and writing to my makeshift "record" format.
-# All tokens are stored as 2-byte integers. The record file is nothing but a
-# sequence of these integers. SBIFF stands for "Sixteen Bit Integers File
-# Format".
+# SBIFF stands for "Sixteen Bit Integers File Format". The record file is a
+# sequence of fixed width unsigned integers (tokens), optionally preceded by a
+# header.
+#
+# Files written by Create start with a HEADER_SIZE byte header (see Header) that
+# records the width (2 or 4 bytes) and byte order of the ints as well as the
+# number of ints and docs in the file. Files without one (the original format,
+# and what AppendInts makes of a file that doesn't exist yet) are read as
+# big-endian 16-bit ints. New files are little-endian by default (see
+# consts.SBIFF_BYTEORDER) so ReadArray can memmap them without byte swaps on x86.
+#
+# Convert can also write a read-only, block-compressed variant: fixed size
+# blocks of ints compressed with zlib, followed by an index of where each block
+# starts. BlockReader reads windows from these by decompressing only the blocks
+# they touch. The other readers here don't read them.
 
+from dataclasses import dataclass
 import os
 import struct
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import random
 import collections
+import functools
+import zlib
+
+import numpy as np
 
 
 _INT_SIZE = struct.calcsize("H")
 
+MAGIC = b"SBIF"
+VERSION = 1
+# magic, version, width, byte order, pad, num ints, num docs, reserved. Padded to
+# 32 bytes so the ints stay aligned for any width.
+_HEADER_FORMAT = "<4sBBcxQQ8x"
+HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_WIDTH_TO_CODE = {2: "H", 4: "I"}
+
+COMPRESSED_MAGIC = b"SBIZ"
+# magic, version, width, byte order, codec ("z" for zlib), ints per block, num
+# ints, num docs, num blocks, offset of the block index, reserved.
+_COMPRESSED_HEADER_FORMAT = "<4sBBccIQQQQ4x"
+_COMPRESSED_HEADER_SIZE = struct.calcsize(_COMPRESSED_HEADER_FORMAT)
+
+
+@dataclass
+class Header:
+    width: int = _INT_SIZE
+    # ">" or "<" as in struct.
+    byteorder: str = ">"
+    num_ints: int = 0
+    # Unknown for legacy files.
+    num_docs: Optional[int] = None
+    # 0 for legacy files.
+    version: int = 0
+    # The number of ints per block of a block-compressed file, otherwise 0.
+    block_ints: int = 0
+
+    @property
+    def data_offset(self) -> int:
+        return HEADER_SIZE if self.version else 0
+
+    def Format(self, n: int) -> str:
+        return self.byteorder + _WIDTH_TO_CODE[self.width] * n
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(f"{self.byteorder}u{self.width}")
+
+
+def WidthFor(max_int: int) -> int:
+    """The smallest supported width that can store ints up to `max_int`."""
+    if max_int < 2**16:
+        return 2
+    if max_int < 2**32:
+        return 4
+    raise ValueError(f"{max_int} doesn't fit in any SBIFF width.")
+
+
+def Create(file_path: str, width: int = _INT_SIZE, byteorder: str = ">"):
+    """Creates (or empties) a headered file. AppendInts and the readers follow
+    its width and byte order from then on."""
+    assert width in _WIDTH_TO_CODE, width
+    assert byteorder in ("<", ">"), byteorder
+    if os.path.dirname(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as f:
+        _WriteHeader(f, Header(width, byteorder, 0, 0, VERSION))
+
+
+def _WriteHeader(f, header: Header):
+    f.seek(0)
+    f.write(
+        struct.pack(
+            _HEADER_FORMAT,
+            MAGIC,
+            header.version,
+            header.width,
+            header.byteorder.encode(),
+            header.num_ints,
+            header.num_docs,
+        )
+    )
+
+
+def _ReadHeader(f, allow_compressed=False) -> Header:
+    """Reads the header of the open file and leaves it at the first int."""
+    f.seek(0)
+    b = f.read(HEADER_SIZE)
+    if b[: len(COMPRESSED_MAGIC)] == COMPRESSED_MAGIC:
+        if not allow_compressed:
+            raise ValueError(f"{f.name} is block-compressed. Read it with BlockReader.")
+        f.seek(0)
+        return _UnpackCompressedHeader(f.read(_COMPRESSED_HEADER_SIZE))[0]
+    # NOTE: A legacy file whose first two ints are 21314, 18758 would look like
+    # a header, but those are past every vocab size we've used with them.
+    if len(b) < HEADER_SIZE or b[: len(MAGIC)] != MAGIC:
+        f.seek(0, os.SEEK_END)
+        num_ints = f.tell() // _INT_SIZE
+        f.seek(0)
+        return Header(num_ints=num_ints)
+    _, version, width, byteorder, num_ints, num_docs = struct.unpack(_HEADER_FORMAT, b)
+    if version > VERSION:
+        raise ValueError(f"Unsupported SBIFF version {version} in {f.name}.")
+    return Header(width, byteorder.decode(), num_ints, num_docs, version)
+
+
+def ReadHeader(file_path: str) -> Header:
+    with open(file_path, "rb") as f:
+        return _ReadHeader(f, allow_compressed=True)
+
+
+def _UnpackCompressedHeader(b: bytes) -> Tuple[Header, int, int]:
+    """Returns the header, number of blocks and offset of the block index."""
+    (
+        _,
+        version,
+        width,
+        byteorder,
+        codec,
+        block_ints,
+        num_ints,
+        num_docs,
+        num_blocks,
+        index_offset,
+    ) = struct.unpack(_COMPRESSED_HEADER_FORMAT, b)
+    if version > VERSION or codec != b"z":
+        raise ValueError(f"Unsupported compressed SBIFF ({version}, {codec}).")
+    header = Header(width, byteorder.decode(), num_ints, num_docs, version, block_ints)
+    return header, num_blocks, index_offset
+
+
+def AppendInts(file_path: str, ints: List[int], num_docs: int = 0):
+    """Appends `ints`, which hold `num_docs` docs (only counted in headered
+    files)."""
+    if not os.path.exists(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "ab") as f:
+            f.write(struct.pack(">" + "H" * len(ints), *ints))
+        return
+    with open(file_path, "r+b") as f:
+        header = _ReadHeader(f)
+        data = struct.pack(header.Format(len(ints)), *ints)
+        f.seek(0, os.SEEK_END)
+        f.write(data)
+        if header.version:
+            header.num_ints += len(ints)
+            header.num_docs += num_docs
+            _WriteHeader(f, header)
+
 
-def AppendInts(file_path: str, ints: List[int]):
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "ab") as f:
-        f.write(struct.pack(">" + "H" * len(ints), *ints))
+def _Unpack(header: Header, b: bytes) -> List[int]:
+    return list(struct.unpack(header.Format(len(b) // header.width), b))
 
 
 def ReadAllInts(file_path: str) -> List[int]:
     with open(file_path, "rb") as f:
+        header = _ReadHeader(f)
         b = f.read()
-    return list(struct.unpack(">" + "H" * (len(b) // _INT_SIZE), b))
+    return _Unpack(header, b)
 
 
-# NOTE: n_offset is in terms of 2-byte integers, not bytes. n_offset=3 means
+# NOTE: n_offset is in terms of integers, not bytes. n_offset=3 means
 # we'll start on the 3rd number (0 index) i.e. there will be 3 numbers that
 # are skipped.
 def ReadNInts(file_path: str, n: int, n_offset=0) -> List[int]:
     with open(file_path, "rb") as f:
-        f.seek(n_offset * _INT_SIZE)
-        b = f.read(n * _INT_SIZE)
-    if len(b) < n * _INT_SIZE:
+        header = _ReadHeader(f)
+        f.seek(header.data_offset + n_offset * header.width)
+        b = f.read(n * header.width)
+    if len(b) < n * header.width:
         raise ValueError("File does not contain enough data from the offset.")
-    return list(struct.unpack(">" + "H" * n, b))
+    return _Unpack(header, b)
 
 
 # Similar to ReadNInts but doesn't raise an error if there's not enough data.
 def ReadUpToNInts(file_path: str, n: int, n_offset=0) -> List[int]:
     with open(file_path, "rb") as f:
-        f.seek(n_offset * _INT_SIZE)
-        b = f.read(n * _INT_SIZE)
-    return list(struct.unpack(">" + "H" * (len(b) // _INT_SIZE), b))
+        header = _ReadHeader(f)
+        start = header.data_offset + n_offset * header.width
+        # Don't ask read() for a huge buffer when n is just an upper bound.
+        size = f.seek(0, os.SEEK_END)
+        f.seek(start)
+        b = f.read(max(min(n * header.width, size - start), 0))
+    return _Unpack(header, b)
 
 
 def ReadRandomNInts(file_path: str, n: int, end=-1) -> List[int]:
-    num_ints_in_file = os.path.getsize(file_path) // _INT_SIZE
+    num_ints_in_file = CountInts(file_path)
     end = num_ints_in_file if end == -1 else end
     n_offset = random.randint(0, end - n)
     return ReadNInts(file_path, n, n_offset)
@@ -56,21 +217,24 @@ def ReadUntilInt(file_path: str, i: int, n_offset=0) -> Tuple[List[int], int]:
     chunk_size = 4096
     ints = []
     overall_index = n_offset
-    needle = struct.pack(">" + "H", i)
     with open(file_path, "rb") as f:
-        f.seek(n_offset * _INT_SIZE)
+        header = _ReadHeader(f)
+        width = header.width
+        needle = struct.pack(header.Format(1), i)
+        f.seek(header.data_offset + n_offset * width)
         while True:
             chunk = f.read(chunk_size)
             b_index = chunk.find(needle)
+            # Skip matches that straddle two ints.
+            while b_index != -1 and b_index % width:
+                b_index = chunk.find(needle, b_index + 1)
             if b_index != -1:
                 chunk = chunk[:b_index]
-                ints.extend(
-                    list(struct.unpack(">" + "H" * (b_index // _INT_SIZE), chunk))
-                )
-                return ints, overall_index + (b_index // 2)
+                ints.extend(_Unpack(header, chunk))
+                return ints, overall_index + (b_index // width)
 
-            ints.extend(struct.unpack(">" + "H" * (len(chunk) // _INT_SIZE), chunk))
-            overall_index += len(chunk) // _INT_SIZE
+            ints.extend(_Unpack(header, chunk))
+            overall_index += len(chunk) // width
 
             if len(chunk) < chunk_size:
                 break
@@ -88,7 +252,161 @@ def ReadIntsAfter(file_path: str, i: int, n=1000):
         break
 
 
-# Count the number of 2-byte integers in the file.
+# Count the number of integers in the file.
 def CountInts(file_path: str) -> int:
     with open(file_path, "rb") as f:
-        return len(f.read()) // _INT_SIZE
+        header = _ReadHeader(f)
+        f.seek(0, os.SEEK_END)
+        return (f.tell() - header.data_offset) // header.width
+
+
+# Cut the file down to its first `n` integers (and `num_docs` docs).
+def TruncateInts(file_path: str, n: int, num_docs: Optional[int] = None):
+    with open(file_path, "r+b") as f:
+        header = _ReadHeader(f)
+        f.truncate(header.data_offset + n * header.width)
+        if header.version:
+            header.num_ints = n
+            if num_docs is not None:
+                header.num_docs = num_docs
+            _WriteHeader(f, header)
+
+
+def ReadArray(file_path: str) -> np.ndarray:
+    """Maps the ints of the file into a read-only numpy array of the file's
+    dtype without reading it. Use astype to get native ints out of it."""
+    with open(file_path, "rb") as f:
+        header = _ReadHeader(f)
+    n = CountInts(file_path)
+    if n == 0:
+        return np.empty(0, dtype=header.dtype)
+    return np.memmap(
+        file_path, dtype=header.dtype, mode="r", offset=header.data_offset, shape=(n,)
+    )
+
+
+def _Chunks(file_path: str, chunk_size: int):
+    """Yields the ints of any kind of SBIFF file as arrays of up to chunk_size."""
+    if ReadHeader(file_path).block_ints:
+        arr = BlockReader(file_path, cache_blocks=1)
+        read = arr.Read
+    else:
+        arr = ReadArray(file_path)
+        read = lambda i, n: arr[i : i + n]
+    for i in range(0, len(arr), chunk_size):
+        yield read(i, min(chunk_size, len(arr) - i))
+
+
+def Convert(
+    src: str,
+    dst: str,
+    width: Optional[int] = None,
+    byteorder: str = "<",
+    doc_end_int: Optional[int] = None,
+    block_ints: int = 0,
+    chunk_size: int = 2**24,
+):
+    """Rewrites `src` (which may be legacy or compressed) as a headered file at
+    `dst`, which can be `src`. Keeps the width unless one is given. Legacy files
+    don't know how many docs they hold, so they're counted as occurrences of
+    `doc_end_int` if it's given.
+
+    With `block_ints`, `dst` is block-compressed with that many ints per block.
+    Smaller blocks make random reads cheaper and compress worse.
+    """
+    header = ReadHeader(src)
+    width = width or header.width
+    dtype = np.dtype(f"{byteorder}u{width}")
+    count_docs = header.num_docs is None
+    num_ints, num_docs = 0, header.num_docs or 0
+    offsets = []
+
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(bytes(_COMPRESSED_HEADER_SIZE if block_ints else HEADER_SIZE))
+            for chunk in _Chunks(src, block_ints or chunk_size):
+                if width < header.width and chunk.max() >= 2 ** (8 * width):
+                    raise ValueError(f"{src} has ints that don't fit in {width} bytes.")
+                if count_docs and doc_end_int is not None:
+                    num_docs += int(np.count_nonzero(chunk == doc_end_int))
+                num_ints += len(chunk)
+                data = chunk.astype(dtype).tobytes()
+                if block_ints:
+                    offsets.append(f.tell())
+                    data = zlib.compress(data)
+                f.write(data)
+
+            header = Header(width, byteorder, num_ints, num_docs, VERSION, block_ints)
+            if not block_ints:
+                _WriteHeader(f, header)
+            else:
+                offsets.append(f.tell())
+                f.write(np.array(offsets, dtype="<u8").tobytes())
+                f.seek(0)
+                f.write(
+                    struct.pack(
+                        _COMPRESSED_HEADER_FORMAT,
+                        COMPRESSED_MAGIC,
+                        header.version,
+                        header.width,
+                        header.byteorder.encode(),
+                        b"z",
+                        header.block_ints,
+                        header.num_ints,
+                        header.num_docs,
+                        len(offsets) - 1,
+                        offsets[-1],
+                    )
+                )
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, dst)
+
+
+class BlockReader:
+    """Reads windows of ints from a block-compressed file (see Convert).
+
+    Each read decompresses only the blocks it touches, and the last
+    `cache_blocks` decompressed blocks are kept in an LRU so nearby reads don't
+    decompress them again.
+    """
+
+    def __init__(self, file_path: str, cache_blocks: int = 64):
+        fd = os.open(file_path, os.O_RDONLY)
+        b = os.pread(fd, _COMPRESSED_HEADER_SIZE, 0)
+        if b[: len(COMPRESSED_MAGIC)] != COMPRESSED_MAGIC:
+            os.close(fd)
+            raise ValueError(f"{file_path} isn't block-compressed.")
+        self._fd = fd
+        self.header, num_blocks, index_offset = _UnpackCompressedHeader(b)
+        index = os.pread(self._fd, 8 * (num_blocks + 1), index_offset)
+        self._offsets = np.frombuffer(index, dtype="<u8").tolist()
+        self._Block = functools.lru_cache(maxsize=cache_blocks)(self._DecodeBlock)
+
+    def __len__(self) -> int:
+        return self.header.num_ints
+
+    def __del__(self):
+        if hasattr(self, "_fd"):
+            os.close(self._fd)
+
+    def _DecodeBlock(self, i: int) -> np.ndarray:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        b = zlib.decompress(os.pread(self._fd, end - start, start))
+        return np.frombuffer(b, dtype=self.header.dtype)
+
+    def Read(self, n_offset: int, n: int) -> np.ndarray:
+        """Like ReadNInts, but returns a (read-only) array of the file's dtype."""
+        if n_offset < 0 or n_offset + n > len(self):
+            raise ValueError("File does not contain enough data from the offset.")
+        if n == 0:
+            return np.empty(0, dtype=self.header.dtype)
+        block_ints = self.header.block_ints
+        first, last = n_offset // block_ints, (n_offset + n - 1) // block_ints
+        start = n_offset - first * block_ints
+        if first == last:
+            return self._Block(first)[start : start + n]
+        blocks = [self._Block(i) for i in range(first, last + 1)]
+        return np.concatenate(blocks)[start : start + n]
@@ -9,6 +9,9 @@ import struct
 import unittest
 import util
 
+import numpy as np
+
+import sbiff
 from sbiff import (
     AppendInts,
     ReadAllInts,
@@ -113,5 +116,152 @@ class TestSbiff(unittest.TestCase):
             assert CountInts(file_path) == 5
 
 
+class TestSbiffHeader(unittest.TestCase):
+
+    def test_reads_headered_16_bit(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            sbiff.Create(file_path)
+            AppendInts(file_path, [1, 2, 3], num_docs=1)
+            AppendInts(file_path, [4, 5], num_docs=1)
+            assert os.path.getsize(file_path) == sbiff.HEADER_SIZE + 10
+            assert ReadAllInts(file_path) == [1, 2, 3, 4, 5]
+            assert ReadNInts(file_path, 2, n_offset=3) == [4, 5]
+            assert CountInts(file_path) == 5
+            header = sbiff.ReadHeader(file_path)
+            assert (header.width, header.num_ints, header.num_docs) == (2, 5, 2)
+
+    def test_reads_headered_32_bit(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            sbiff.Create(file_path, width=sbiff.WidthFor(2**16))
+            ints = [2**16, 1, 2**32 - 1, 7, 0x00070000, 5]
+            AppendInts(file_path, ints, num_docs=1)
+            assert ReadAllInts(file_path) == ints
+            assert ReadUpToNInts(file_path, 10, n_offset=4) == ints[4:]
+            assert CountInts(file_path) == 6
+            # The bytes of 0x00070000 contain 7 but not at an int boundary.
+            assert ReadUntilInt(file_path, 7, n_offset=4) == ([0x00070000, 5], -1)
+            assert ReadUntilInt(file_path, 7) == (ints[:3], 3)
+            with self.assertRaises(struct.error):
+                AppendInts(file_path, [2**32])
+
+    def test_truncates_headered(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            sbiff.Create(file_path, width=4)
+            AppendInts(file_path, [1, 2, 3], num_docs=1)
+            AppendInts(file_path, [4, 5], num_docs=1)
+            sbiff.TruncateInts(file_path, 3, num_docs=1)
+            assert ReadAllInts(file_path) == [1, 2, 3]
+            header = sbiff.ReadHeader(file_path)
+            assert (header.num_ints, header.num_docs) == (3, 1)
+
+    def test_legacy_files_are_16_bit(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            with open(file_path, "wb") as f:
+                f.write(struct.pack(">HHH", 1, 300, 2))
+            header = sbiff.ReadHeader(file_path)
+            assert (header.version, header.width, header.byteorder) == (0, 2, ">")
+            assert ReadAllInts(file_path) == [1, 300, 2]
+            AppendInts(file_path, [3])
+            assert ReadAllInts(file_path) == [1, 300, 2, 3]
+
+    def test_reads_little_endian(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            sbiff.Create(file_path, byteorder="<")
+            AppendInts(file_path, [1, 300, 2, 300], num_docs=1)
+            with open(file_path, "rb") as f:
+                f.seek(sbiff.HEADER_SIZE)
+                assert f.read(4) == struct.pack("<HH", 1, 300)
+            assert ReadAllInts(file_path) == [1, 300, 2, 300]
+            assert ReadUntilInt(file_path, 2) == ([1, 300], 2)
+            arr = sbiff.ReadArray(file_path)
+            assert arr.dtype == np.dtype("<u2")
+            assert arr.tolist() == [1, 300, 2, 300]
+
+    def test_converts_legacy_to_little_endian(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            ints = [1, 300, 9, 4, 9, 2**16 - 1, 9]
+            AppendInts(file_path, ints)
+            assert sbiff.ReadArray(file_path).tolist() == ints
+            sbiff.Convert(file_path, file_path, doc_end_int=9, chunk_size=3)
+            header = sbiff.ReadHeader(file_path)
+            assert (header.version, header.width, header.byteorder) == (1, 2, "<")
+            assert (header.num_ints, header.num_docs) == (7, 3)
+            assert ReadAllInts(file_path) == ints
+            assert os.listdir(dir_path) == ["test.bin"]
+
+            sbiff.Convert(file_path, file_path, width=4, byteorder=">")
+            header = sbiff.ReadHeader(file_path)
+            assert (header.width, header.byteorder, header.num_docs) == (4, ">", 3)
+            assert ReadAllInts(file_path) == ints
+
+    def test_wont_convert_to_narrower_width_that_overflows(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            sbiff.Create(file_path, width=4)
+            AppendInts(file_path, [1, 2**16])
+            with self.assertRaises(ValueError):
+                sbiff.Convert(file_path, file_path, width=2)
+
+
+class TestCompressedSbiff(unittest.TestCase):
+
+    def test_reads_windows_across_blocks(self):
+        with util.GetTempDir() as dir_path:
+            raw = os.path.join(dir_path, "raw.bin")
+            compressed = os.path.join(dir_path, "compressed.bin")
+            ints = [i % 7 for i in range(1000)] + [9]
+            AppendInts(raw, ints)
+            sbiff.Convert(raw, compressed, doc_end_int=9, block_ints=64)
+            header = sbiff.ReadHeader(compressed)
+            assert (header.block_ints, header.num_ints, header.num_docs) == (
+                64,
+                1001,
+                1,
+            )
+            assert os.path.getsize(compressed) < os.path.getsize(raw)
+
+            reader = sbiff.BlockReader(compressed)
+            assert len(reader) == 1001
+            for n_offset, n in [(0, 1001), (0, 64), (63, 2), (100, 300), (1000, 1)]:
+                window = reader.Read(n_offset, n).tolist()
+                assert window == ints[n_offset : n_offset + n]
+            assert reader.Read(5, 0).tolist() == []
+            with self.assertRaises(ValueError):
+                reader.Read(1000, 2)
+
+    def test_caches_decoded_blocks(self):
+        with util.GetTempDir() as dir_path:
+            raw = os.path.join(dir_path, "raw.bin")
+            compressed = os.path.join(dir_path, "compressed.bin")
+            AppendInts(raw, list(range(256)))
+            sbiff.Convert(raw, compressed, block_ints=16)
+            reader = sbiff.BlockReader(compressed, cache_blocks=2)
+            for n_offset in [0, 8, 16, 0, 40]:
+                reader.Read(n_offset, 8)
+            info = reader._Block.cache_info()
+            assert (info.hits, info.misses) == (2, 3)
+
+    def test_round_trips_and_only_block_reader_reads_it(self):
+        with util.GetTempDir() as dir_path:
+            file_path = os.path.join(dir_path, "test.bin")
+            ints = [1, 2**16 + 5, 3, 4, 5]
+            sbiff.Create(file_path, width=4, byteorder=">")
+            AppendInts(file_path, ints, num_docs=2)
+            sbiff.Convert(file_path, file_path, block_ints=2)
+            for read in [ReadAllInts, CountInts, sbiff.ReadArray]:
+                with self.assertRaises(ValueError):
+                    read(file_path)
+            sbiff.Convert(file_path, file_path)
+            header = sbiff.ReadHeader(file_path)
+            assert (header.block_ints, header.width, header.num_docs) == (0, 4, 2)
+            assert ReadAllInts(file_path) == ints
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,43 +1,106 @@
 import json
-from typing import List
+from typing import Dict, List, Optional
 
+import numpy as np
+
+import bpe
 import consts
 
 
 class Tokens:
-    def __init__(self, base_stoi, merges):
+    """The base vocab and the BPE merges on top of it.
+
+    Alongside these we keep, for every token, what it expands to in base tokens:
+    `first_base`/`last_base` (its first/last base token), `first_tag`/`last_tag`
+    (its first/last base tag token, -1 if it has none) and `lengths` (how many
+    base tokens it expands to). Merges only ever combine earlier tokens, so
+    these are filled in one pass in merge order.
+
+    `start_counts` is how many docs of the corpus begin with each token, which
+    prep saves to weight the choice of start token.
+    """
+
+    def __init__(self, base_stoi, merges, start_counts: Optional[Dict] = None):
         self._base_stoi = base_stoi
         self._base_itos = {v: k for k, v in base_stoi.items()}
         self._merges = merges
         self._merges_inverted = {v: k for k, v in merges}
         self._doc_end_token = self._base_stoi[consts.DOC_END_TOKEN]
+        self._start_counts = (
+            None
+            if start_counts is None
+            else {int(k): v for k, v in start_counts.items()}
+        )
+        self._start = None
+        self._starts = None
+        self._start_weights = None
+        self._BuildExpansions()
+
+    def _BuildExpansions(self):
+        size = self.Size()
+        first, last, lengths = list(range(size)), list(range(size)), [1] * size
+        tags = [t if self.TokenIsTag(t) else -1 for t in range(self.BaseSize())]
+        first_tag = tags + [-1] * (size - len(tags))
+        last_tag = list(first_tag)
+        # Lists are quicker than numpy arrays for this loop.
+        for (a, b), c in self._merges:
+            first[c], last[c] = first[a], last[b]
+            lengths[c] = lengths[a] + lengths[b]
+            first_tag[c] = first_tag[a] if first_tag[a] != -1 else first_tag[b]
+            last_tag[c] = last_tag[b] if last_tag[b] != -1 else last_tag[a]
+        self.first_base, self.last_base = np.array(first), np.array(last)
+        self.lengths = np.array(lengths)
+        self.first_tag, self.last_tag = np.array(first_tag), np.array(last_tag)
 
     def Save(self, path):
+        data = {"stoi": self._base_stoi, "merges": self._merges}
+        if self._start_counts is not None:
+            data["start_counts"] = self._start_counts
         with open(path, "w") as f:
-            json.dump({"stoi": self._base_stoi, "merges": self._merges}, f)
+            json.dump(data, f)
 
     def Size(self):
         return len(self._base_stoi) + len(self._merges)
 
+    def BaseSize(self):
+        return len(self._base_stoi)
+
+    def GetDocEndToken(self) -> int:
+        return self._doc_end_token
+
+    def GetStartOrDie(self) -> int:
+        """The base start token ("score-partwise")."""
+        if self._start is None:
+            start_base_token = -1
+            for k, v in self._base_stoi.items():
+                if "score-partwise" in k:
+                    start_base_token = v
+            assert start_base_token != -1
+            self._start = start_base_token
+        return self._start
+
     # Because of MusicXML format, we know the base start token will always be
     # merged a lot with other tokens. So let's return all BPE'ed tokens that
     # begin with the start token ("score-partwise"). A way to avoid this in the
     # future would be to always keep the first base token separate.
-    def GetStartsOrDie(self):
-        # Find start base token.
-        start_base_token = -1
-        for k, v in self._base_stoi.items():
-            if "score-partwise" in k:
-                start_base_token = v
-        assert start_base_token != -1
-
-        # Find all BPE'ed tokens that begin with the start base token.
-        res = []
-        for k in self._merges_inverted.keys():
-            translated = self.Translate(k)
-            if translated[0] == start_base_token:
-                res.append(k)
-        return res
+    def GetStartsOrDie(self) -> List[int]:
+        if self._starts is None:
+            num_base = self.BaseSize()
+            start = self.GetStartOrDie()
+            starts = np.flatnonzero(self.first_base[num_base:] == start) + num_base
+            # Without merges the base token is the only start.
+            self._starts = starts.tolist() or [start]
+        return self._starts
+
+    def GetStartWeights(self) -> List[int]:
+        """How many docs in the corpus begin with each of GetStartsOrDie(), or all
+        1s if the counts weren't saved (or none of them begin one)."""
+        if self._start_weights is None:
+            starts = self.GetStartsOrDie()
+            counts = self._start_counts or {}
+            weights = [counts.get(s, 0) for s in starts]
+            self._start_weights = weights if any(weights) else [1] * len(starts)
+        return self._start_weights
 
     def Translate(self, tok: int) -> List[int]:
         if tok in self._base_stoi:
@@ -54,11 +117,28 @@ class Tokens:
                 stack.append(a)
         return res
 
+    def EncodeStrs(self, strs: List[str]) -> List[int]:
+        """Encodes base token strings (e.g. from util.GetTokensFromXml) the way
+        prep encodes the training data, minus the doc end token. Strings that
+        aren't in the vocab become UNK_TOKEN if the vocab has it, except tags.
+
+        Raises:
+            ValueError: If some of the strings aren't in the base vocab (and
+                there's no UNK_TOKEN, or they're tags).
+        """
+        unk = self._base_stoi.get(consts.UNK_TOKEN)
+        unknown = sorted({s for s in strs if s not in self._base_stoi})
+        if unknown and (unk is None or any(Tokens.IsTagStr(s) for s in unknown)):
+            raise ValueError(f"Tokens not in the vocab: {unknown[:10]}")
+        ints = [self._base_stoi.get(s, unk) for s in strs]
+        return bpe.Encode(ints, self._merges)
+
     def TokenIsTag(self, tok: int) -> bool:
-        return (
-            self._base_itos.get(tok, "").startswith("<")
-            and not tok == self._doc_end_token
-        )
+        return Tokens.IsTagStr(self._base_itos.get(tok, ""))
+
+    @staticmethod
+    def IsTagStr(s: str) -> bool:
+        return s.startswith("<") and s not in (consts.DOC_END_TOKEN, consts.UNK_TOKEN)
 
     def GetStr(self, tok: int) -> str:
         return self._base_itos[tok]
@@ -74,4 +154,4 @@ class Tokens:
     def Load(path) -> "Tokens":
         with open(path, "r") as f:
             data = json.load(f)
-            return Tokens(data["stoi"], data["merges"])
+            return Tokens(data["stoi"], data["merges"], data.get("start_counts"))
@@ -5,6 +5,7 @@
 # https://opensource.org/licenses/MIT.
 
 import os
+import random
 import unittest
 import util
 import consts
@@ -32,6 +33,44 @@ class TestTokens(unittest.TestCase):
         tokens = Tokens(base_stoi, merges)
         assert tokens.GetStartOrDie() == 2
 
+    def test_finds_merged_starts(self):
+        base_stoi = {"a": 0, "<score-partwise>": 1, "<b>": 2, consts.DOC_END_TOKEN: 3}
+        merges = [((1, 0), 4), ((0, 1), 5), ((4, 2), 6), ((2, 6), 7)]
+        tokens = Tokens(base_stoi, merges)
+        assert tokens.GetStartOrDie() == 1
+        assert tokens.GetStartsOrDie() == [4, 6]
+        # Without counts every start is as likely.
+        assert tokens.GetStartWeights() == [1, 1]
+        assert Tokens(base_stoi, []).GetStartsOrDie() == [1]
+
+    def test_saves_start_weights(self):
+        base_stoi = {"a": 0, "<score-partwise>": 1, consts.DOC_END_TOKEN: 2}
+        merges = [((1, 0), 3), ((3, 0), 4)]
+        tokens = Tokens(base_stoi, merges, start_counts={4: 7, 3: 2, 0: 5})
+        with util.GetTempDir() as dir_path:
+            path = os.path.join(dir_path, "tokens.json")
+            tokens.Save(path)
+            loaded = Tokens.Load(path)
+        assert loaded.GetStartsOrDie() == [3, 4]
+        assert loaded.GetStartWeights() == [2, 7]
+
+    def test_expansions_match_translate(self):
+        rng = random.Random(0)
+        base_stoi = {f"<t{i}>" if i % 3 else str(i): i for i in range(9)}
+        base_stoi[consts.DOC_END_TOKEN] = 9
+        merges = []
+        for c in range(10, 200):
+            merges.append(((rng.randrange(c), rng.randrange(c)), c))
+        tokens = Tokens(base_stoi, merges)
+        for tok in range(tokens.Size()):
+            seq = tokens.Translate(tok)
+            tags = [t for t in seq if tokens.TokenIsTag(t)] or [-1]
+            assert tokens.first_base[tok] == seq[0]
+            assert tokens.last_base[tok] == seq[-1]
+            assert tokens.lengths[tok] == len(seq)
+            assert tokens.first_tag[tok] == tags[0]
+            assert tokens.last_tag[tok] == tags[-1]
+
     def test_translate(self):
         base_stoi = {"a": 0, "b": 1, "c": 2, consts.DOC_END_TOKEN: 3}
         merges = [((0, 1), 4), ((4, 3), 5), ((5, 1), 6)]
@@ -41,6 +80,22 @@ class TestTokens(unittest.TestCase):
         assert tokens.Translate(5) == [0, 1, 3]
         assert tokens.Translate(6) == [0, 1, 3, 1]
 
+    def test_encode_strs(self):
+        base_stoi = {"a": 0, "b": 1, "c": 2, consts.DOC_END_TOKEN: 3}
+        merges = [((0, 1), 4), ((4, 2), 5)]
+        tokens = Tokens(base_stoi, merges)
+        assert tokens.EncodeStrs(["a", "b", "c", "a", "b", "a"]) == [5, 4, 0]
+        with self.assertRaises(ValueError):
+            tokens.EncodeStrs(["a", "d"])
+        # Unless there's an UNK token.
+        base_stoi = {"a": 0, "b": 1, consts.DOC_END_TOKEN: 2, consts.UNK_TOKEN: 3}
+        tokens = Tokens(base_stoi, [])
+        assert tokens.EncodeStrs(["a", "d", "b"]) == [0, 3, 1]
+        assert not tokens.TokenIsTag(3)
+        # But not for tags.
+        with self.assertRaises(ValueError):
+            tokens.EncodeStrs(["a", "<d>"])
+
     def test_token_is_tag(self):
         base_stoi = {
             "<hey>": 0,
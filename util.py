@@ -6,6 +6,7 @@
 
 from contextlib import contextmanager
 import gzip
+from itertools import islice
 import logging
 import os
 import tempfile
@@ -13,6 +14,7 @@ from typing import List, Optional, Union, Tuple
 import xml.etree.ElementTree as ET
 import math
 import shutil
+import sys
 
 import consts
 
@@ -55,7 +57,76 @@ def ReadFileAsText(path: str) -> Optional[str]:
         return ""
 
 
+def ReadFileAsBytes(path: str) -> bytes:
+    try:
+        if path.endswith(".gz"):
+            with gzip.open(path, "rb") as f:
+                return f.read()
+        with open(path, "rb") as f:
+            return f.read()
+    except Exception as e:
+        logging.debug(f"Error reading file ({path}): {e}")
+        return b""
+
+
+def GetLxml():
+    """Returns the lxml.etree module if consts.XML_PARSER allows it and it's
+    installed, otherwise None."""
+    assert consts.XML_PARSER in ("auto", "lxml", "etree"), consts.XML_PARSER
+    if consts.XML_PARSER == "etree":
+        return None
+    try:
+        from lxml import etree
+    except ImportError:
+        if consts.XML_PARSER == "lxml":
+            raise
+        return None
+    return etree
+
+
+def XmlParserBackend() -> str:
+    """The name of the backend ParseXml uses, "lxml" or "etree"."""
+    return "etree" if GetLxml() is None else "lxml"
+
+
+def LxmlParserOptions() -> dict:
+    # Like the standard library: no comments, processing instructions or
+    # external entities. libxml2's size limits stay on unless
+    # consts.XML_HUGE_TREE.
+    return dict(
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities="internal",
+        no_network=True,
+        huge_tree=consts.XML_HUGE_TREE,
+    )
+
+
+_lxml_parser = None
+
+
+def _LxmlParser(etree):
+    global _lxml_parser
+    if _lxml_parser is None:
+        _lxml_parser = etree.XMLParser(**LxmlParserOptions())
+    return _lxml_parser
+
+
 def ParseXml(path: str) -> Optional[ET.Element]:
+    """Parses the file with the backend in consts.XML_PARSER. lxml elements
+    have the ElementTree API that the rest of this module uses.
+
+    lxml reads the bytes and honors the encoding declaration while the standard
+    library path decodes as UTF-8, so only non-UTF-8 files can differ.
+    """
+    etree = GetLxml()
+    if etree is not None:
+        try:
+            return etree.fromstring(ReadFileAsBytes(path), _LxmlParser(etree))
+        except etree.XMLSyntaxError as e:
+            logging.debug(f"Error parsing xml ({path}): {e}")
+            return None
+
     xml = ReadFileAsText(path)
     try:
         return ET.fromstring(xml)
@@ -64,65 +135,198 @@ def ParseXml(path: str) -> Optional[ET.Element]:
         return None
 
 
-def GetTokensFromXmlRoot(root) -> List[str]:
-    if root is None:
-        return []
+class _Tokenizer:
+    """The filters from consts as frozensets plus memo tables for the strings
+    we produce, so each distinct open tag or text token is formatted (and
+    TranslateNum'd) once and shared by every occurrence."""
+
+    def __init__(self):
+        self.kept_tags = frozenset(
+            consts.ALLOWED_TAG_NAMES - consts.TAG_NAMES_TO_IGNORE
+        )
+        self.ignored_attributes = frozenset(consts.ATTRIBUTES_TO_IGNORE)
+        self._bare_tags = {}
+        self._tags = {}
+        # The attribute-less open tag of every kept tag, which doubles as the
+        # kept check in Tokens.
+        self._kept_bare_tags = {t: self.OpenTag(t, ()) for t in self.kept_tags}
+        # Open tags by tag and unfiltered attributes, which skips filtering the
+        # attributes of the elements we've seen before.
+        self._raw_tags = {}
+        self._texts = {}
+
+    def OpenTag(self, tag: str, attrib) -> str:
+        """`attrib` is a mapping or a sequence of (name, value) pairs."""
+        if not attrib:
+            res = self._bare_tags.get(tag)
+            if res is None:
+                res = self._bare_tags[tag] = sys.intern(f"<{tag}>")
+            return res
+        # Element.attrib is a dict, or a dict-like _Attrib with lxml.
+        items = attrib.items() if hasattr(attrib, "items") else attrib
+        ignored = self.ignored_attributes
+        key = (tag, tuple((k, v) for k, v in items if k not in ignored))
+        res = self._tags.get(key)
+        if res is None:
+            attrs = "".join(f' {k}="{v}"' for k, v in key[1])
+            res = self._tags[key] = sys.intern(f"<{tag}{attrs}>")
+        return res
+
+    def Text(self, text: str) -> str:
+        """Returns the token for the raw text of an element, or "" if it's blank."""
+        res = self._texts.get(text)
+        if res is None:
+            res = text.strip()
+            if res.lstrip("-").isnumeric():
+                res = str(TranslateNum(int(res)))
+            res = self._texts[text] = sys.intern(res)
+        return res
+
+    def _KeptNodes(self, root: ET.Element):
+        """Yields the root and every element whose ancestors below the root are
+        all kept, in document order (which is the order of the tokens)."""
+        kept = self.kept_tags
+        nodes = root.iter()
+        yield next(nodes)
+        # iter() walks the whole tree in C, so instead of walking it ourselves
+        # we skip the subtrees under elements we don't keep.
+        for node in nodes:
+            if node.tag not in kept:
+                _SkipSubtree(nodes, node)
+                continue
+            yield node
+
+    def Tokens(self, root: ET.Element) -> List[str]:
+        tokens = []
+        append = tokens.append
+        bare_tags, raw_tags, texts = self._kept_bare_tags, self._raw_tags, self._texts
+        nodes = root.iter()
+        # Same walk as _KeptNodes, inlined since this is the hot loop of prep.
+        for node in nodes:
+            tag = node.tag
+            tok = bare_tags.get(tag)
+            if tok is None and node is not root:
+                _SkipSubtree(nodes, node)
+                continue
+            # Inlined lookups for the common cases of OpenTag and Text.
+            # items() rather than attrib, which lxml builds a proxy object for.
+            items = node.items()
+            if items:
+                key = (tag, tuple(items))
+                tok = raw_tags.get(key)
+                if tok is None:
+                    tok = raw_tags[key] = self.OpenTag(tag, items)
+            elif tok is None:
+                tok = self.OpenTag(tag, items)
+            append(tok)
+            text = node.text
+            if text:
+                tok = texts.get(text)
+                if tok is None:
+                    tok = self.Text(text)
+                if tok:
+                    append(tok)
+        return tokens
+
+    def Elements(self, root: ET.Element) -> List[tuple]:
+        # Tuples are cheaper than lists for the GC. JSON turns them into lists.
+        return [
+            (
+                node.tag,
+                tuple(node.attrib.items()),
+                node.text.strip() if node.text else "",
+            )
+            for node in self._KeptNodes(root)
+        ]
+
+    def TokensFromElements(self, elements: List) -> List[str]:
+        tokens = []
+        append = tokens.append
+        for tag, attrib, text in elements:
+            append(self.OpenTag(tag, attrib))
+            if text:
+                append(self.Text(text))
+        return tokens
+
+
+def _SkipSubtree(nodes, node):
+    """Advances `nodes`, an iter() that just yielded `node`, past its subtree."""
+    n = sum(1 for _ in node.iter()) - 1
+    next(islice(nodes, n, n), None)
+
+
+_tokenizer = None
+_tokenizer_settings = None
+
+
+def _GetTokenizer() -> _Tokenizer:
+    """Returns a _Tokenizer for the current consts, which tests (and notebooks)
+    sometimes swap out."""
+    global _tokenizer, _tokenizer_settings
+    settings = (
+        consts.ALLOWED_TAG_NAMES,
+        consts.TAG_NAMES_TO_IGNORE,
+        consts.ATTRIBUTES_TO_IGNORE,
+        consts.WHITELISTED_NUMS,
+    )
+    if _tokenizer is None or any(
+        a is not b for a, b in zip(settings, _tokenizer_settings)
+    ):
+        _tokenizer, _tokenizer_settings = _Tokenizer(), settings
+    return _tokenizer
 
-    tokens = []
-    stack = [root]
 
-    while stack:
-        parent = stack.pop()
+def GetElementsFromXmlRoot(root) -> List[tuple]:
+    """Flattens the elements we keep into (tag, ((name, value), ...), text) in
+    token order. Attributes and text are left as they are in the XML, so this
+    is what's worth caching (see element_cache.py)."""
+    if root is None:
+        return []
+    return _GetTokenizer().Elements(root)
 
-        # Remove attributes we don't care about.
-        for name, _ in list(parent.attrib.items()):
-            if not KeepAttribute(name):
-                del parent.attrib[name]
 
-        # Get tokens for this node.
-        tokens.extend(GetTokens(parent))
+def GetTokensFromElements(elements: List) -> List[str]:
+    return _GetTokenizer().TokensFromElements(elements)
 
-        # Find children while removing certain ones we don't care about.
-        # Don't remove these while iterating otherwise the iterator will break.
-        # Iterate backwards to make sure we go left to right.
-        children_to_remove = []
-        for child in reversed(list(iter(parent))):
-            if KeepElement(child.tag):
-                stack.append(child)
-            else:
-                children_to_remove.append(child)
-        for child in children_to_remove:
-            parent.remove(child)
 
-    return tokens
+def GetTokensFromXmlRoot(root) -> List[str]:
+    # Doesn't modify the tree.
+    if root is None:
+        return []
+    return _GetTokenizer().Tokens(root)
 
 
-def GetUniqueTokens(path: str):
-    return set(GetTokensFromXml(path))
+def GetElementsFromXml(path: str, cache=None) -> List[tuple]:
+    """Like GetElementsFromXmlRoot(ParseXml(path)) but through an
+    element_cache.ElementCache if one is given."""
+    if cache is None:
+        return GetElementsFromXmlRoot(ParseXml(path))
+    key = cache.Key(path)
+    elements = cache.Get(key)
+    if elements is None:
+        elements = GetElementsFromXmlRoot(ParseXml(path))
+        cache.Put(key, elements)
+    return elements
 
 
-def GetTokensFromXml(path: str) -> List[str]:
-    return GetTokensFromXmlRoot(ParseXml(path))
+def GetTokensFromXml(path: str, cache=None) -> List[str]:
+    if cache is None:
+        return GetTokensFromXmlRoot(ParseXml(path))
+    return GetTokensFromElements(GetElementsFromXml(path, cache))
 
 
 def GetTokens(node: ET.Element) -> List[str]:
-    tokens = []
-    attrs = []
-    for k, v in list(node.attrib.items()):
-        attrs.append(f'{k}="{v}"')
-    attrs = " ".join(attrs)
-    attrs = " " + attrs if attrs else ""
     text = node.text.strip() if node.text else ""
-    children = iter(node)
-    if text or children:
-        n = f"<{node.tag}{attrs}>"
-        tokens.append(n)
-        if text:
-            if text.lstrip("-").isnumeric():
-                text = str(TranslateNum(int(text)))
-            tokens.append(text)
-    else:
-        tokens.append(f"<{node.tag}{attrs} />")
+    return GetTokensFromParts(node.tag, node.attrib, text)
+
+
+def GetTokensFromParts(tag: str, attrib, text: str) -> List[str]:
+    # NOTE: Every element gets an open tag (no "<tag />" tokens) because that's
+    # what the original version of this did with `iter(node)`, which is truthy.
+    tokenizer = _GetTokenizer()
+    tokens = [tokenizer.OpenTag(tag, attrib)]
+    if text:
+        tokens.append(tokenizer.Text(text))
     return tokens
 
 
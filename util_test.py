@@ -0,0 +1,177 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import gzip
+import json
+import os
+import random
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+import consts
+import util
+from benchmarks import synthetic
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+_XML = """<?xml version="1.0"?>
+<!DOCTYPE score-partwise>
+<score-partwise version="3.1">
+  <!-- A comment -->
+  <identification><encoding><software>x</software></encoding></identification>
+  <part id="P1">
+    <measure number="1" width="200" implicit="yes">
+      <attributes><divisions>100</divisions><key><fifths>-3</fifths></key></attributes>
+      <direction><direction-type><words>dolce</words></direction-type></direction>
+      <note default-x="10" print-object="no" xml:id="n1">
+        <pitch><step>C</step><alter>-100</alter><octave>4</octave></pitch>
+        <duration>  96  </duration>
+        <notations><slur type="start" color="#000" placement="above"/></notations>
+        <unknown-tag><step>D</step></unknown-tag>
+      </note>
+      <note><rest/><duration>7000</duration></note>
+    </measure>
+  </part>
+</score-partwise>
+"""
+
+
+def _ReferenceTokens(root):
+    """The original tokenizer, which mutated the tree as it went."""
+    tokens = []
+    stack = [root]
+    while stack:
+        parent = stack.pop()
+        for name, _ in list(parent.attrib.items()):
+            if not util.KeepAttribute(name):
+                del parent.attrib[name]
+        attrs = " ".join(f'{k}="{v}"' for k, v in parent.attrib.items())
+        attrs = " " + attrs if attrs else ""
+        text = parent.text.strip() if parent.text else ""
+        tokens.append(f"<{parent.tag}{attrs}>")
+        if text:
+            if text.lstrip("-").isnumeric():
+                text = str(util.TranslateNum(int(text)))
+            tokens.append(text)
+        children_to_remove = []
+        for child in reversed(list(iter(parent))):
+            if util.KeepElement(child.tag):
+                stack.append(child)
+            else:
+                children_to_remove.append(child)
+        for child in children_to_remove:
+            parent.remove(child)
+    return tokens
+
+
+class TestTokenizer(unittest.TestCase):
+
+    def assertMatchesReference(self, xml: str):
+        root = ET.fromstring(xml)
+        before = ET.tostring(root)
+        tokens = util.GetTokensFromXmlRoot(root)
+        assert ET.tostring(root) == before, "The tree was modified."
+        elements = json.loads(json.dumps(util.GetElementsFromXmlRoot(root)))
+        assert util.GetTokensFromElements(elements) == tokens
+        assert tokens == _ReferenceTokens(root)
+        return tokens
+
+    def test_matches_reference(self):
+        tokens = self.assertMatchesReference(_XML)
+        assert tokens[:3] == ["<score-partwise>", "<part>", '<measure implicit="yes">']
+        assert '<note print-object="no">' in tokens
+        assert "<unknown-tag>" not in tokens and "dolce" not in tokens
+        assert "-128" in tokens and "96" in tokens and "8192" in tokens
+
+    def test_matches_reference_on_synthetic_scores(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            self.assertMatchesReference(synthetic.GenerateScore(rng, 8))
+
+    def test_follows_consts(self):
+        self.assertMatchesReference(_XML)
+        with mock.patch.object(consts, "ATTRIBUTES_TO_IGNORE", set()):
+            with mock.patch.object(consts, "TAG_NAMES_TO_IGNORE", {"note"}):
+                with mock.patch.object(consts, "WHITELISTED_NUMS", {4}):
+                    tokens = self.assertMatchesReference(_XML)
+        assert "<note>" not in tokens and "<words>" in tokens
+
+
+_EDGE_CASES = {
+    "entities.xml": '<?xml version="1.0"?><!DOCTYPE a [<!ENTITY foo "12">]>'
+    "<score-partwise><part><measure><note><duration>&foo;</duration>"
+    "<type>&amp;&lt;</type></note></measure></part></score-partwise>",
+    "cdata_bom.xml": "\ufeff<score-partwise><part><measure><note>"
+    "<duration><![CDATA[ 100 ]]></duration></note></measure></part>"
+    "</score-partwise>",
+    "pi.xml": "<score-partwise><?pi x?><part><!-- c --><measure><note>"
+    "<step>C<!-- c -->D</step></note></measure></part></score-partwise>",
+    "undefined_entity.xml": '<!DOCTYPE a PUBLIC "x" "http://example.com/x.dtd">'
+    "<score-partwise><part>&nbsp;</part></score-partwise>",
+    "malformed.xml": "<score-partwise><part></score-partwise>",
+    "empty.xml": "",
+}
+
+
+@unittest.skipIf(lxml is None, "lxml is not installed")
+class TestXmlBackends(unittest.TestCase):
+
+    def test_backends_produce_identical_tokens(self):
+        with util.GetTempDir() as dir_path:
+            paths = synthetic.WriteCorpus(dir_path, 30, max_measures=8, seed=1)
+            paths.append(os.path.join(dir_path, "score.xml.gz"))
+            with gzip.open(paths[-1], "wt") as f:
+                f.write(_XML)
+            for name, xml in _EDGE_CASES.items():
+                paths.append(os.path.join(dir_path, name))
+                with open(paths[-1], "w") as f:
+                    f.write(xml)
+
+            tokens = {}
+            for backend in ["etree", "lxml"]:
+                with mock.patch.object(consts, "XML_PARSER", backend):
+                    tokens[backend] = [util.GetTokensFromXml(p) for p in paths]
+                    elements = [util.GetElementsFromXml(p) for p in paths]
+                    assert [util.GetTokensFromElements(e) for e in elements] == (
+                        tokens[backend]
+                    )
+            assert tokens["etree"] == tokens["lxml"]
+            assert tokens["lxml"][-6][4:6] == ["<duration>", "12"]
+            assert tokens["lxml"][-2:] == [[], []]
+
+    def test_returns_lxml_elements(self):
+        with util.GetTempDir() as dir_path:
+            path = os.path.join(dir_path, "score.xml")
+            with open(path, "w") as f:
+                f.write(_XML)
+            with mock.patch.object(consts, "XML_PARSER", "lxml"):
+                assert type(util.ParseXml(path)).__module__ == "lxml.etree"
+
+    def test_lxml_keeps_its_limits(self):
+        from lxml import etree
+
+        deep = "<a>" * 300 + "</a>" * 300
+        for huge_tree in [False, True]:
+            parser = etree.XMLParser(
+                **{**util.LxmlParserOptions(), "huge_tree": huge_tree}
+            )
+            with mock.patch.object(util, "_lxml_parser", parser):
+                with mock.patch.object(consts, "XML_PARSER", "lxml"):
+                    with util.GetTempDir() as dir_path:
+                        path = os.path.join(dir_path, "deep.xml")
+                        with open(path, "w") as f:
+                            f.write(deep)
+                        root = util.ParseXml(path)
+            assert (root is not None) == huge_tree
+        assert not util.LxmlParserOptions()["huge_tree"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,11 +5,29 @@
 # https://opensource.org/licenses/MIT.
 
 import json
+from typing import List
+
+import torch
 
 import consts
 from tokens import Tokens
 
 
+class InvalidTokenError(Exception):
+    """Raised when a token can't follow the tokens registered so far."""
+
+
+def LoadLookups():
+    """Reads the tok2tok and tag2tag lookups written by prep.py."""
+    with open(f"{consts.TRAINING_DATA_ROOT}/tok2tok.json", "r") as f:
+        tok2tok_data = json.loads(f.read())
+    with open(f"{consts.TRAINING_DATA_ROOT}/tag2tag.json", "r") as f:
+        tag2tag_data = json.loads(f.read())
+    tok2tok_lookup = {int(k): set(v) for k, v in tok2tok_data.items()}
+    tag2tag_lookup = {int(k): set(v) for k, v in tag2tag_data.items()}
+    return tok2tok_lookup, tag2tag_lookup
+
+
 class Validator:
     """Class used in model inference to validate the model's output.
 
@@ -30,15 +48,17 @@ class Validator:
     This is all complicated by the fact that our BPE-like tokenization adds
     tokens on the base set of tokens directly from MusicXML. Basically we have
     to take a guess, expand it into base tokens, and validate that first.
+
+    Nothing follows the doc end token in the training data, so once it has been
+    registered the validator is `finished` and would reject every token.
     """
 
-    def __init__(self, start_token: int, tokens: Tokens):
-        with open(f"{consts.TRAINING_DATA_ROOT}/tok2tok.json", "r") as f:
-            tok2tok_data = json.loads(f.read())
-        with open(f"{consts.TRAINING_DATA_ROOT}/tag2tag.json", "r") as f:
-            tag2tag_data = json.loads(f.read())
-        self.tok2tok_lookup = {int(k): set(v) for k, v in tok2tok_data.items()}
-        self.tag2tag_lookup = {int(k): set(v) for k, v in tag2tag_data.items()}
+    def __init__(self, start_token: int, tokens: Tokens, lookups=None):
+        # Pass `lookups` (from LoadLookups) to share them across validators
+        # instead of reading the JSON files again.
+        if lookups is None:
+            lookups = LoadLookups()
+        self.tok2tok_lookup, self.tag2tag_lookup = lookups
         self.tokens = tokens
 
         seq = tokens.Translate(start_token)
@@ -49,26 +69,165 @@ class Validator:
             self.last_token = seq[-1]
             seq_tags = [t for t in seq if self.tokens.TokenIsTag(t)]
             self.last_tag = seq_tags[-1] if seq_tags else self.last_tag
+        self.finished = False
+
+    def prime(self, toks: List[int]):
+        """Saves the tokens that follow the start token without validating them,
+        e.g. a prompt from real MusicXML."""
+        for tok in toks:
+            self.last_token = int(self.tokens.last_base[tok])
+            last_tag = int(self.tokens.last_tag[tok])
+            self.last_tag = last_tag if last_tag != -1 else self.last_tag
+        self.finished = self.last_token == self.tokens.GetDocEndToken()
 
     def register_new_token(self, tok: str):
         """Saves the token presuming it is valid.
 
         Raises:
-            Exception: If the token is not valid.
+            InvalidTokenError: If the token is not valid, including ids past the
+                end of the vocabulary, which the model's padded vocab_size can
+                still sample.
         """
 
+        if not 0 <= tok < self.tokens.Size():
+            raise InvalidTokenError()
         seq = self.tokens.Translate(tok)
         # Check tok2tok.
-        if seq[0] not in self.tok2tok_lookup[self.last_token]:
-            raise Exception()
+        if seq[0] not in self.tok2tok_lookup.get(self.last_token, ()):
+            raise InvalidTokenError()
 
         # Check tag2tag.
         # Find first and last tags.
         seq_tags = [t for t in seq if self.tokens.TokenIsTag(t)]
         if seq_tags:
-            if seq_tags[0] not in self.tag2tag_lookup[self.last_tag]:
-                raise Exception()
+            if seq_tags[0] not in self.tag2tag_lookup.get(self.last_tag, ()):
+                raise InvalidTokenError()
 
         # If we made it past validation, update state.
         self.last_token = seq[-1]
         self.last_tag = seq_tags[-1] if seq_tags else self.last_tag
+        self.finished = self.last_token == self.tokens.GetDocEndToken()
+
+
+class TransitionTables:
+    """The Validator's lookups as dense tensors over the whole vocabulary.
+
+    For every (BPE) token we take its first/last base token and its first/last
+    tag (-1 if it has no tag) from Tokens. The tok2tok and tag2tag adjacency
+    matrices over base tokens are then composed with the first base token and
+    first tag arrays, so row r of `tok_legal`/`tag_legal` says which of the
+    vocab_size candidates may follow a last base token/last tag of r.
+
+    Nothing is ever recorded after the doc end token, so `doc_end_only` (a
+    vocab_size row that only allows it) is what finished rows are masked with.
+
+    Building this takes a pass over the vocabulary, so build it once and share
+    it between BatchValidators.
+    """
+
+    def __init__(self, tokens: Tokens, vocab_size: int, lookups=None, device="cpu"):
+        if lookups is None:
+            lookups = LoadLookups()
+        tok2tok_lookup, tag2tag_lookup = lookups
+        num_base = tokens.BaseSize()
+
+        # Padding at the end of the vocabulary keeps -1 and is never legal.
+        first_token = torch.full((vocab_size,), -1, dtype=torch.long)
+        last_token = torch.full((vocab_size,), -1, dtype=torch.long)
+        first_tag = torch.full((vocab_size,), -1, dtype=torch.long)
+        last_tag = torch.full((vocab_size,), -1, dtype=torch.long)
+        n = tokens.Size()
+        first_token[:n] = torch.from_numpy(tokens.first_base)
+        last_token[:n] = torch.from_numpy(tokens.last_base)
+        first_tag[:n] = torch.from_numpy(tokens.first_tag)
+        last_tag[:n] = torch.from_numpy(tokens.last_tag)
+
+        tok_adj = torch.zeros((num_base, num_base + 1), dtype=torch.bool)
+        for k, v in tok2tok_lookup.items():
+            tok_adj[k, list(v)] = True
+        # The extra last row is the state before any tag was seen, which lets
+        # every tag through.
+        tag_adj = torch.zeros((num_base + 1, num_base + 1), dtype=torch.bool)
+        tag_adj[num_base] = True
+        for k, v in tag2tag_lookup.items():
+            tag_adj[k, list(v)] = True
+        # Column num_base (reached through index -1) stands for "no base
+        # token"/"no tag": never legal for tok2tok, always for tag2tag.
+        tag_adj[:, num_base] = True
+
+        self.num_base = num_base
+        self.doc_end = tokens.GetDocEndToken()
+        self.doc_end_only = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        self.doc_end_only[self.doc_end] = True
+        self.first_token = first_token.to(device)
+        self.last_token = last_token.to(device)
+        self.first_tag = first_tag.to(device)
+        self.last_tag = last_tag.to(device)
+        self.tok_legal = tok_adj[:, first_token].to(device)
+        self.tag_legal = tag_adj[:, first_tag].to(device)
+
+
+class BatchValidator:
+    """A Validator for a batch of sequences that works on whole batches at once.
+
+    The per-row state is a `last_token` and a `last_tag` vector. `legal`
+    answers which of the vocab_size candidates may come next in every row with
+    one gather per table, so it can mask logits before sampling instead of
+    sampling and retrying. `register` updates every row at once.
+
+    A row is `finished` once it registers the doc end token, or when nothing may
+    follow its last token at all (transitions are only recorded inside docs).
+    Finished rows keep their state and only accept the doc end token, so
+    generating a batch can go on until every row has finished.
+    """
+
+    def __init__(self, start_tokens: List[int], tables: TransitionTables):
+        self.tables = tables
+        start = torch.tensor(start_tokens, device=tables.tok_legal.device)
+        self.last_token = tables.last_token[start]
+        # Like Validator, a lone base start token counts as the last tag.
+        start_tag = tables.last_tag[start]
+        self.last_tag = torch.where(
+            start < tables.num_base,
+            start,
+            torch.where(start_tag >= 0, start_tag, tables.num_base),
+        )
+        self.finished = ~self._successors().any(-1)
+
+    def _successors(self) -> torch.Tensor:
+        return (
+            self.tables.tok_legal[self.last_token]
+            & self.tables.tag_legal[self.last_tag]
+        )
+
+    def legal(self) -> torch.Tensor:
+        """Returns a (b, vocab_size) bool tensor of the candidates each row accepts."""
+        return torch.where(
+            self.finished[:, None], self.tables.doc_end_only, self._successors()
+        )
+
+    def mask_logits_(self, logits: torch.Tensor) -> torch.Tensor:
+        """Sets the logits of every illegal candidate to -inf in place."""
+        return logits.masked_fill_(~self.legal(), -float("Inf"))
+
+    def register(self, toks: torch.Tensor) -> torch.Tensor:
+        """Registers the next token of every row, given as a (b,) or (b, 1) tensor.
+
+        Rows whose token is illegal, and finished rows, keep their state.
+        Returns a (b,) bool tensor of the rows whose token was accepted.
+        """
+        toks = toks.view(-1)
+        ok = self.tables.tok_legal[self.last_token, toks]
+        ok &= self.tables.tag_legal[self.last_tag, toks]
+        ok = torch.where(self.finished, toks == self.tables.doc_end, ok)
+        update = ok & ~self.finished
+        self.last_token = torch.where(
+            update, self.tables.last_token[toks], self.last_token
+        )
+        tok_last_tag = self.tables.last_tag[toks]
+        self.last_tag = torch.where(
+            update & (tok_last_tag >= 0), tok_last_tag, self.last_tag
+        )
+        self.finished |= update & (self.last_token == self.tables.doc_end)
+        self.finished |= ~self._successors().any(-1)
+        return ok
@@ -0,0 +1,129 @@
+# Copyright 2023 Google LLC
+
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import random
+import unittest
+
+import torch
+
+import consts
+from tokens import Tokens
+from validator import BatchValidator, InvalidTokenError, TransitionTables, Validator
+
+
+def _Setup():
+    base_stoi = {
+        "<score-partwise>": 0,
+        "<part>": 1,
+        "<note>": 2,
+        "C": 3,
+        "D": 4,
+        "<rest />": 5,
+        consts.DOC_END_TOKEN: 6,
+    }
+    merges = [((0, 1), 7), ((2, 3), 8), ((3, 4), 9), ((8, 2), 10), ((4, 3), 11)]
+    tokens = Tokens(base_stoi, merges)
+
+    rng = random.Random(0)
+    # Like in prep, nothing follows the doc end token.
+    tok2tok = {k: {j for j in range(7) if rng.random() < 0.6} for k in range(6)}
+    tags = [0, 1, 2, 5]
+    tag2tag = {k: {j for j in tags if rng.random() < 0.6} for k in tags[:-1]}
+    return tokens, (tok2tok, tag2tag)
+
+
+def _ScalarAccepts(validator: Validator, tok: int) -> bool:
+    state = (validator.last_token, validator.last_tag)
+    try:
+        validator.register_new_token(tok)
+    except InvalidTokenError:
+        return False
+    validator.last_token, validator.last_tag = state
+    return True
+
+
+class TestValidator(unittest.TestCase):
+
+    def test_prime_matches_registering(self):
+        tokens, _ = _Setup()
+        everything = set(range(tokens.Size()))
+        lookups = ({k: everything for k in range(7)}, {k: everything for k in range(7)})
+        rng = random.Random(0)
+        for _ in range(20):
+            toks = [rng.randrange(tokens.Size()) for _ in range(rng.randrange(6))]
+            registered = Validator(7, tokens, lookups=lookups)
+            for tok in toks:
+                registered.register_new_token(tok)
+            primed = Validator(7, tokens, lookups=lookups)
+            primed.prime(toks)
+            assert (primed.last_token, primed.last_tag) == (
+                registered.last_token,
+                registered.last_tag,
+            )
+
+
+class TestBatchValidator(unittest.TestCase):
+
+    def test_matches_validator(self):
+        tokens, lookups = _Setup()
+        vocab_size = 16  # Includes padding past tokens.Size().
+        tables = TransitionTables(tokens, vocab_size, lookups=lookups)
+        starts = [0, 7, 7]
+        scalars = [Validator(s, tokens, lookups=lookups) for s in starts]
+        batch = BatchValidator(starts, tables)
+
+        rng = random.Random(1)
+        for _ in range(50):
+            legal = batch.legal()
+            assert legal.shape == (3, vocab_size)
+            for row, scalar in enumerate(scalars):
+                expected = [_ScalarAccepts(scalar, t) for t in range(tokens.Size())]
+                if batch.finished[row]:
+                    # Only the doc end token, as padding.
+                    assert not any(expected)
+                    expected = [t == 6 for t in range(tokens.Size())]
+                assert legal[row, : tokens.Size()].tolist() == expected
+                assert not legal[row, tokens.Size() :].any()
+
+            toks = [rng.randrange(tokens.Size()) for _ in scalars]
+            ok = batch.register(torch.tensor(toks))
+            for row, (scalar, tok) in enumerate(zip(scalars, toks)):
+                if _ScalarAccepts(scalar, tok):
+                    assert ok[row]
+                    scalar.register_new_token(tok)
+                else:
+                    assert ok[row].item() == (
+                        tok == 6
+                        and not any(
+                            _ScalarAccepts(scalar, t) for t in range(tokens.Size())
+                        )
+                    )
+
+    def test_finishes_at_doc_end(self):
+        tokens, _ = _Setup()
+        tags = [0, 1, 2, 5]
+        lookups = ({k: set(range(7)) for k in range(6)}, {k: set(tags) for k in tags})
+        tables = TransitionTables(tokens, 12, lookups=lookups)
+        batch = BatchValidator([7, 7], tables)
+        assert batch.legal()[:, 6].all() and not batch.finished.any()
+
+        batch.register(torch.tensor([6, 3]))
+        assert batch.finished.tolist() == [True, False]
+        assert batch.legal()[0].nonzero().view(-1).tolist() == [6]
+        # The finished row keeps taking the doc end token as padding.
+        assert batch.register(torch.tensor([6, 6])).tolist() == [True, True]
+        assert batch.finished.all()
+
+    def test_mask_logits(self):
+        tokens, lookups = _Setup()
+        tables = TransitionTables(tokens, 12, lookups=lookups)
+        batch = BatchValidator([7], tables)
+        logits = batch.mask_logits_(torch.zeros(1, 12))
+        assert torch.equal(torch.isfinite(logits), batch.legal())
+
+
+if __name__ == "__main__":
+    unittest.main()